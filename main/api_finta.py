@@ -0,0 +1,326 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+# Bot API di Telegram finta, in memoria, per i test di carico end-to-end (vedi carico.py).
+# Il bot la usa al posto di api.telegram.org con TELEGRAM_API_URL=http://127.0.0.1:8081
+# (qualsiasi TELEGRAM_BOT_TOKEN va bene). Emula i metodi usati dal bot: getMe, getUpdates
+# (long polling) oppure setWebhook con consegna degli aggiornamenti via POST, sendMessage,
+# editMessageText, editMessageReplyMarkup, answerCallbackQuery, sendPhoto, sendDocument,
+# getFile (con il download da /file/bot<token>/<percorso>), setMyCommands.
+# Gli utenti virtuali scrivono con invia_messaggio/invia_callback/invia_documento e ricevono
+# le risposte del bot nella coda della propria chat (risposte(chat_id)).
+# Con limite_globale / limite_chat (chiamate al secondo) risponde 429 con retry_after come
+# Telegram quando il bot li supera (vedi invii.py).
+#
+# Uso da solo: python api_finta.py [porta]  (utile per provare il bot a mano)
+
+BOT = {"id": 1000000001, "is_bot": True, "first_name": "Bot finto", "username": "bot_finto_bot"}
+
+# Parametri che PTB invia codificati in JSON (le stringhe arrivano così come sono)
+PARAMETRI_JSON = {
+    "chat_id", "message_id", "offset", "limit", "timeout", "reply_markup", "allowed_updates",
+    "commands", "show_alert", "max_connections", "drop_pending_updates", "cache_time",
+    "disable_notification", "protect_content", "reply_parameters", "link_preview_options", "scope",
+}
+
+# Metodi che non contano per i limiti di invio
+METODI_SENZA_LIMITI = {"getMe", "getUpdates", "setWebhook", "deleteWebhook", "getWebhookInfo", "setMyCommands"}
+
+# Metodi che producono un messaggio del bot nella chat
+METODI_MESSAGGIO = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendPhoto", "sendDocument"}
+
+def _utente(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Utente {user_id}"}
+
+def _chat(chat_id):
+    return {"id": chat_id, "type": "private", "first_name": f"Utente {chat_id}"}
+
+class ApiFinta:
+    def __init__(self, latenza=0.0, limite_globale=None, limite_chat=None):
+        self.latenza = latenza          # secondi aggiunti a ogni risposta, come la rete verso Telegram
+        self.limite_globale = limite_globale
+        self.limite_chat = limite_chat
+        self.finestre = {}              # None (globale) o chat_id -> (secondo, chiamate nel secondo)
+        self.respinte = 0               # risposte 429
+        self.id_aggiornamenti = itertools.count(1)
+        self.id_messaggi = itertools.count(1)
+        self.id_file = itertools.count(1)
+        self.id_callback = itertools.count(1)
+        self.callback = {}              # id del callback -> user_id, finché il bot non risponde
+        self.file = {}                  # file_id -> contenuto dei documenti inviati dagli utenti
+        self.aggiornamenti = []         # in attesa di getUpdates
+        self.nuovi = asyncio.Event()
+        self.webhook = None             # (url, segreto) dopo setWebhook
+        self.consegne = None            # coda della consegna via webhook
+        self.consegnatori = []
+        self.sessione = None
+        self.code = {}                  # chat_id -> asyncio.Queue di (istante, metodo, parametri, risultato)
+        self.collegato = asyncio.Event()  # il bot ha chiamato getUpdates o setWebhook
+        self.chiamate = {}              # metodo -> numero di chiamate
+        self.errori_consegna = 0
+        self.runner = None
+
+    # Lato utenti virtuali
+
+    def risposte(self, chat_id):
+        coda = self.code.get(chat_id)
+        if coda is None:
+            coda = self.code[chat_id] = asyncio.Queue()
+        return coda
+
+    async def invia_messaggio(self, user_id, testo):
+        messaggio = {
+            "message_id": next(self.id_messaggi),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _utente(user_id),
+            "text": testo,
+        }
+        if testo.startswith("/"):
+            comando = testo.split()[0]
+            messaggio["entities"] = [{"type": "bot_command", "offset": 0, "length": len(comando)}]
+        await self._aggiornamento({"message": messaggio})
+
+    # Click su un bottone inline del messaggio del bot `messaggio` (come restituito in risposte())
+    async def invia_callback(self, user_id, messaggio, dati):
+        id_callback = str(next(self.id_callback))
+        self.callback[id_callback] = user_id
+        await self._aggiornamento({"callback_query": {
+            "id": id_callback,
+            "from": _utente(user_id),
+            "chat_instance": str(user_id),
+            "message": messaggio,
+            "data": dati,
+        }})
+
+    # Documento inviato dall'utente (es. il CSV di /importa): il bot lo scarica con getFile
+    async def invia_documento(self, user_id, nome_file, contenuto, didascalia=None):
+        documento = self._file(file_name=nome_file, file_size=len(contenuto))
+        self.file[documento["file_id"]] = contenuto
+        messaggio = {
+            "message_id": next(self.id_messaggi),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _utente(user_id),
+            "document": documento,
+        }
+        if didascalia:
+            messaggio["caption"] = didascalia
+        await self._aggiornamento({"message": messaggio})
+
+    async def _aggiornamento(self, contenuto):
+        aggiornamento = {"update_id": next(self.id_aggiornamenti), **contenuto}
+        if self.webhook is not None:
+            await self.consegne.put(aggiornamento)
+        else:
+            self.aggiornamenti.append(aggiornamento)
+            self.nuovi.set()
+
+    # Consegna via webhook: `max_connections` richieste in parallelo, come fa Telegram
+    async def _consegna(self):
+        while True:
+            aggiornamento = await self.consegne.get()
+            url, segreto = self.webhook
+            intestazioni = {"X-Telegram-Bot-Api-Secret-Token": segreto} if segreto else {}
+            try:
+                async with self.sessione.post(url, json=aggiornamento, headers=intestazioni) as risposta:
+                    if risposta.status != 200:
+                        self.errori_consegna += 1
+            except (ClientError, asyncio.TimeoutError):
+                self.errori_consegna += 1
+
+    # Conta la chiamata nel secondo corrente; True se supera il limite
+    def _oltre_limite(self, chiave, limite):
+        secondo = int(time.monotonic())
+        inizio, chiamate = self.finestre.get(chiave, (secondo, 0))
+        if inizio != secondo:
+            chiamate = 0
+        self.finestre[chiave] = (secondo, chiamate + 1)
+        return chiamate + 1 > limite
+
+    def _troppe_richieste(self, metodo, parametri):
+        if metodo in METODI_SENZA_LIMITI:
+            return False
+        chat_id = parametri.get("chat_id")
+        oltre = self.limite_globale is not None and self._oltre_limite(None, self.limite_globale)
+        if self.limite_chat is not None and chat_id is not None:
+            oltre = self._oltre_limite(chat_id, self.limite_chat) or oltre
+        return oltre
+
+    # Metodi del Bot API
+
+    async def _get_updates(self, parametri):
+        offset = parametri.get("offset")
+        if offset:
+            self.aggiornamenti = [a for a in self.aggiornamenti if a["update_id"] >= offset]
+        self.collegato.set()
+        if not self.aggiornamenti:
+            self.nuovi.clear()
+            try:
+                await asyncio.wait_for(self.nuovi.wait(), timeout=parametri.get("timeout") or 0)
+            except asyncio.TimeoutError:
+                pass
+        return self.aggiornamenti[:parametri.get("limit") or 100]
+
+    async def _set_webhook(self, parametri):
+        await self._ferma_consegna()
+        self.webhook = (parametri["url"], parametri.get("secret_token"))
+        self.consegne = asyncio.Queue()
+        self.consegnatori = [
+            asyncio.get_running_loop().create_task(self._consegna())
+            for _ in range(parametri.get("max_connections") or 40)
+        ]
+        # Gli aggiornamenti non ancora letti con getUpdates passano al webhook
+        for aggiornamento in self.aggiornamenti:
+            self.consegne.put_nowait(aggiornamento)
+        self.aggiornamenti = []
+        self.collegato.set()
+        return True
+
+    async def _delete_webhook(self, parametri):
+        await self._ferma_consegna()
+        self.webhook = None
+        return True
+
+    async def _ferma_consegna(self):
+        for task in self.consegnatori:
+            task.cancel()
+        self.consegnatori = []
+
+    def _messaggio_bot(self, parametri, **campi):
+        messaggio = {
+            "message_id": parametri.get("message_id") or next(self.id_messaggi),
+            "date": int(time.time()),
+            "chat": _chat(parametri["chat_id"]),
+            "from": BOT,
+            **campi,
+        }
+        if "reply_markup" in parametri:
+            messaggio["reply_markup"] = parametri["reply_markup"]
+        return messaggio
+
+    def _file(self, **campi):
+        numero = next(self.id_file)
+        return {"file_id": f"finto{numero}", "file_unique_id": f"u{numero}", **campi}
+
+    async def _esegui(self, metodo, parametri):
+        if metodo == "getMe":
+            return BOT
+        if metodo == "getUpdates":
+            return await self._get_updates(parametri)
+        if metodo == "setWebhook":
+            return await self._set_webhook(parametri)
+        if metodo == "deleteWebhook":
+            return await self._delete_webhook(parametri)
+        if metodo == "getWebhookInfo":
+            return {"url": self.webhook[0] if self.webhook else "", "has_custom_certificate": False,
+                    "pending_update_count": len(self.aggiornamenti)}
+        if metodo in ("setMyCommands", "deleteMyCommands", "sendChatAction", "answerCallbackQuery"):
+            return True
+        if metodo in ("sendMessage", "editMessageText"):
+            return self._messaggio_bot(parametri, text=parametri.get("text", ""))
+        if metodo == "editMessageReplyMarkup":
+            # La Bot API finta non conserva i messaggi: il testo modificato non è noto
+            return self._messaggio_bot(parametri, text="")
+        if metodo == "getFile":
+            contenuto = self.file.get(parametri.get("file_id"))
+            if contenuto is None:
+                return None
+            return {"file_id": parametri["file_id"], "file_unique_id": "u" + parametri["file_id"],
+                    "file_size": len(contenuto), "file_path": f"documents/{parametri['file_id']}"}
+        if metodo == "sendPhoto":
+            return self._messaggio_bot(parametri, caption=parametri.get("caption", ""), photo=[
+                self._file(width=90, height=60, file_size=1000), self._file(width=1000, height=600, file_size=50000),
+            ])
+        if metodo == "sendDocument":
+            return self._messaggio_bot(parametri, caption=parametri.get("caption", ""), document=self._file(
+                file_name=parametri.get("nome_file", "documento"), file_size=parametri.get("dimensione", 0),
+            ))
+        return None
+
+    async def gestisci(self, request):
+        metodo = request.match_info["metodo"]
+        self.chiamate[metodo] = self.chiamate.get(metodo, 0) + 1
+        parametri = {}
+        for chiave, valore in (await request.post()).items():
+            if isinstance(valore, web.FileField):
+                # Documenti e foto caricati: conta solo la dimensione
+                contenuto = valore.file.read()
+                parametri["nome_file"] = valore.filename
+                parametri["dimensione"] = len(contenuto)
+            elif chiave in PARAMETRI_JSON:
+                parametri[chiave] = json.loads(valore)
+            else:
+                parametri[chiave] = valore
+
+        if self.latenza and metodo != "getUpdates":
+            await asyncio.sleep(self.latenza)
+        if self._troppe_richieste(metodo, parametri):
+            self.respinte += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        risultato = await self._esegui(metodo, parametri)
+        if risultato is None and metodo == "getFile":
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}, status=400)
+        if risultato is None:
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found: method not found"}, status=404)
+
+        if metodo in METODI_MESSAGGIO:
+            chat_id = parametri.get("chat_id")
+        elif metodo == "answerCallbackQuery":
+            # La risposta a un callback non ha chat_id: va alla chat dell'utente del callback
+            chat_id = self.callback.pop(parametri.get("callback_query_id"), None)
+        else:
+            chat_id = None
+        if chat_id is not None:
+            self.risposte(chat_id).put_nowait((time.perf_counter(), metodo, parametri, risultato))
+        return web.json_response({"ok": True, "result": risultato})
+
+    # Download dei file, come https://api.telegram.org/file/bot<token>/<file_path>
+    async def scarica(self, request):
+        contenuto = self.file.get(request.match_info["percorso"].rpartition("/")[2])
+        if contenuto is None:
+            return web.Response(status=404)
+        return web.Response(body=contenuto)
+
+    # Server
+
+    async def avvia(self, porta):
+        self.sessione = ClientSession(timeout=ClientTimeout(total=30))
+        app = web.Application(client_max_size=60 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{metodo}", self.gestisci)
+        app.router.add_get("/bot{token}/{metodo}", self.gestisci)
+        app.router.add_get("/file/bot{token}/{percorso:.+}", self.scarica)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", porta).start()
+        print(f"🤖 Bot API finta su http://127.0.0.1:{porta} (TELEGRAM_API_URL per il bot)")
+
+    async def chiudi(self):
+        await self._ferma_consegna()
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.sessione is not None:
+            await self.sessione.close()
+
+async def _comando(porta):
+    api = ApiFinta()
+    await api.avvia(porta)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.chiudi()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_comando(int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("API_FINTA_PORTA", "8081"))))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,483 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import asyncpg
+
+import esportazione
+import paginazione
+import query
+import rollup
+import saldi
+from migrazioni import applica_migrazioni
+
+# Benchmark delle query del bot su un Postgres locale.
+# Per ogni dimensione richiesta genera un dataset sintetico nello schema `benchmark` (le tabelle
+# del bot non vengono toccate: le connessioni usano search_path=benchmark), lo carica con COPY,
+# poi esegue ogni caso di CASI: latenza su più ripetizioni e un EXPLAIN (ANALYZE, BUFFERS).
+# Un caso fallisce se supera il budget di latenza (p95) o se il piano fa un Seq Scan su una
+# tabella grande non prevista. I risultati vanno in un file JSON, confrontabile tra esecuzioni.
+#
+# Uso: python benchmark.py [--dimensioni 10000,100000,1000000] [--utenti 1000]
+#                          [--output risultati.json] [--confronta precedente.json]
+# Il database si indica con BENCHMARK_DATABASE_URL (o DATABASE_URL); lo schema `benchmark`
+# viene ricreato a ogni dimensione e lasciato al termine per ispezionarlo.
+
+SCHEMA = "benchmark"
+
+CATEGORIE = ("Spesa", "Casa", "Trasporti", "Ristoranti", "Salute", "Svago", "Abbonamenti", "Regali")
+CARTE = ("Bancomat", "Visa", "Contanti")
+# Tabelle del bot (nello schema del benchmark) da passare a VACUUM ANALYZE dopo il caricamento
+TABELLE = ("transazioni", "categorie", "carte", "saldi_mensili", "stato_utenti", "transazioni_rollup_minuto",
+           "transazioni_rollup_utente_giorno", "transazioni_rollup_utente")
+# Righe di una pagina del riepilogo, come PAGINA_RIEPILOGO in transaction.py
+PAGINA = 20
+DESCRIZIONI = ("supermercato", "benzina", "affitto", "bolletta luce", "pizzeria", "farmacia",
+               "cinema", "treno", "stipendio", "rimborso", "palestra", "libri")
+
+# Dataset
+
+# Pesi degli utenti con distribuzione di Zipf: pochi utenti con moltissime transazioni,
+# la maggior parte con poche (il primo utente è il più pesante)
+def pesi_cumulativi(utenti, asimmetria):
+    cumulati = []
+    totale = 0.0
+    for rango in range(1, utenti + 1):
+        totale += 1 / rango ** asimmetria
+        cumulati.append(totale)
+    return cumulati
+
+# Transazioni in ordine cronologico (come arrivano nella realtà) negli ultimi `giorni`:
+# l'utente è estratto con i pesi di Zipf, l'85% sono spese
+def genera_transazioni(rng, totale, utenti, cumulati, categorie, carte, giorni, adesso):
+    inizio = adesso - timedelta(days=giorni)
+    passo = timedelta(days=giorni) / totale
+    blocco = 10000
+    for partenza in range(0, totale, blocco):
+        estratti = rng.choices(utenti, cum_weights=cumulati, k=min(blocco, totale - partenza))
+        for i, user_id in enumerate(estratti):
+            data = inizio + passo * (partenza + i)
+            if rng.random() < 0.85:
+                importo = -Decimal(f"{rng.expovariate(1 / 40) + 0.5:.2f}")
+            else:
+                importo = Decimal(f"{rng.uniform(50, 2500):.2f}")
+            yield (
+                user_id,
+                f"{rng.choice(DESCRIZIONI)} {rng.randint(1, 99)}",
+                importo,
+                data,
+                rng.choice(categorie[user_id]) if rng.random() < 0.9 else None,
+                rng.choice(carte[user_id]) if rng.random() < 0.7 else None,
+            )
+
+async def carica_dataset(pool, transazioni, utenti, asimmetria, giorni, seme):
+    rng = random.Random(seme)
+    adesso = datetime.now().replace(microsecond=0)
+    id_utenti = [10_000_000 + i for i in range(utenti)]
+    categorie = {}
+    carte = {}
+    righe_categorie = []
+    righe_carte = []
+    for user_id in id_utenti:
+        categorie[user_id] = []
+        for nome in CATEGORIE:
+            righe_categorie.append((len(righe_categorie) + 1, user_id, nome))
+            categorie[user_id].append(len(righe_categorie))
+        carte[user_id] = []
+        for nome in CARTE:
+            righe_carte.append((len(righe_carte) + 1, user_id, nome))
+            carte[user_id].append(len(righe_carte))
+
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table("categorie", records=righe_categorie, columns=["id", "user_id", "nome"])
+        await conn.copy_records_to_table("carte", records=righe_carte, columns=["id", "user_id", "nome"])
+        await conn.execute("SELECT setval(pg_get_serial_sequence('categorie', 'id'), $1)", len(righe_categorie))
+        await conn.execute("SELECT setval(pg_get_serial_sequence('carte', 'id'), $1)", len(righe_carte))
+        await conn.copy_records_to_table(
+            "transazioni",
+            records=genera_transazioni(
+                rng, transazioni, id_utenti, pesi_cumulativi(utenti, asimmetria), categorie, carte, giorni, adesso
+            ),
+            columns=["user_id", "descrizione", "importo", "data", "categoria_id", "metodopagamento"],
+        )
+        # Tabelle derivate come le manterrebbe il bot, poi statistiche e visibility map
+        async with conn.transaction():
+            await rollup.ricostruisci_conn(conn)
+            await saldi.ricostruisci_conn(conn)
+        await conn.execute(f"VACUUM ANALYZE {', '.join(TABELLE)}")
+    return id_utenti[0]
+
+# Valori usati come parametri dei casi, presi dal dataset appena caricato
+async def contesto(pool, user_id):
+    finestra = paginazione.ultimi_giorni(paginazione.GIORNI_DEFAULT)
+    async with pool.acquire() as conn:
+        categoria_id = await conn.fetchval("SELECT MIN(id) FROM categorie WHERE user_id = $1", user_id)
+        carta_id = await conn.fetchval("SELECT MIN(id) FROM carte WHERE user_id = $1", user_id)
+        recente = await conn.fetchrow(
+            "SELECT id, data FROM transazioni WHERE user_id = $1 ORDER BY data DESC, id DESC LIMIT 1", user_id
+        )
+        # Bordo della prima pagina del riepilogo: parametri della pagina successiva
+        bordo = await conn.fetchrow("""
+            SELECT id, data FROM transazioni WHERE user_id = $1 AND data >= $2 AND data < $3
+            ORDER BY data DESC, id DESC OFFSET $4 LIMIT 1
+        """, user_id, *finestra, PAGINA - 1)
+    bordo = bordo or recente
+    return {
+        "user_id": user_id,
+        "categoria_id": categoria_id,
+        "carta_id": carta_id,
+        "transazione_id": recente["id"],
+        "cursore": (bordo["data"], bordo["id"]),
+        "finestra": finestra,
+        "anno": paginazione.ultimi_giorni(365),
+        "mese": datetime.now().date().replace(day=1),
+        "oggi": datetime.now().date(),
+    }
+
+# Casi
+
+class Caso:
+    def __init__(self, nome, argomenti, query_nome=None, sql=None, budget_ms=None, seq_scan_ammessi=(), scrittura=False,
+                 preparazione=None, piano=True):
+        self.nome = nome
+        self.query_nome = query_nome or nome
+        self.sql = sql
+        self.argomenti = argomenti              # contesto -> parametri della query
+        self.budget_ms = budget_ms              # None = budget di default
+        self.seq_scan_ammessi = seq_scan_ammessi
+        self.scrittura = scrittura              # eseguita in una transazione annullata
+        self.preparazione = preparazione        # async (conn, contesto), nella stessa transazione, non misurata
+        self.piano = piano                      # False per le istruzioni senza EXPLAIN (DDL)
+
+    def testo(self):
+        return self.sql if self.sql is not None else query.QUERY[self.query_nome]
+
+_SQL_ESPORTAZIONE, _ = esportazione.sql_esportazione(None, None, esportazione.COLONNE_DEFAULT)
+
+# Importazione: la tabella temporanea con le ultime 1000 transazioni dell'utente, come
+# reimportando un'esportazione (tutte duplicate: il controllo NOT EXISTS lavora per ogni riga)
+async def _prepara_importazione(conn, ctx):
+    await conn.execute(query.QUERY["importazione.tabella"])
+    await conn.execute("""
+        INSERT INTO importazione (descrizione, importo, data, categoria_id, carta_id)
+        SELECT descrizione, importo, data, categoria_id, metodoPagamento FROM transazioni
+        WHERE user_id = $1 ORDER BY data DESC LIMIT 1000
+    """, ctx["user_id"])
+
+# Paginazione di /riepilogo e /gestisci: ogni variante (g, s, e, c) in ogni direzione
+# (prima pagina, avanti ".a" e indietro ".i" da un cursore)
+def _casi_paginazione():
+    casi = []
+    for variante in ("g", "s", "e", "c"):
+        for direzione in ("", ".a", ".i"):
+            def argomenti(c, variante=variante, direzione=direzione, riepilogo=True):
+                categoria = (c["categoria_id"],) if variante == "c" else ()
+                finestra = c["finestra"] if riepilogo else ()
+                cursore = c["cursore"] if direzione else ()
+                # Pagine di PAGINA righe per /riepilogo, di PAGINA_GESTISCI = 10 per /gestisci, più una
+                return (c["user_id"], *categoria, *finestra, *cursore, (PAGINA if riepilogo else 10) + 1)
+            casi.append(Caso(f"riepilogo.pagina.{variante}{direzione}", argomenti))
+            casi.append(Caso(f"transazioni.pagina.{variante}{direzione}",
+                             functools.partial(argomenti, riepilogo=False)))
+    return casi
+
+CASI = [
+    # /riepilogo e /gestisci; il riepilogo anche su un anno
+    *_casi_paginazione(),
+    Caso("riepilogo.pagina.g (365 giorni)", lambda c: (c["user_id"], *c["anno"], PAGINA + 1),
+         query_nome="riepilogo.pagina.g"),
+    Caso("transazioni.by_id", lambda c: (c["transazione_id"], c["user_id"])),
+    # /grafico
+    Caso("grafici.generale", lambda c: (c["user_id"],)),
+    Caso("grafici.spese_per_categoria", lambda c: (c["user_id"],)),
+    Caso("grafici.entrate_per_categoria", lambda c: (c["user_id"],)),
+    # Categorie, carte, stato delle conversazioni
+    Caso("categorie.by_user", lambda c: (c["user_id"],)),
+    Caso("carte.by_user", lambda c: (c["user_id"],)),
+    Caso("stato.by_user", lambda c: (c["user_id"],)),
+    # Una volta all'avvio per ConversationHandler: legge tutta stato_utenti
+    Caso("stato.conversazioni", lambda c: ("spesa",), seq_scan_ammessi=("stato_utenti",)),
+    Caso("replica.ritardo", lambda c: ()),
+    # /esporta: conteggio e query del COPY (tutta la storia dell'utente più pesante)
+    Caso("esportazione.conta", lambda c: (c["user_id"],)),
+    Caso("esportazione.conta.dal", lambda c: (c["user_id"], c["anno"][0])),
+    Caso("esportazione.conta.al", lambda c: (c["user_id"], c["anno"][1])),
+    Caso("esportazione.conta.dal.al", lambda c: (c["user_id"], *c["anno"])),
+    Caso("esportazione.copy", lambda c: (c["user_id"],), sql=_SQL_ESPORTAZIONE, budget_ms=2000),
+    # /metrics (solo tabelle di rollup)
+    Caso("metrics.oggi", lambda c: ()),
+    Caso("metrics.utenti_attivi_oggi", lambda c: ()),
+    Caso("metrics.crescita", lambda c: ()),
+    Caso("metrics.per_periodo.minute", lambda c: (timedelta(hours=2),)),
+    Caso("metrics.per_periodo.5m", lambda c: (timedelta(hours=12),)),
+    Caso("metrics.per_periodo.hour", lambda c: (timedelta(days=2),)),
+    Caso("metrics.per_periodo.day", lambda c: (timedelta(days=30),)),
+    # Conta tutte le righe per definizione
+    Caso("metrics.utenti_totali", lambda c: (), seq_scan_ammessi=("transazioni_rollup_utente",)),
+    # Scritture, ognuna in una transazione annullata
+    Caso("transazioni.insert", lambda c: (c["user_id"], "benchmark", Decimal("-1.00"), c["categoria_id"], c["carta_id"]),
+         scrittura=True),
+    Caso("transazioni.lock_by_id", lambda c: (c["transazione_id"], c["user_id"]), scrittura=True),
+    Caso("transazioni.update", lambda c: (None, Decimal("-2.00"), c["transazione_id"]), scrittura=True),
+    Caso("transazioni.delete", lambda c: (c["transazione_id"], c["user_id"]), scrittura=True),
+    Caso("saldi.aggiorna", lambda c: (
+        [c["user_id"]], [c["categoria_id"]], [c["mese"]], [Decimal(0)], [Decimal("-1.00")], [0], [1], [1]
+    ), scrittura=True),
+    Caso("rollup.minuto", lambda c: ([datetime.now().replace(second=0, microsecond=0)], ["uscite"], [1]),
+         scrittura=True),
+    Caso("stato.salva", lambda c: ([c["user_id"]], ["{}"], ["{}"]), scrittura=True),
+    Caso("stato.elimina", lambda c: ([c["user_id"]],), scrittura=True),
+    Caso("transazioni.insert_batch", lambda c: (
+        [c["user_id"]] * 10, ["benchmark"] * 10, [Decimal("-1.00")] * 10, [c["categoria_id"]] * 10, [c["carta_id"]] * 10
+    ), scrittura=True),
+    Caso("saldi.pulizia", lambda c: ([c["user_id"]], [c["categoria_id"]], [c["mese"]]), scrittura=True),
+    Caso("saldi.sposta_categoria", lambda c: (c["user_id"], c["categoria_id"]), scrittura=True),
+    Caso("rollup.minuto_pulizia", lambda c: ([datetime.now().replace(second=0, microsecond=0)], ["uscite"]),
+         scrittura=True),
+    Caso("rollup.utente_giorno", lambda c: ([c["oggi"]], [c["user_id"]], [1]), scrittura=True),
+    Caso("rollup.utente_giorno_pulizia", lambda c: ([c["oggi"]], [c["user_id"]]), scrittura=True),
+    Caso("rollup.utente", lambda c: ([c["user_id"]], [1]), scrittura=True),
+    Caso("rollup.utente_pulizia", lambda c: ([c["user_id"]],), scrittura=True),
+    # Categorie e carte. L'eliminazione di una categoria include l'ON DELETE SET NULL sulle sue
+    # transazioni: il tempo del trigger conta nella latenza ma non compare come nodo del piano
+    Caso("categorie.insert", lambda c: (c["user_id"], "Benchmark"), scrittura=True),
+    Caso("categorie.update_nome", lambda c: ("Benchmark", c["categoria_id"], c["user_id"]), scrittura=True),
+    Caso("categorie.delete_by_id", lambda c: (c["categoria_id"], c["user_id"]), scrittura=True),
+    Caso("categorie.delete_by_nome", lambda c: (c["user_id"], CATEGORIE[0]), scrittura=True),
+    Caso("carte.insert", lambda c: (c["user_id"], "Benchmark"), scrittura=True),
+    # /importa
+    Caso("importazione.categorie_crea", lambda c: (c["user_id"], [*CATEGORIE, "Benchmark"]), scrittura=True),
+    Caso("importazione.categorie_ids", lambda c: (c["user_id"], list(CATEGORIE))),
+    Caso("importazione.carte_crea", lambda c: (c["user_id"], [*CARTE, "Benchmark"]), scrittura=True),
+    Caso("importazione.carte_ids", lambda c: (c["user_id"], list(CARTE))),
+    Caso("importazione.tabella", lambda c: (), scrittura=True, piano=False),
+    Caso("importazione.inserisci", lambda c: (c["user_id"],), scrittura=True, preparazione=_prepara_importazione,
+         seq_scan_ammessi=("importazione",)),
+]
+
+# Query di query.QUERY senza un caso: il benchmark non parte finché non ne hanno uno
+def query_senza_caso():
+    coperte = {caso.query_nome for caso in CASI}
+    return sorted(nome for nome in query.QUERY if nome not in coperte)
+
+# Esecuzione
+
+def _percentile(ordinati, p):
+    return round(ordinati[min(len(ordinati) - 1, int(len(ordinati) * p))] * 1000, 3)
+
+# Nodi Seq Scan del piano: (tabella, righe stimate della tabella)
+def seq_scan(piano, righe_tabelle):
+    trovati = []
+    if piano.get("Node Type") == "Seq Scan":
+        tabella = piano.get("Relation Name")
+        trovati.append((tabella, righe_tabelle.get(tabella, 0)))
+    for figlio in piano.get("Plans", ()):
+        trovati.extend(seq_scan(figlio, righe_tabelle))
+    return trovati
+
+# Restituisce (righe, secondi): la preparazione non entra nella durata
+async def _esegui(conn, caso, argomenti, ctx, spiega=False):
+    sql = caso.testo()
+    if spiega:
+        sql = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql
+    if not caso.scrittura:
+        inizio = time.perf_counter()
+        return await conn.fetch(sql, *argomenti), time.perf_counter() - inizio
+    transazione = conn.transaction()
+    await transazione.start()
+    try:
+        if caso.preparazione is not None:
+            await caso.preparazione(conn, ctx)
+        inizio = time.perf_counter()
+        return await conn.fetch(sql, *argomenti), time.perf_counter() - inizio
+    finally:
+        await transazione.rollback()
+
+async def misura_caso(conn, caso, ctx, ripetizioni, budget_ms, righe_tabelle, min_righe_seq_scan):
+    argomenti = caso.argomenti(ctx)
+    # Riscaldamento: statement preparato e pagine in cache, come sul bot a regime
+    for _ in range(2):
+        await _esegui(conn, caso, argomenti, ctx)
+    durate = []
+    for _ in range(ripetizioni):
+        righe, durata = await _esegui(conn, caso, argomenti, ctx)
+        durate.append(durata)
+    durate.sort()
+
+    if caso.piano:
+        piano = json.loads((await _esegui(conn, caso, argomenti, ctx, spiega=True))[0][0][0])[0]
+    else:
+        piano = {"Plan": {}}
+    nodo = piano["Plan"]
+    scansioni = [
+        {"tabella": tabella, "righe_tabella": int(righe)}
+        for tabella, righe in seq_scan(nodo, righe_tabelle)
+        if tabella not in caso.seq_scan_ammessi and righe >= min_righe_seq_scan
+    ]
+    budget = caso.budget_ms or budget_ms
+    risultato = {
+        "caso": caso.nome,
+        "query": caso.query_nome,
+        "righe": len(righe),
+        "p50_ms": _percentile(durate, 0.50),
+        "p95_ms": _percentile(durate, 0.95),
+        "max_ms": round(durate[-1] * 1000, 3),
+        "budget_ms": budget,
+        "esecuzione_ms": piano.get("Execution Time"),
+        "pianificazione_ms": piano.get("Planning Time"),
+        "buffer_hit": nodo.get("Shared Hit Blocks"),
+        "buffer_letti": nodo.get("Shared Read Blocks"),
+        "seq_scan": scansioni,
+        "piano": piano,
+    }
+    errori = []
+    if risultato["p95_ms"] > budget:
+        errori.append(f"p95 {risultato['p95_ms']} ms oltre il budget di {budget} ms")
+    for s in scansioni:
+        errori.append(f"Seq Scan su {s['tabella']} ({s['righe_tabella']} righe)")
+    risultato["errori"] = errori
+    return risultato
+
+async def esegui_dimensione(url, transazioni, args):
+    # Schema vuoto e migrato come al primo avvio del bot
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    finally:
+        await conn.close()
+
+    pool = await asyncpg.create_pool(
+        url, min_size=1, max_size=2, server_settings={"search_path": SCHEMA},
+        statement_cache_size=query.DIMENSIONE_STATEMENT_CACHE,
+    )
+    try:
+        await applica_migrazioni(pool)
+        inizio = time.perf_counter()
+        user_id = await carica_dataset(pool, transazioni, args.utenti, args.asimmetria, args.giorni, args.seme)
+        caricamento = time.perf_counter() - inizio
+        ctx = await contesto(pool, user_id)
+
+        async with pool.acquire() as conn:
+            righe_tabelle = {
+                r["relname"]: r["reltuples"] for r in await conn.fetch(
+                    "SELECT relname, reltuples FROM pg_class WHERE relnamespace = $1::regnamespace AND relkind = 'r'",
+                    SCHEMA,
+                )
+            }
+            righe_utente = await conn.fetchval("SELECT COUNT(*) FROM transazioni WHERE user_id = $1", user_id)
+            risultati = []
+            for caso in CASI:
+                if args.casi and not any(caso.nome.startswith(p) for p in args.casi):
+                    continue
+                risultato = await misura_caso(
+                    conn, caso, ctx, args.ripetizioni, args.budget_ms, righe_tabelle, args.min_righe_seq_scan
+                )
+                stato = "❌" if risultato["errori"] else "✅"
+                print(f"  {stato} {caso.nome:<36} p50 {risultato['p50_ms']:>9.3f} ms  p95 {risultato['p95_ms']:>9.3f} ms"
+                      + ("  " + "; ".join(risultato["errori"]) if risultato["errori"] else ""))
+                risultati.append(risultato)
+    finally:
+        await pool.close()
+
+    return {
+        "transazioni": transazioni,
+        "utenti": args.utenti,
+        "transazioni_utente_misurato": righe_utente,
+        "caricamento_s": round(caricamento, 3),
+        "casi": risultati,
+    }
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Stampa la variazione del p50 di ogni caso rispetto a un'esecuzione precedente
+def confronta(precedente, attuale):
+    vecchi = {
+        (d["transazioni"], c["caso"]): c["p50_ms"]
+        for d in precedente["dimensioni"] for c in d["casi"]
+    }
+    print(f"\nConfronto con {precedente.get('commit') or '?'} del {precedente.get('avviato')}:")
+    for d in attuale["dimensioni"]:
+        for c in d["casi"]:
+            vecchio = vecchi.get((d["transazioni"], c["caso"]))
+            if not vecchio:
+                continue
+            variazione = (c["p50_ms"] - vecchio) / vecchio * 100
+            print(f"  {d['transazioni']:>9} {c['caso']:<36} {vecchio:>9.3f} → {c['p50_ms']:>9.3f} ms ({variazione:+.0f}%)")
+
+def _argomenti(argomenti):
+    parser = argparse.ArgumentParser(description="Benchmark delle query del bot su dati sintetici")
+    parser.add_argument("--url", default=os.getenv("BENCHMARK_DATABASE_URL") or os.getenv("DATABASE_URL"))
+    parser.add_argument("--dimensioni", default="10000,100000,1000000",
+                        help="transazioni totali per ogni esecuzione, separate da virgola")
+    parser.add_argument("--utenti", type=int, default=1000)
+    parser.add_argument("--asimmetria", type=float, default=1.1, help="esponente di Zipf della distribuzione per utente")
+    parser.add_argument("--giorni", type=int, default=3 * 365, help="giorni di storia generati")
+    parser.add_argument("--seme", type=int, default=42)
+    parser.add_argument("--ripetizioni", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=50, help="p95 massimo per caso (salvo budget proprio)")
+    parser.add_argument("--min-righe-seq-scan", type=int, default=10000,
+                        help="un Seq Scan è un errore solo su tabelle con almeno queste righe")
+    parser.add_argument("--casi", nargs="*", help="esegue solo i casi con questi prefissi")
+    parser.add_argument("--output", default=f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_argument("--confronta", help="JSON di un'esecuzione precedente")
+    return parser.parse_args(argomenti)
+
+async def _comando(argomenti):
+    args = _argomenti(argomenti)
+    if not args.url:
+        print("Indica il database con BENCHMARK_DATABASE_URL, DATABASE_URL o --url")
+        return 1
+    mancanti = query_senza_caso()
+    if mancanti:
+        print(f"❌ Query senza un caso in CASI: {', '.join(mancanti)}")
+        return 1
+    conn = await asyncpg.connect(args.url)
+    try:
+        versione = await conn.fetchval("SHOW server_version")
+    finally:
+        await conn.close()
+
+    risultati = {
+        "avviato": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "postgres": versione,
+        "parametri": {k: v for k, v in vars(args).items() if k not in ("url", "output", "confronta")},
+        "dimensioni": [],
+    }
+    for transazioni in (int(d) for d in args.dimensioni.split(",")):
+        print(f"📦 {transazioni} transazioni, {args.utenti} utenti")
+        risultati["dimensioni"].append(await esegui_dimensione(args.url, transazioni, args))
+
+    with open(args.output, "w") as f:
+        json.dump(risultati, f, indent=2, default=str)
+    print(f"\n📝 Risultati in {args.output}")
+
+    if args.confronta:
+        with open(args.confronta) as f:
+            confronta(json.load(f), risultati)
+
+    falliti = sum(1 for d in risultati["dimensioni"] for c in d["casi"] if c["errori"])
+    if falliti:
+        print(f"❌ {falliti} casi oltre il budget o con Seq Scan")
+        return 1
+    print("✅ Tutti i casi entro il budget e senza Seq Scan")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_comando(sys.argv[1:])))
@@ -0,0 +1,96 @@
+import itertools
+import os
+from collections import OrderedDict
+
+# Cache dei grafici già generati, chiave (user_id, tipo di grafico, versione dei dati dell'utente).
+# La versione è un numero mai riusato, assegnato all'utente alla prima richiesta di un grafico;
+# ogni scrittura che cambia i dati dell'utente toglie i suoi grafici e la sua versione, quindi
+# un render partito prima della scrittura non viene salvato come attuale. Le scritture di un
+# utente non toccano la cache degli altri. Le versioni stanno in un LRU di GRAFICI_CACHE_UTENTI
+# utenti: uscire dall'LRU equivale a un'invalidazione.
+# Per ogni voce si tiene il PNG e, dopo il primo invio, il file_id di Telegram:
+# le richieste successive inviano solo il file_id, senza render né upload.
+
+class CacheGrafici:
+    def __init__(self, max_byte, max_utenti):
+        self.max_byte = max_byte
+        self.max_utenti = max_utenti
+        self.voci = OrderedDict()      # chiave -> [png, file_id]
+        self.byte = 0
+        self.versioni = OrderedDict()  # user_id -> versione dei dati, in ordine di uso
+        self.chiavi_utente = {}        # user_id -> chiavi delle sue voci
+        self.contatore = itertools.count(1)
+        self.hit_file_id = 0
+        self.hit_png = 0
+        self.miss = 0
+        self.byte_risparmiati = 0
+
+    def chiave(self, user_id, tipo):
+        versione = self.versioni.get(user_id)
+        if versione is None:
+            versione = self.versioni[user_id] = next(self.contatore)
+            while len(self.versioni) > self.max_utenti:
+                self.invalida(next(iter(self.versioni)))
+        else:
+            self.versioni.move_to_end(user_id)
+        return (user_id, tipo, versione)
+
+    # Da chiamare dopo ogni inserimento, modifica o eliminazione che tocca i dati dell'utente
+    def invalida(self, user_id):
+        for chiave in list(self.chiavi_utente.get(user_id, ())):
+            self._rimuovi(chiave)
+        self.versioni.pop(user_id, None)
+
+    # Restituisce (png, file_id) oppure None
+    def ottieni(self, chiave):
+        voce = self.voci.get(chiave)
+        if voce is None:
+            self.miss += 1
+            return None
+        self.voci.move_to_end(chiave)
+        if voce[1] is not None:
+            # Solo il file_id evita l'upload: con il PNG si risparmia il render, non i byte
+            self.hit_file_id += 1
+            self.byte_risparmiati += len(voce[0])
+        else:
+            self.hit_png += 1
+        return voce[0], voce[1]
+
+    def salva(self, chiave, png, file_id=None):
+        user_id = chiave[0]
+        if chiave[2] != self.versioni.get(user_id):
+            return  # render di dati nel frattempo cambiati
+        if chiave in self.voci:
+            self._rimuovi(chiave)
+        if len(png) > self.max_byte:
+            return
+        self.voci[chiave] = [png, file_id]
+        self.byte += len(png)
+        self.chiavi_utente.setdefault(user_id, set()).add(chiave)
+        while self.byte > self.max_byte:
+            self._rimuovi(next(iter(self.voci)))
+
+    def _rimuovi(self, chiave):
+        png, _ = self.voci.pop(chiave)
+        self.byte -= len(png)
+        user_id = chiave[0]
+        chiavi = self.chiavi_utente[user_id]
+        chiavi.discard(chiave)
+        if not chiavi:
+            del self.chiavi_utente[user_id]
+
+    def statistiche(self):
+        return {
+            "voci": len(self.voci),
+            "utenti": len(self.versioni),
+            "byte": self.byte,
+            "hit_file_id": self.hit_file_id,
+            "hit_png": self.hit_png,
+            "miss": self.miss,
+            "byte_risparmiati": self.byte_risparmiati,
+        }
+
+cache_grafici = CacheGrafici(
+    int(os.getenv("GRAFICI_CACHE_MB", "32")) * 1024 * 1024,
+    int(os.getenv("GRAFICI_CACHE_UTENTI", "10000")),
+)
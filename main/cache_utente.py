@@ -0,0 +1,49 @@
+import os
+from collections import OrderedDict
+
+import query
+
+# Cache in memoria, per utente, degli elenchi di categorie e carte (id, nome ordinati per nome).
+# Cambiano raramente ma servono a ogni /spesa e /entrata: ogni handler che li modifica
+# chiama invalida(user_id) dopo la scrittura, e la lettura successiva li ricarica dal database.
+
+class CacheElenchi:
+    def __init__(self, tabella, max_utenti):
+        self.tabella = tabella
+        self.max_utenti = max_utenti
+        self.voci = OrderedDict()  # user_id -> lista di record (id, nome)
+        # Aumenta a ogni invalidazione: un caricamento iniziato prima non viene salvato
+        self.epoca = 0
+        self.hit = 0
+        self.miss = 0
+
+    async def elenco(self, pool, user_id):
+        voce = self.voci.get(user_id)
+        if voce is not None:
+            self.voci.move_to_end(user_id)
+            self.hit += 1
+            return voce
+
+        self.miss += 1
+        epoca = self.epoca
+        voce = await query.fetch(pool, f"{self.tabella}.by_user", user_id)
+        if epoca == self.epoca:
+            self.voci[user_id] = voce
+            if len(self.voci) > self.max_utenti:
+                self.voci.popitem(last=False)
+        return voce
+
+    # Cerca un elemento dell'utente per id (None se non esiste o appartiene ad altri)
+    async def trova(self, pool, user_id, id_elemento):
+        return next((r for r in await self.elenco(pool, user_id) if r["id"] == id_elemento), None)
+
+    def invalida(self, user_id):
+        self.epoca += 1
+        self.voci.pop(user_id, None)
+
+    def statistiche(self):
+        return {"utenti": len(self.voci), "hit": self.hit, "miss": self.miss}
+
+MAX_UTENTI = int(os.getenv("CACHE_UTENTI_MAX", "10000"))
+cache_categorie = CacheElenchi("categorie", MAX_UTENTI)
+cache_carte = CacheElenchi("carte", MAX_UTENTI)
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from api_finta import ApiFinta
+
+# Test di carico end-to-end: migliaia di utenti virtuali percorrono la conversazione /spesa
+# (/spesa → descrizione → importo → seleziona_categoria → seleziona_carta) contro un'istanza
+# vera del bot, che parla con la Bot API finta (api_finta.py) avviata qui nello stesso processo.
+#
+# 1. python carico.py --utenti 2000 --conversazioni 3      (avvia la Bot API finta e attende il bot)
+# 2. TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_BOT_TOKEN=1:finto python transaction.py
+#    (su un database di prova: gli utenti virtuali creano categorie, carte e transazioni vere)
+#    Il bot invia entro i limiti di Telegram (invii.py): con TELEGRAM_LIMITE_GLOBALE=0 misura
+#    il bot senza limiti, con --limite-globale/--limite-chat la Bot API finta risponde 429
+#    a chi li supera
+#
+# Per ogni passo misura la latenza end-to-end (dall'aggiornamento inviato al bot alla risposta
+# del bot alla Bot API) e conta gli errori: nessuna risposta entro il timeout, oppure una
+# risposta di errore del bot (⚠️/⏳/❌ o un alert sul callback).
+
+PASSI = ("/spesa", "descrizione", "importo", "seleziona_categoria", "seleziona_carta")
+PREFISSI_ERRORE = ("⚠️", "⏳", "❌")
+
+class PassoFallito(Exception):
+    pass
+
+class Statistiche:
+    def __init__(self):
+        self.durate = {}        # passo -> [secondi]
+        self.errori = {}        # passo -> {tipo: numero}
+        self.completate = 0
+        self.fallite = 0
+
+    def ok(self, passo, durata):
+        self.durate.setdefault(passo, []).append(durata)
+
+    def errore(self, passo, tipo):
+        errori = self.errori.setdefault(passo, {})
+        errori[tipo] = errori.get(tipo, 0) + 1
+
+    def riepilogo(self, durata_totale):
+        passi = {}
+        for passo in dict.fromkeys(PASSI + tuple(self.durate) + tuple(self.errori)):
+            durate = sorted(self.durate.get(passo, []))
+            errori = self.errori.get(passo, {})
+            totale = len(durate) + sum(errori.values())
+            if not totale:
+                continue
+            def percentile(p):
+                return round(durate[min(len(durate) - 1, int(len(durate) * p))] * 1000, 1) if durate else None
+            passi[passo] = {
+                "richieste": totale,
+                "errori": errori,
+                "tasso_errori": round(sum(errori.values()) / totale, 4),
+                "p50_ms": percentile(0.50),
+                "p99_ms": percentile(0.99),
+                "max_ms": round(durate[-1] * 1000, 1) if durate else None,
+            }
+        richieste = sum(p["richieste"] for p in passi.values())
+        return {
+            "durata_s": round(durata_totale, 2),
+            "conversazioni_completate": self.completate,
+            "conversazioni_fallite": self.fallite,
+            "conversazioni_al_secondo": round(self.completate / durata_totale, 2),
+            "passi_al_secondo": round(richieste / durata_totale, 2),
+            "passi": passi,
+        }
+
+# Invia un aggiornamento e attende la prima risposta del bot nella chat dell'utente.
+# Restituisce il messaggio del bot (come lo restituisce la Bot API), o solleva PassoFallito.
+async def passo(api, user_id, nome, invio, statistiche, timeout, misura=True):
+    coda = api.risposte(user_id)
+    while not coda.empty():
+        coda.get_nowait()  # risposte arrivate in ritardo a un passo precedente
+    inizio = time.perf_counter()
+    await invio
+    scadenza = inizio + timeout
+    while True:
+        try:
+            istante, metodo, parametri, risultato = await asyncio.wait_for(coda.get(), scadenza - time.perf_counter())
+        except asyncio.TimeoutError:
+            if misura:
+                statistiche.errore(nome, "timeout")
+            raise PassoFallito(nome)
+        if metodo != "answerCallbackQuery":
+            break
+        if parametri.get("text"):
+            # Alert sul callback: il bot ha risposto con un errore (es. database occupato)
+            if misura:
+                statistiche.errore(nome, "alert")
+            raise PassoFallito(nome)
+        # query.answer() senza testo: la risposta vera arriva dopo
+    testo = risultato.get("text") or risultato.get("caption") or ""
+    if testo.startswith(PREFISSI_ERRORE):
+        if misura:
+            statistiche.errore(nome, "risposta di errore")
+        raise PassoFallito(nome)
+    if misura:
+        statistiche.ok(nome, istante - inizio)
+    return risultato
+
+def primo_bottone(messaggio, nome):
+    try:
+        return messaggio["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+    except (KeyError, IndexError, TypeError):
+        raise PassoFallito(f"{nome}: nessun bottone")
+
+async def utente_virtuale(api, user_id, args, statistiche, ritardo):
+    rng = random.Random(user_id)
+    await asyncio.sleep(ritardo)
+
+    async def pensa():
+        if args.pausa_ms:
+            await asyncio.sleep(rng.uniform(0, args.pausa_ms) / 1000)
+
+    # Preparazione, non misurata: almeno una categoria e una carta (se esistono già il bot
+    # risponde con un avviso, va bene lo stesso)
+    for comando, nome in (("/aggiungi_categoria", "Spesa"), ("/aggiungi_carta", "Carta")):
+        for testo in (comando, nome):
+            try:
+                await passo(api, user_id, "preparazione", api.invia_messaggio(user_id, testo), statistiche,
+                            args.timeout, misura=False)
+            except PassoFallito:
+                pass
+
+    for numero in range(args.conversazioni):
+        try:
+            await passo(api, user_id, "/spesa", api.invia_messaggio(user_id, "/spesa"), statistiche, args.timeout)
+            await pensa()
+            await passo(api, user_id, "descrizione", api.invia_messaggio(user_id, f"Caffè {numero}"),
+                        statistiche, args.timeout)
+            await pensa()
+            categorie = await passo(api, user_id, "importo", api.invia_messaggio(user_id, f"{rng.uniform(1, 50):.2f}"),
+                                    statistiche, args.timeout)
+            await pensa()
+            carte = await passo(api, user_id, "seleziona_categoria",
+                                api.invia_callback(user_id, categorie, primo_bottone(categorie, "importo")),
+                                statistiche, args.timeout)
+            await pensa()
+            fatto = await passo(api, user_id, "seleziona_carta",
+                                api.invia_callback(user_id, carte, primo_bottone(carte, "seleziona_categoria")),
+                                statistiche, args.timeout)
+            if not fatto.get("text", "").startswith("✅"):
+                statistiche.errore("seleziona_carta", "risposta inattesa")
+                raise PassoFallito("seleziona_carta")
+            statistiche.completate += 1
+        except PassoFallito:
+            statistiche.fallite += 1
+            # Chiude la conversazione rimasta a metà prima della successiva
+            try:
+                await passo(api, user_id, "/annulla", api.invia_messaggio(user_id, "/annulla"), statistiche,
+                            args.timeout, misura=False)
+            except PassoFallito:
+                pass
+        await pensa()
+
+def stampa(risultati):
+    print(f"\n⏱️  {risultati['durata_s']} s, {risultati['conversazioni_completate']} conversazioni completate "
+          f"({risultati['conversazioni_al_secondo']}/s), {risultati['conversazioni_fallite']} fallite, "
+          f"{risultati['passi_al_secondo']} passi/s, {risultati['risposte_429']} risposte 429")
+    print(f"{'passo':<22}{'richieste':>10}{'errori':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for nome, p in risultati["passi"].items():
+        errori = sum(p["errori"].values())
+        print(f"{nome:<22}{p['richieste']:>10}{errori:>9}{p['p50_ms'] or '-':>10}{p['p99_ms'] or '-':>10}{p['max_ms'] or '-':>10}"
+              + (f"  {p['errori']}" if errori else ""))
+
+def _argomenti(argomenti):
+    parser = argparse.ArgumentParser(description="Test di carico della conversazione /spesa con la Bot API finta")
+    parser.add_argument("--porta", type=int, default=8081)
+    parser.add_argument("--utenti", type=int, default=1000, help="utenti virtuali")
+    parser.add_argument("--conversazioni", type=int, default=3, help="conversazioni /spesa per utente")
+    parser.add_argument("--rampa", type=float, default=10, help="secondi in cui partono tutti gli utenti")
+    parser.add_argument("--pausa-ms", type=float, default=0, help="pausa massima tra un passo e l'altro")
+    parser.add_argument("--latenza-ms", type=float, default=0, help="latenza aggiunta a ogni chiamata al Bot API")
+    parser.add_argument("--limite-globale", type=float, help="chiamate al secondo oltre cui la Bot API finta risponde 429")
+    parser.add_argument("--limite-chat", type=float, help="chiamate al secondo per chat oltre cui risponde 429")
+    parser.add_argument("--timeout", type=float, default=30, help="secondi massimi di attesa di una risposta")
+    parser.add_argument("--primo-utente", type=int, default=900_000_000, help="user_id del primo utente virtuale")
+    parser.add_argument("--output", help="scrive i risultati anche in questo file JSON")
+    return parser.parse_args(argomenti)
+
+async def _comando(argomenti):
+    args = _argomenti(argomenti)
+    api = ApiFinta(latenza=args.latenza_ms / 1000, limite_globale=args.limite_globale, limite_chat=args.limite_chat)
+    await api.avvia(args.porta)
+    try:
+        print("⏳ In attesa del bot (getUpdates o setWebhook)...")
+        await api.collegato.wait()
+        print(f"🚀 {args.utenti} utenti virtuali, {args.conversazioni} conversazioni ciascuno")
+        statistiche = Statistiche()
+        inizio = time.perf_counter()
+        await asyncio.gather(*(
+            utente_virtuale(api, args.primo_utente + i, args, statistiche, args.rampa * i / args.utenti)
+            for i in range(args.utenti)
+        ))
+        risultati = statistiche.riepilogo(time.perf_counter() - inizio)
+        risultati["parametri"] = vars(args)
+        risultati["chiamate_bot_api"] = api.chiamate
+        risultati["errori_consegna_webhook"] = api.errori_consegna
+        risultati["risposte_429"] = api.respinte
+    finally:
+        await api.chiudi()
+
+    stampa(risultati)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(risultati, f, indent=2)
+    return 1 if statistiche.fallite else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_comando(sys.argv[1:])))
@@ -0,0 +1,240 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+import query
+
+# Pool di connessioni condiviso da bot, server HTTP e writer a lotti.
+# Tutti i limiti si configurano da variabili d'ambiente:
+# - DB_POOL_MIN / DB_POOL_MAX: connessioni aperte
+# - DB_COMMAND_TIMEOUT: secondi massimi per query (anche statement_timeout lato server)
+# - DB_ACQUIRE_TIMEOUT: secondi massimi di attesa per una connessione libera
+# - DB_MAX_ATTESA: richieste che possono attendere una connessione; oltre si rifiuta subito
+# - DB_MAX_QUERIES / DB_MAX_IDLE: query e secondi di inattività prima di riaprire una connessione
+# - DB_CONTROLLO_DOPO: secondi di inattività dopo i quali la connessione viene verificata
+#   con un SELECT 1 prima di essere consegnata
+
+class DatabaseOccupato(Exception):
+    """Nessuna connessione disponibile entro i limiti: il chiamante deve chiedere all'utente di riprovare."""
+
+# Campioni di attesa tenuti per i percentili
+CAMPIONI_ATTESA = 1000
+
+class Database:
+    def __init__(self, pool, timeout_acquire, max_attesa, controllo_dopo):
+        self.pool = pool
+        self.timeout_acquire = timeout_acquire
+        self.max_attesa = max_attesa
+        self.controllo_dopo = controllo_dopo
+        self.ultimo_uso = {}  # pid del backend -> istante dell'ultimo rilascio
+        self.in_attesa = 0
+        self.acquisizioni = 0
+        self.rifiutate = 0
+        self.timeout = 0
+        self.controlli_falliti = 0
+        self.attese = deque(maxlen=CAMPIONI_ATTESA)
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._acquisisci()
+        try:
+            yield conn
+        finally:
+            self.ultimo_uso[conn.get_server_pid()] = time.monotonic()
+            await self.pool.release(conn)
+            if len(self.ultimo_uso) > self.pool.get_max_size() * 4:
+                # Connessioni già chiuse dal pool (max_queries, inattività): tiene solo le più recenti
+                recenti = sorted(self.ultimo_uso.items(), key=lambda v: v[1])[-self.pool.get_max_size():]
+                self.ultimo_uso = dict(recenti)
+
+    async def _acquisisci(self):
+        if self.in_attesa >= self.max_attesa:
+            self.rifiutate += 1
+            raise DatabaseOccupato()
+        inizio = time.perf_counter()
+        self.in_attesa += 1
+        try:
+            # Un tentativo in più se la connessione non supera il controllo
+            for _ in range(2):
+                try:
+                    conn = await self.pool.acquire(timeout=self.timeout_acquire)
+                except asyncio.TimeoutError:
+                    self.timeout += 1
+                    raise DatabaseOccupato()
+                if await self._sana(conn):
+                    self.acquisizioni += 1
+                    return conn
+            raise DatabaseOccupato()
+        finally:
+            self.in_attesa -= 1
+            self.attese.append(time.perf_counter() - inizio)
+
+    # Verifica una connessione rimasta inutilizzata a lungo; se non risponde la chiude
+    # (il pool ne aprirà una nuova) e restituisce False
+    async def _sana(self, conn):
+        ultimo = self.ultimo_uso.get(conn.get_server_pid())
+        if ultimo is not None and time.monotonic() - ultimo < self.controllo_dopo:
+            return True
+        try:
+            await conn.fetchval("SELECT 1", timeout=self.timeout_acquire)
+            return True
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+            print(f"⚠️ Connessione al database non valida, la sostituisco: {e}")
+            self.controlli_falliti += 1
+            self.ultimo_uso.pop(conn.get_server_pid(), None)
+            conn.terminate()
+            await self.pool.release(conn)
+            return False
+
+    # Stessa interfaccia di asyncpg.Pool per le query singole (usata da query.py)
+    async def fetch(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def fetchrow(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    async def fetchval(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchval(sql, *args)
+
+    async def execute(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.execute(sql, *args)
+
+    async def close(self):
+        await self.pool.close()
+
+    def statistiche(self):
+        dimensione = self.pool.get_size()
+        in_uso = dimensione - self.pool.get_idle_size()
+        massimo = self.pool.get_max_size()
+        ordinate = sorted(self.attese)
+        def percentile(p):
+            return round(ordinate[min(len(ordinate) - 1, int(len(ordinate) * p))] * 1000, 3) if ordinate else None
+        return {
+            "dimensione": dimensione,
+            "in_uso": in_uso,
+            "massimo": massimo,
+            "utilizzo": round(in_uso / massimo, 3),
+            "in_attesa": self.in_attesa,
+            "acquisizioni": self.acquisizioni,
+            "rifiutate": self.rifiutate,
+            "timeout": self.timeout,
+            "controlli_falliti": self.controlli_falliti,
+            "attesa_p50_ms": percentile(0.50),
+            "attesa_p99_ms": percentile(0.99),
+        }
+
+async def connetti(url=None):
+    massimo = int(os.getenv("DB_POOL_MAX", "10"))
+    timeout_comando = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+    pool = await asyncpg.create_pool(
+        url or os.getenv("DATABASE_URL"),
+        min_size=min(int(os.getenv("DB_POOL_MIN", "2")), massimo),
+        max_size=massimo,
+        command_timeout=timeout_comando,
+        max_queries=int(os.getenv("DB_MAX_QUERIES", "50000")),
+        max_inactive_connection_lifetime=float(os.getenv("DB_MAX_IDLE", "300")),
+        # Le query con nome di query.py restano preparate nella statement cache di ogni connessione
+        statement_cache_size=query.DIMENSIONE_STATEMENT_CACHE,
+        # Il server interrompe comunque le query oltre il timeout, anche se il client se ne va
+        server_settings={"statement_timeout": str(int(timeout_comando * 1000))},
+    )
+    return Database(
+        pool,
+        timeout_acquire=float(os.getenv("DB_ACQUIRE_TIMEOUT", "2")),
+        max_attesa=int(os.getenv("DB_MAX_ATTESA", str(massimo * 4))),
+        controllo_dopo=float(os.getenv("DB_CONTROLLO_DOPO", "30")),
+    )
+
+# Instradamento delle letture di report e metriche (riepiloghi, grafici, /esporta, /metrics)
+# verso una replica opzionale (DATABASE_REPLICA_URL). Le scritture e tutto il resto restano
+# sul primario. Si torna al primario se la replica non risponde o è in ritardo oltre
+# DB_REPLICA_RITARDO_MAX secondi, e per un utente che ha appena scritto (finché la replica
+# potrebbe non avere ancora le sue modifiche), così vede subito i propri dati.
+
+class Letture:
+    def __init__(self, ritardo_max=None, intervallo=None):
+        self.primario = None
+        self.replica = None
+        self.ritardo_max = ritardo_max or float(os.getenv("DB_REPLICA_RITARDO_MAX", "5"))
+        self.intervallo = intervallo or float(os.getenv("DB_REPLICA_CONTROLLO", "2"))
+        # Oltre questo tempo dalla scrittura la replica (in ritardo al massimo di ritardo_max,
+        # misurato al più `intervallo` secondi fa) ha sicuramente i dati dell'utente
+        self.finestra = self.ritardo_max + self.intervallo
+        self.ritardo = None  # ultimo ritardo misurato in secondi, None se la replica non risponde
+        self.ultima_scrittura = {}  # user_id -> istante dell'ultima scrittura
+        self.task = None
+        self.letture_replica = 0
+        self.letture_primario = 0
+
+    def replica_disponibile(self):
+        return self.replica is not None and self.ritardo is not None and self.ritardo <= self.ritardo_max
+
+    # Pool da usare per una lettura di report (dell'utente `user_id`, se indicato)
+    def pool(self, user_id=None):
+        if self.replica_disponibile():
+            scrittura = self.ultima_scrittura.get(user_id)
+            if scrittura is None or time.monotonic() - scrittura >= self.finestra:
+                self.letture_replica += 1
+                return self.replica
+        self.letture_primario += 1
+        return self.primario
+
+    # Da chiamare dopo ogni scrittura che cambia i dati di report dell'utente
+    def scrittura(self, user_id):
+        if self.replica is None:
+            return
+        adesso = time.monotonic()
+        self.ultima_scrittura[user_id] = adesso
+        if len(self.ultima_scrittura) > 10000:
+            self.ultima_scrittura = {u: t for u, t in self.ultima_scrittura.items() if adesso - t < self.finestra}
+
+    async def avvia(self, primario):
+        self.primario = primario
+        url = os.getenv("DATABASE_REPLICA_URL")
+        if not url:
+            return
+        try:
+            self.replica = await connetti(url)
+        except (asyncpg.PostgresError, OSError) as e:
+            print(f"⚠️ Replica non raggiungibile all'avvio, uso solo il primario: {e}")
+            return
+        self.task = asyncio.get_running_loop().create_task(self._controlla())
+        print(f"📚 Letture di report sulla replica (ritardo massimo {self.ritardo_max:.0f} s)")
+
+    async def _controlla(self):
+        while True:
+            try:
+                self.ritardo = float(await query.fetchval(self.replica, "replica.ritardo"))
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError, DatabaseOccupato) as e:
+                if self.ritardo is not None:
+                    print(f"⚠️ Replica non disponibile, letture sul primario: {e}")
+                self.ritardo = None
+            await asyncio.sleep(self.intervallo)
+
+    async def chiudi(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.replica is not None:
+            await self.replica.close()
+            self.replica = None
+
+    def statistiche(self):
+        return {
+            "replica": self.replica is not None,
+            "disponibile": self.replica_disponibile(),
+            "ritardo_s": round(self.ritardo, 3) if self.ritardo is not None else None,
+            "letture_replica": self.letture_replica,
+            "letture_primario": self.letture_primario,
+            "pool_replica": self.replica.statistiche() if self.replica is not None else None,
+        }
+
+letture = Letture()
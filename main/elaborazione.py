@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Elaborazione concorrente degli aggiornamenti con ordine garantito per utente.
+# Aggiornamenti di utenti diversi girano in parallelo fino a `limite`; quelli dello stesso
+# utente passano uno alla volta, nell'ordine di arrivo, da una coda per utente (i
+# ConversationHandler contano sul fatto che i messaggi di un utente arrivino in ordine).
+# La coda di un utente viene eliminata appena si svuota.
+
+# Campioni di attesa in coda tenuti per i percentili
+CAMPIONI_ATTESA = 1000
+
+class CodaUtente:
+    def __init__(self):
+        # asyncio.Lock è FIFO: i task lo acquisiscono nell'ordine in cui arrivano
+        self.turno = asyncio.Lock()
+        self.in_coda = 0
+
+class ProcessoreAggiornamenti(BaseUpdateProcessor):
+    def __init__(self, limite):
+        # Il semaforo della classe base viene preso prima di do_process_update, quando
+        # l'aggiornamento aspetta ancora il turno del suo utente: lo si lascia largo e il
+        # limite vero (`self.posti`) si applica solo agli aggiornamenti che possono partire
+        super().__init__(max(limite * 64, 1024))
+        self.limite = limite
+        self.posti = asyncio.Semaphore(limite)
+        self.code = {}  # chiave utente -> CodaUtente
+        self.in_corso = 0
+        self.in_attesa = 0
+        self.elaborati = 0
+        self.code_rimosse = 0
+        self.attese = deque(maxlen=CAMPIONI_ATTESA)
+
+    @staticmethod
+    def chiave(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        chiave = self.chiave(update)
+        if chiave is None:
+            # Aggiornamenti senza utente né chat: nessun ordine da rispettare
+            await self._esegui(contextlib.nullcontext(), coroutine)
+            return
+
+        coda = self.code.get(chiave)
+        if coda is None:
+            coda = self.code[chiave] = CodaUtente()
+        coda.in_coda += 1
+        try:
+            await self._esegui(coda.turno, coroutine)
+        finally:
+            coda.in_coda -= 1
+            if coda.in_coda == 0:
+                # Coda vuota: l'utente non ha altri aggiornamenti in arrivo
+                del self.code[chiave]
+                self.code_rimosse += 1
+
+    # Attende il turno dell'utente e un posto libero, poi elabora l'aggiornamento
+    async def _esegui(self, turno, coroutine):
+        arrivo = time.perf_counter()
+        self.in_attesa += 1
+        partito = False
+        try:
+            async with turno, self.posti:
+                self.in_attesa -= 1
+                partito = True
+                self.attese.append(time.perf_counter() - arrivo)
+                self.in_corso += 1
+                try:
+                    await coroutine
+                finally:
+                    self.in_corso -= 1
+                    self.elaborati += 1
+        finally:
+            if not partito:
+                self.in_attesa -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def statistiche(self):
+        ordinate = sorted(self.attese)
+        def percentile(p):
+            return round(ordinate[min(len(ordinate) - 1, int(len(ordinate) * p))] * 1000, 3) if ordinate else None
+        return {
+            "limite": self.limite,
+            "in_corso": self.in_corso,
+            "in_attesa": self.in_attesa,
+            "utenti_in_coda": len(self.code),
+            "max_coda_utente": max((c.in_coda for c in self.code.values()), default=0),
+            "elaborati": self.elaborati,
+            "code_rimosse": self.code_rimosse,
+            "attesa_p50_ms": percentile(0.50),
+            "attesa_p99_ms": percentile(0.99),
+        }
+
+# AGGIORNAMENTI_CONCORRENTI=1 (default) lascia l'elaborazione sequenziale di python-telegram-bot
+LIMITE = int(os.getenv("AGGIORNAMENTI_CONCORRENTI", "1"))
+processore = ProcessoreAggiornamenti(LIMITE) if LIMITE > 1 else None
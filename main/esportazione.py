@@ -0,0 +1,130 @@
+import gzip
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import query
+
+# Colonne esportabili: nome accettato da /esporta -> (espressione SQL, intestazione CSV)
+COLONNE_ESPORTAZIONE = {
+    "descrizione": ("t.descrizione", "Descrizione"),
+    "importo": ("t.importo", "Importo"),
+    "data": ("to_char(t.data, 'YYYY-MM-DD HH24:MI')", "Data"),
+    "categoria": ("c.nome", "Categoria"),
+    "carta": ("k.nome", "Carta"),
+}
+COLONNE_DEFAULT = ["descrizione", "importo", "data", "categoria", "carta"]
+
+# Oltre questo numero di righe l'esportazione gira in background e il documento arriva dopo
+SOGLIA_BACKGROUND = int(os.getenv("EXPORT_BACKGROUND_RIGHE", "5000"))
+# Fino a questa dimensione il file compresso resta in memoria, poi passa su disco
+MAX_MEMORIA = 1024 * 1024
+
+USO = (
+    "❌ Formato non valido. Esempi:\n"
+    "• /esporta\n"
+    "• /esporta 2025-01-01 2025-06-30\n"
+    "• /esporta 2025-01-01 2025-06-30 data,importo,categoria\n"
+    f"Colonne disponibili: {', '.join(COLONNE_ESPORTAZIONE)}"
+)
+
+# Interpreta gli argomenti di /esporta: [dal] [al] [colonne separate da virgola]
+# Restituisce (dal, al escluso, colonne); solleva ValueError se non validi.
+def parse_argomenti(argomenti):
+    date = []
+    colonne = COLONNE_DEFAULT
+    for arg in argomenti:
+        if arg[:1].isdigit():
+            date.append(datetime.strptime(arg, "%Y-%m-%d"))
+        else:
+            colonne = [c.strip().lower() for c in arg.split(",") if c.strip()]
+            if not colonne or any(c not in COLONNE_ESPORTAZIONE for c in colonne):
+                raise ValueError(f"colonne non valide: {arg}")
+    if len(date) > 2:
+        raise ValueError("troppe date")
+
+    dal = date[0] if date else None
+    # La data finale è inclusa: il filtro usa il giorno successivo come estremo escluso
+    try:
+        al = date[1] + timedelta(days=1) if len(date) == 2 else None
+    except OverflowError:
+        raise ValueError(f"data finale fuori intervallo: {date[1]:%Y-%m-%d}") from None
+    if dal and al and al <= dal:
+        raise ValueError("la data finale precede quella iniziale")
+    return dal, al, colonne
+
+def _filtro(dal, al):
+    condizioni = ["t.user_id = $1"]
+    parametri = []
+    if dal:
+        parametri.append(dal)
+        condizioni.append(f"t.data >= ${len(parametri) + 1}")
+    if al:
+        parametri.append(al)
+        condizioni.append(f"t.data < ${len(parametri) + 1}")
+    return " AND ".join(condizioni), parametri
+
+async def conta_righe(pool, user_id, dal, al):
+    _, parametri = _filtro(dal, al)
+    nome = f"esportazione.conta{'.dal' if dal else ''}{'.al' if al else ''}"
+    return await query.fetchval(pool, nome, user_id, *parametri)
+
+# Query dell'esportazione ($1 = user_id): restituisce (sql, parametri dopo user_id)
+def sql_esportazione(dal, al, colonne):
+    condizione, parametri = _filtro(dal, al)
+    select = ", ".join(f'{COLONNE_ESPORTAZIONE[c][0]} AS "{COLONNE_ESPORTAZIONE[c][1]}"' for c in colonne)
+    return f"""
+        SELECT {select}
+        FROM transazioni t
+        LEFT JOIN categorie c ON c.id = t.categoria_id
+        LEFT JOIN carte k ON k.id = t.metodoPagamento
+        WHERE {condizione}
+        ORDER BY t.data DESC, t.id DESC
+    """, parametri
+
+# Scrive l'esportazione con COPY ... TO STDOUT direttamente in un file gzip temporaneo.
+# asyncpg passa ogni blocco a write() in un executor, quindi la compressione non blocca il loop.
+# Restituisce il file riavvolto, pronto da inviare; va chiuso dal chiamante.
+async def scrivi_esportazione(pool, user_id, dal, al, colonne):
+    sql, parametri = sql_esportazione(dal, al, colonne)
+
+    file = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORIA)
+    try:
+        with gzip.GzipFile(fileobj=file, mode="wb") as compresso:
+            async with query.misura("esportazione.copy"), pool.acquire() as conn:
+                await conn.copy_from_query(
+                    sql, user_id, *parametri, output=compresso, format="csv", header=True
+                )
+        file.seek(0)
+        return file
+    except BaseException:
+        file.close()
+        raise
+
+def nome_file(dal, al):
+    if dal or al:
+        inizio = dal.strftime("%Y%m%d") if dal else "inizio"
+        fine = (al - timedelta(days=1)).strftime("%Y%m%d") if al else "oggi"
+        return f"transazioni_{inizio}_{fine}.csv.gz"
+    return "transazioni.csv.gz"
+
+# Esportazione completa e invio del documento in una chat
+async def invia_esportazione(bot, chat_id, pool, user_id, dal, al, colonne):
+    file = await scrivi_esportazione(pool, user_id, dal, al, colonne)
+    try:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=file,
+            filename=nome_file(dal, al),
+            caption="📤 Ecco il tuo file CSV (compresso) con le transazioni"
+        )
+    finally:
+        file.close()
+
+# Versione in background per le esportazioni grandi: eventuali errori arrivano all'utente
+async def esportazione_background(bot, chat_id, pool, user_id, dal, al, colonne):
+    try:
+        await invia_esportazione(bot, chat_id, pool, user_id, dal, al, colonne)
+    except Exception as e:
+        print(f"Errore nell'esportazione per l'utente {user_id}: {e}")
+        await bot.send_message(chat_id=chat_id, text="⚠️ Errore durante l'esportazione, riprova più tardi.")
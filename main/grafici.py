@@ -0,0 +1,112 @@
+import asyncio
+import io
+import os
+
+# Servizio di rendering dei grafici: i PNG vengono generati in un pool di processi
+# già avviati (con matplotlib importato), usando l'API a oggetti Figure/Agg invece
+# dello stato globale di pyplot. L'event loop del bot non esegue mai il rendering.
+
+class GraficiOccupati(Exception):
+    """La coda dei render è piena: il chiamante deve chiedere all'utente di riprovare."""
+
+# Eseguita una volta in ogni processo worker
+def _inizializza_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure  # noqa: F401 (import di riscaldamento)
+    # Primo render a vuoto: carica font e cache di matplotlib prima della prima richiesta vera
+    _disegna_torta([1], ["-"], "", None)
+
+def _pronto():
+    return os.getpid()
+
+# Definisci etichette per grafici
+def format_labels(pct, all_vals):
+    absolute = int(round(pct / 100. * sum(all_vals)))
+    return f"{absolute} €\n({pct:.1f}%)"
+
+# Disegna un grafico a torta e restituisce il PNG in bytes (eseguita nel worker)
+def _disegna_torta(valori, etichette, titolo, colori):
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figura = Figure(figsize=(6, 6))
+    FigureCanvasAgg(figura)
+    asse = figura.add_subplot()
+    wedges, texts, autotexts = asse.pie(
+        valori,
+        labels=etichette,
+        autopct=lambda pct: format_labels(pct, valori),
+        startangle=90,
+        colors=colori or matplotlib.colormaps["Paired"].colors
+    )
+    asse.set_title(titolo)
+
+    # Personalizza lo stile delle etichette
+    for text in autotexts:
+        text.set_color("white")
+        text.set_fontsize(10)
+
+    buffer = io.BytesIO()
+    figura.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+class ServizioGrafici:
+    def __init__(self, worker=None, coda=None, timeout=None):
+        self.worker = worker or int(os.getenv("GRAFICI_WORKER", "2"))
+        # Render ammessi contemporaneamente (in esecuzione + in attesa di un worker)
+        self.coda = coda or int(os.getenv("GRAFICI_CODA", "8"))
+        self.timeout = timeout or float(os.getenv("GRAFICI_TIMEOUT", "10"))
+        self.in_corso = 0
+        self.executor = None
+
+    # Avvia i worker. Il riscaldamento (import di matplotlib e primo render) prosegue in
+    # background, così non ritarda l'avvio del bot: i render richiesti nel frattempo
+    # restano in coda nell'executor finché un worker è pronto.
+    def avvia(self):
+        # Importati qui: multiprocessing pesa sull'avvio a freddo (vedi tempi_avvio.py)
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # spawn: i worker non ereditano l'event loop e i thread del processo del bot
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.worker,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_inizializza_worker
+        )
+        loop = asyncio.get_running_loop()
+        self.riscaldamento = asyncio.gather(*[loop.run_in_executor(self.executor, _pronto) for _ in range(self.worker)])
+        self.riscaldamento.add_done_callback(self._riscaldato)
+
+    def _riscaldato(self, futuro):
+        if futuro.cancelled():
+            return
+        if futuro.exception() is not None:
+            print(f"⚠️ Errore nell'avvio dei worker dei grafici: {futuro.exception()}")
+        else:
+            print(f"🎨 Servizio grafici pronto con {self.worker} worker")
+
+    async def chiudi(self):
+        if self.executor is not None:
+            await asyncio.to_thread(self.executor.shutdown, wait=True, cancel_futures=True)
+            self.executor = None
+
+    # Il posto in coda si libera quando il worker ha finito, non quando scade il timeout:
+    # un render lento continua a occupare il worker e va contato finché non termina
+    async def torta(self, valori, etichette, titolo, colori=None):
+        if self.in_corso >= self.coda:
+            raise GraficiOccupati()
+        loop = asyncio.get_running_loop()
+        futuro = self.executor.submit(_disegna_torta, valori, etichette, titolo, colori)
+        self.in_corso += 1
+        futuro.add_done_callback(lambda _: self._terminato(loop))
+        return await asyncio.wait_for(asyncio.wrap_future(futuro), self.timeout)
+
+    # Gira nel thread dell'executor: il contatore si aggiorna nel loop
+    def _terminato(self, loop):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._libera)
+
+    def _libera(self):
+        self.in_corso -= 1
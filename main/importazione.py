@@ -0,0 +1,185 @@
+import csv
+import gzip
+import io
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import query
+import rollup
+from esportazione import COLONNE_ESPORTAZIONE
+
+# Importazione di transazioni da un CSV caricato dall'utente (/importa).
+# Il file viene letto riga per riga in un thread (asyncio.to_thread), poi in un'unica
+# transazione: categorie e carte mancanti create in blocco, tutte le righe caricate con
+# un solo COPY in una tabella temporanea e inserite da lì saltando i duplicati.
+
+CAMPI = ("descrizione", "importo", "data", "categoria", "carta")
+OBBLIGATORI = ("importo", "data")
+# Mappatura predefinita: le intestazioni prodotte da /esporta
+MAPPATURA_DEFAULT = {campo: COLONNE_ESPORTAZIONE[campo][1] for campo in CAMPI}
+
+FORMATI_DATA = ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y")
+
+# Limite del Bot API per il download dei file
+MAX_BYTE = 20 * 1024 * 1024
+MAX_RIGHE = int(os.getenv("IMPORTA_MAX_RIGHE", "50000"))
+# Errori riportati all'utente nel riepilogo
+MAX_ERRORI = 5
+
+USO = (
+    "📥 Inviami un file CSV (anche .csv.gz, come quello di /esporta).\n"
+    "Colonne riconosciute: " + ", ".join(MAPPATURA_DEFAULT.values()) + ".\n"
+    "Per un estratto conto con altre intestazioni indica la mappatura, ad esempio:\n"
+    "/importa data=Data operazione; importo=Importo; descrizione=Causale\n"
+    "Scrivi /annulla per annullare."
+)
+
+# Interpreta "campo=Intestazione; campo=Intestazione" (solleva ValueError se non valida)
+def parse_mappatura(argomenti):
+    mappatura = dict(MAPPATURA_DEFAULT)
+    testo = " ".join(argomenti).strip()
+    if not testo:
+        return mappatura
+    for voce in testo.split(";"):
+        if not voce.strip():
+            continue
+        campo, uguale, intestazione = voce.partition("=")
+        campo = campo.strip().lower()
+        if not uguale or campo not in CAMPI or not intestazione.strip():
+            raise ValueError(f"mappatura non valida: {voce.strip()}")
+        mappatura[campo] = intestazione.strip()
+    return mappatura
+
+# "1.234,56" / "1,234.56" / "1234.56" / "-12,5 €" -> Decimal. L'ultimo tra "." e "," è il
+# separatore dei decimali, l'altro quello delle migliaia; un separatore ripetuto ("1.234.567")
+# è solo delle migliaia. Solleva ValueError (o InvalidOperation) se non è un importo valido.
+def parse_importo(testo):
+    testo = testo.replace("€", "").replace(" ", "").strip()
+    ultimo = max(testo.rfind("."), testo.rfind(","))
+    if ultimo >= 0:
+        separatore = testo[ultimo]
+        if testo.count(separatore) > 1:
+            testo = testo.replace(".", "").replace(",", "")
+        else:
+            testo = testo[:ultimo].replace(".", "").replace(",", "") + "." + testo[ultimo + 1:]
+    importo = Decimal(testo)
+    # "nan", "inf", "Infinity": Decimal li accetta, ma non sono importi
+    if not importo.is_finite():
+        raise ValueError(f"importo non valido: {testo!r}")
+    return importo
+
+def parse_data(testo):
+    testo = testo.strip()
+    for formato in FORMATI_DATA:
+        try:
+            return datetime.strptime(testo, formato)
+        except ValueError:
+            pass
+    raise ValueError(f"data non valida: {testo!r}")
+
+def _apri_testo(percorso):
+    with open(percorso, "rb") as f:
+        compresso = f.read(2) == b"\x1f\x8b"
+    grezzo = gzip.open(percorso, "rb") if compresso else open(percorso, "rb")
+    return io.TextIOWrapper(grezzo, encoding="utf-8-sig", errors="replace", newline="")
+
+# Legge il CSV in streaming (eseguita in un thread). Restituisce (righe valide, errori, scartate):
+# ogni riga è (descrizione, importo, data, categoria, carta); gli errori sono messaggi per l'utente.
+def analizza_file(percorso, mappatura):
+    righe = []
+    errori = []
+    scartate = 0
+    with _apri_testo(percorso) as testo:
+        try:
+            dialetto = csv.Sniffer().sniff(testo.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialetto = csv.excel
+        testo.seek(0)
+        lettore = csv.reader(testo, dialetto)
+
+        intestazione = [c.strip().lower() for c in next(lettore, [])]
+        indici = {}
+        for campo, nome in mappatura.items():
+            if nome.lower() in intestazione:
+                indici[campo] = intestazione.index(nome.lower())
+            elif campo in OBBLIGATORI:
+                raise ValueError(f"colonna '{nome}' non trovata nell'intestazione")
+
+        for numero, valori in enumerate(lettore, start=2):
+            if not any(v.strip() for v in valori):
+                continue
+            if len(righe) >= MAX_RIGHE:
+                raise ValueError(f"il file supera il limite di {MAX_RIGHE} righe")
+            try:
+                campi = {c: (valori[i].strip() if i < len(valori) else "") for c, i in indici.items()}
+                importo = parse_importo(campi["importo"])
+                data = parse_data(campi["data"])
+            except (ValueError, InvalidOperation):
+                scartate += 1
+                if len(errori) < MAX_ERRORI:
+                    errori.append(f"riga {numero}: importo o data non validi")
+                continue
+            righe.append((
+                campi.get("descrizione") or None,
+                importo,
+                data,
+                campi.get("categoria") or None,
+                campi.get("carta") or None,
+            ))
+    return righe, errori, scartate
+
+# Crea le categorie/carte mancanti e restituisce nome -> id per quelle usate nel file
+async def _risolvi_nomi(conn, tabella, user_id, nomi):
+    if not nomi:
+        return {}
+    nomi = sorted(nomi)
+    await query.execute(conn, f"importazione.{tabella}_crea", user_id, nomi)
+    return {r["nome"]: r["id"] for r in await query.fetch(conn, f"importazione.{tabella}_ids", user_id, nomi)}
+
+# Carica le righe in un'unica transazione. Restituisce (importate, duplicate).
+# Una riga è duplicata se l'utente ha già una transazione con stessa descrizione e importo
+# nello stesso minuto (il formato di /esporta): reimportare un'esportazione non crea doppioni.
+# Anche le righe ripetute nello stesso file contano come duplicate: se ne importa una sola.
+async def importa_righe(pool, user_id, righe):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            categorie = await _risolvi_nomi(conn, "categorie", user_id, {r[3] for r in righe if r[3]})
+            carte = await _risolvi_nomi(conn, "carte", user_id, {r[4] for r in righe if r[4]})
+
+            await query.execute(conn, "importazione.tabella")
+            async with query.misura("importazione.copy"):
+                await conn.copy_records_to_table(
+                    "importazione",
+                    records=[(d, i, t, categorie.get(c), carte.get(k)) for d, i, t, c, k in righe],
+                    columns=["descrizione", "importo", "data", "categoria_id", "carta_id"]
+                )
+            inserite = await query.fetch(conn, "importazione.inserisci", user_id)
+            await rollup.registra(conn, inserite)
+    return len(inserite), len(righe) - len(inserite)
+
+# Scarica il documento Telegram in un file temporaneo; va eliminato dal chiamante
+async def scarica_documento(bot, documento):
+    file = await bot.get_file(documento.file_id)
+    descrittore, percorso = tempfile.mkstemp(suffix=".csv")
+    os.close(descrittore)
+    try:
+        await file.download_to_drive(percorso)
+    except BaseException:
+        os.unlink(percorso)
+        raise
+    return percorso
+
+def riepilogo(importate, duplicate, scartate, errori):
+    testo = (
+        f"📥 Importazione completata\n"
+        f"• Importate: {importate}\n"
+        f"• Duplicate (già presenti o ripetute nel file): {duplicate}\n"
+        f"• Scartate: {scartate}"
+    )
+    if errori:
+        testo += "\n\n" + "\n".join(errori)
+        if scartate > len(errori):
+            testo += f"\n… e altre {scartate - len(errori)}"
+    return testo
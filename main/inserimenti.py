@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+from collections import Counter
+
+import query
+import rollup
+
+# Scrittura a lotti delle nuove transazioni (opzionale, INSERIMENTI_BATCH=1).
+# Gli handler mettono la riga in coda e attendono il proprio futuro: il writer la scrive
+# insieme alle altre arrivate nel frattempo con un unico INSERT multi-riga (e un solo
+# aggiornamento del rollup) appena si raggiungono `max_righe` righe o sono passati
+# `attesa` secondi dalla prima. Il futuro si risolve solo dopo il COMMIT del lotto.
+
+class InseritoreTransazioni:
+    def __init__(self, max_righe=None, attesa=None):
+        self.max_righe = max_righe or int(os.getenv("INSERIMENTI_BATCH_RIGHE", "100"))
+        self.attesa = (attesa or float(os.getenv("INSERIMENTI_BATCH_MS", "5"))) / 1000
+        self.attivo = os.getenv("INSERIMENTI_BATCH", "0") == "1"
+        self.pool = None
+        self.coda = None
+        self.task = None
+        # Statistiche
+        self.lotti = 0
+        self.righe = 0
+        self.errori = 0
+        self.ultimo_lotto = 0
+        self.dimensioni = Counter()  # dimensione del lotto -> numero di lotti
+        self.tempo_flush = 0.0
+
+    def avvia(self, pool):
+        self.pool = pool
+        self.coda = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._esegui())
+        print(f"🧺 Inserimenti a lotti attivi (max {self.max_righe} righe, {self.attesa * 1000:.0f} ms)")
+
+    # Scrive le righe ancora in coda e ferma il writer
+    async def chiudi(self):
+        if self.task is None:
+            return
+        await self.coda.put(None)
+        await self.task
+        self.task = None
+
+    # Restituisce la riga inserita (id, user_id, importo, data) quando è durabile
+    async def inserisci(self, user_id, descrizione, importo, categoria_id, carta_id):
+        if self.task is None or self.task.done():
+            raise RuntimeError("inseritore non avviato")
+        futuro = asyncio.get_running_loop().create_future()
+        await self.coda.put(((user_id, descrizione, importo, categoria_id, carta_id), futuro))
+        return await futuro
+
+    async def _esegui(self):
+        fine = False
+        while not fine:
+            voce = await self.coda.get()
+            if voce is None:
+                break
+            lotto = [voce]
+            # Raccoglie le righe che arrivano entro `attesa` dalla prima, fino a max_righe
+            scadenza = time.monotonic() + self.attesa
+            while len(lotto) < self.max_righe:
+                try:
+                    if self.coda.empty():
+                        voce = await asyncio.wait_for(self.coda.get(), scadenza - time.monotonic())
+                    else:
+                        voce = self.coda.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if voce is None:
+                    fine = True
+                    break
+                lotto.append(voce)
+            await self._scrivi(lotto)
+
+        # Chiusura: scrive quello che è rimasto in coda
+        rimaste = []
+        while not self.coda.empty():
+            voce = self.coda.get_nowait()
+            if voce is not None:
+                rimaste.append(voce)
+        for i in range(0, len(rimaste), self.max_righe):
+            await self._scrivi(rimaste[i:i + self.max_righe])
+
+    async def _scrivi(self, lotto):
+        inizio = time.perf_counter()
+        try:
+            try:
+                righe = await self._inserisci_lotto([valori for valori, _ in lotto])
+            except Exception as e:
+                # Una riga non valida (es. categoria eliminata nel frattempo) farebbe fallire
+                # tutto il lotto: si riprova riga per riga così l'errore arriva solo al suo handler
+                print(f"⚠️ Errore nel lotto di {len(lotto)} inserimenti, riprovo singolarmente: {e}")
+                self.errori += 1
+                for valori, futuro in lotto:
+                    try:
+                        riga = (await self._inserisci_lotto([valori]))[0]
+                    except Exception as errore:
+                        if not futuro.done():
+                            futuro.set_exception(errore)
+                    else:
+                        if not futuro.done():
+                            futuro.set_result(riga)
+            else:
+                for (_, futuro), riga in zip(lotto, righe):
+                    if not futuro.done():
+                        futuro.set_result(riga)
+        finally:
+            # Writer annullato a metà (anche durante il primo tentativo): nessun handler
+            # deve restare in attesa per sempre
+            for _, futuro in lotto:
+                if not futuro.done():
+                    futuro.set_exception(RuntimeError("inserimento interrotto"))
+        self.lotti += 1
+        self.righe += len(lotto)
+        self.ultimo_lotto = len(lotto)
+        self.dimensioni[len(lotto)] += 1
+        self.tempo_flush += time.perf_counter() - inizio
+
+    async def _inserisci_lotto(self, valori):
+        colonne = list(zip(*valori))
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                righe = await query.fetch(conn, "transazioni.insert_batch", *colonne)
+                await rollup.registra(conn, righe)
+        # n è la posizione (da 1) della riga in ingresso
+        ordinate = [None] * len(valori)
+        for riga in righe:
+            ordinate[riga["n"] - 1] = riga
+        return ordinate
+
+    def statistiche(self):
+        return {
+            "attivo": self.attivo,
+            "coda": self.coda.qsize() if self.coda is not None else 0,
+            "lotti": self.lotti,
+            "righe": self.righe,
+            "errori": self.errori,
+            "ultimo_lotto": self.ultimo_lotto,
+            "media_lotto": round(self.righe / self.lotti, 2) if self.lotti else None,
+            "max_lotto": max(self.dimensioni) if self.dimensioni else None,
+            "media_flush_ms": round(self.tempo_flush / self.lotti * 1000, 3) if self.lotti else None,
+        }
+
+inseritore = InseritoreTransazioni()
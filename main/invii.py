@@ -0,0 +1,240 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import monitoraggio
+
+# Pianificatore delle chiamate in uscita verso il Bot API (rate limiter di python-telegram-bot).
+# Ogni chiamata aspetta il suo turno prima di partire:
+# - un secchio di gettoni globale (TELEGRAM_LIMITE_GLOBALE chiamate al secondo)
+# - un secchio per chat: TELEGRAM_LIMITE_CHAT al secondo con raffica TELEGRAM_RAFFICA_CHAT nelle
+#   chat private, TELEGRAM_LIMITE_GRUPPO al minuto nei gruppi e nei canali
+# Un solo task distribuisce i gettoni: prima le risposte interattive (callback, messaggi delle
+# conversazioni), poi le altre chiamate, per ultimi gli invii pesanti (grafici, esportazioni).
+# Una chiamata ferma sul limite della propria chat non blocca quelle delle altre chat.
+# Un 429 di Telegram sospende tutte le chiamate per il retry_after indicato; la chiamata
+# respinta riparte per prima, fino a TELEGRAM_MAX_TENTATIVI volte.
+
+INTERATTIVA, NORMALE, MASSIVA = range(3)
+NOMI_PRIORITA = ("interattiva", "normale", "massiva")
+
+# Priorità per metodo; gli altri metodi sono NORMALE. Un handler può scegliere la priorità di
+# una singola chiamata con rate_limit_args=invii.MASSIVA (o INTERATTIVA / NORMALE).
+PRIORITA = {
+    "answerCallbackQuery": INTERATTIVA,
+    "sendMessage": INTERATTIVA,
+    "editMessageText": INTERATTIVA,
+    "editMessageReplyMarkup": INTERATTIVA,
+    "sendChatAction": INTERATTIVA,
+    "sendPhoto": MASSIVA,
+    "sendDocument": MASSIVA,
+}
+
+# Richieste in coda esaminate a ogni giro per trovarne una con la chat libera
+SCANSIONE_MAX = 200
+
+class Secchio:
+    def __init__(self, velocita, capienza):
+        self.velocita = velocita    # gettoni al secondo
+        self.capienza = capienza
+        self.gettoni = capienza
+        self.aggiornato = time.monotonic()
+
+    def _ricarica(self, adesso):
+        self.gettoni = min(self.capienza, self.gettoni + (adesso - self.aggiornato) * self.velocita)
+        self.aggiornato = adesso
+
+    # Secondi da aspettare per avere un gettone (0 se c'è già)
+    def attesa(self, adesso):
+        self._ricarica(adesso)
+        return 0.0 if self.gettoni >= 1 else (1 - self.gettoni) / self.velocita
+
+    def preleva(self):
+        self.gettoni -= 1
+
+    # Nessun gettone fino all'istante `da`
+    def svuota(self, da):
+        self.gettoni = 0
+        self.aggiornato = max(self.aggiornato, da)
+
+    def pieno(self, adesso):
+        self._ricarica(adesso)
+        return self.gettoni >= self.capienza
+
+class Richiesta:
+    __slots__ = ("priorita", "chat", "futuro", "arrivo", "frenata")
+
+    def __init__(self, priorita, chat, futuro):
+        self.priorita = priorita
+        self.chat = chat
+        self.futuro = futuro
+        self.arrivo = time.monotonic()
+        self.frenata = False
+
+class LimitatoreInvii(BaseRateLimiter):
+    def __init__(self, globale, chat, raffica_chat, gruppo, max_tentativi):
+        self.globale = Secchio(globale, globale)
+        self.limite_chat = chat
+        self.raffica_chat = raffica_chat
+        self.limite_gruppo = gruppo         # chiamate al minuto
+        self.max_tentativi = max_tentativi
+        self.secchi = {}                    # chat_id -> Secchio
+        self.code = [deque() for _ in NOMI_PRIORITA]
+        self.nuove = asyncio.Event()
+        self.pausa_fino = 0.0               # istante (monotonic) fino a cui vale l'ultimo retry_after
+        self.task = None
+        self.inviate = 0
+        self.frenate_globale = 0
+        self.frenate_chat = 0
+        self.respinte = 0                   # 429 ricevuti
+
+    async def initialize(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._distribuisci())
+
+    async def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for coda in self.code:
+            while coda:
+                coda.popleft().futuro.cancel()
+
+    def in_coda(self):
+        return sum(len(c) for c in self.code)
+
+    def _secchio(self, chat):
+        secchio = self.secchi.get(chat)
+        if secchio is None:
+            if len(self.secchi) > 10000:
+                # Secchi pieni: le loro chat non inviano da un po', ricrearli non cambia niente
+                adesso = time.monotonic()
+                self.secchi = {c: s for c, s in self.secchi.items() if not s.pieno(adesso)}
+            if isinstance(chat, str) or chat < 0:
+                secchio = Secchio(self.limite_gruppo / 60, self.limite_gruppo)
+            else:
+                secchio = Secchio(self.limite_chat, self.raffica_chat)
+            self.secchi[chat] = secchio
+        return secchio
+
+    # Attende che il distributore dia il turno a questa chiamata
+    async def _turno(self, priorita, chat, davanti=False):
+        richiesta = Richiesta(priorita, chat, asyncio.get_running_loop().create_future())
+        if davanti:
+            self.code[priorita].appendleft(richiesta)
+        else:
+            self.code[priorita].append(richiesta)
+        self.nuove.set()
+        await richiesta.futuro
+        monitoraggio.INVII_ATTESA.osserva(time.monotonic() - richiesta.arrivo, NOMI_PRIORITA[priorita])
+
+    # Prima richiesta, in ordine di priorità, la cui chat ha un gettone.
+    # Restituisce (richiesta o None, secondi dopo cui riprovare se nessuna è pronta).
+    def _scegli(self, adesso):
+        attesa_minima = None
+        for coda in self.code:
+            for i, richiesta in enumerate(coda):
+                if i >= SCANSIONE_MAX:
+                    break
+                if richiesta.futuro.done():
+                    continue  # annullata da chi la aspettava, la toglie il prossimo giro
+                if richiesta.chat is None:
+                    del coda[i]
+                    return richiesta, None
+                secchio = self._secchio(richiesta.chat)
+                attesa = secchio.attesa(adesso)
+                if attesa == 0:
+                    secchio.preleva()
+                    del coda[i]
+                    return richiesta, None
+                if not richiesta.frenata:
+                    richiesta.frenata = True
+                    self.frenate_chat += 1
+                    monitoraggio.INVII_FRENATI.incrementa("chat")
+                attesa_minima = attesa if attesa_minima is None else min(attesa_minima, attesa)
+            # Toglie le richieste annullate in testa alla coda
+            while coda and coda[0].futuro.done():
+                coda.popleft()
+        return None, attesa_minima
+
+    async def _distribuisci(self):
+        while True:
+            self.nuove.clear()
+            if not any(self.code):
+                await self.nuove.wait()
+                continue
+            adesso = time.monotonic()
+            if self.pausa_fino > adesso:
+                await asyncio.sleep(self.pausa_fino - adesso)
+                continue
+            attesa = self.globale.attesa(adesso)
+            if attesa > 0:
+                self.frenate_globale += 1
+                monitoraggio.INVII_FRENATI.incrementa("globale")
+                await asyncio.sleep(attesa)
+                continue
+            richiesta, attesa = self._scegli(adesso)
+            if richiesta is None:
+                # Tutte le chat in coda sono al limite: si riprova quando si libera la prima
+                # o quando arriva una richiesta nuova (magari di un'altra chat)
+                try:
+                    await asyncio.wait_for(self.nuove.wait(), attesa)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.globale.preleva()
+            self.inviate += 1
+            richiesta.futuro.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priorita = rate_limit_args if rate_limit_args in (INTERATTIVA, NORMALE, MASSIVA) else PRIORITA.get(endpoint, NORMALE)
+        chat = data.get("chat_id")
+        if chat is not None:
+            try:
+                chat = int(chat)
+            except (TypeError, ValueError):
+                pass  # @nome di un canale: limiti da gruppo
+
+        for tentativo in range(self.max_tentativi + 1):
+            await self._turno(priorita, chat, davanti=tentativo > 0)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.respinte += 1
+                monitoraggio.INVII_FRENATI.incrementa("retry_after")
+                if tentativo == self.max_tentativi:
+                    raise
+                attesa = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                # Tutte le chiamate si fermano: un'altra partita subito prenderebbe un altro 429.
+                # Alla ripresa niente raffica: il secchio globale riparte vuoto
+                adesso = time.monotonic()
+                if self.pausa_fino <= adesso:
+                    print(f"⚠️ Bot API: 429 su {endpoint}, invii sospesi per {attesa:.1f} s")
+                self.pausa_fino = max(self.pausa_fino, adesso + attesa + 0.1)
+                self.globale.svuota(self.pausa_fino)
+
+    def statistiche(self):
+        return {
+            "in_coda": {nome: len(coda) for nome, coda in zip(NOMI_PRIORITA, self.code)},
+            "inviate": self.inviate,
+            "frenate_globale": self.frenate_globale,
+            "frenate_chat": self.frenate_chat,
+            "respinte_429": self.respinte,
+            "pausa_residua_s": round(max(0.0, self.pausa_fino - time.monotonic()), 3),
+            "chat_tracciate": len(self.secchi),
+        }
+
+# TELEGRAM_LIMITE_GLOBALE=0 lascia le chiamate senza limiti (comportamento di python-telegram-bot)
+LIMITE_GLOBALE = float(os.getenv("TELEGRAM_LIMITE_GLOBALE", "30"))
+limitatore = LimitatoreInvii(
+    globale=LIMITE_GLOBALE,
+    chat=float(os.getenv("TELEGRAM_LIMITE_CHAT", "1")),
+    raffica_chat=float(os.getenv("TELEGRAM_RAFFICA_CHAT", "3")),
+    gruppo=float(os.getenv("TELEGRAM_LIMITE_GRUPPO", "20")),
+    max_tentativi=int(os.getenv("TELEGRAM_MAX_TENTATIVI", "3")),
+) if LIMITE_GLOBALE > 0 else None
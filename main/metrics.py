@@ -1,85 +1,88 @@
+import asyncio
 import datetime
+import json
+import os
+import time
 from aiohttp import web
+from cache_grafici import cache_grafici
+from cache_utente import cache_categorie, cache_carte
+from inserimenti import inseritore
+from elaborazione import processore
+from invii import limitatore
+from persistenza import persistenza
+import monitoraggio
+import query
+from database import DatabaseOccupato, letture
+from query import RISOLUZIONI
 
 # Tempo di attivita del server
 SERVER_UPTIME = datetime.datetime.now()
 
+# Passo di ogni risoluzione accettata da ?resolution= (le espressioni SQL sono in query.py)
+PASSI = {
+    "minute": datetime.timedelta(minutes=1),
+    "5m": datetime.timedelta(minutes=5),
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+}
+UNITA_FINESTRA = {"m": "minutes", "h": "hours", "d": "days"}
+
+FINESTRA_DEFAULT = datetime.timedelta(days=2)
+RISOLUZIONE_DEFAULT = "minute"
+# Numero massimo di punti per serie (finestra / risoluzione)
+MAX_PUNTI = 10000
+
+# Converte "30m", "6h", "2d" in timedelta
+def parse_finestra(testo):
+    testo = testo.strip().lower()
+    if len(testo) < 2 or testo[-1] not in UNITA_FINESTRA or not testo[:-1].isdigit():
+        raise ValueError(f"finestra non valida: {testo!r} (usa ad esempio 30m, 6h, 2d)")
+    try:
+        finestra = datetime.timedelta(**{UNITA_FINESTRA[testo[-1]]: int(testo[:-1])})
+    except OverflowError:
+        raise ValueError(f"finestra troppo ampia: {testo!r}")
+    if finestra <= datetime.timedelta(0):
+        raise ValueError("la finestra deve essere positiva")
+    return finestra
+
+def formatta_finestra(finestra):
+    secondi = int(finestra.total_seconds())
+    for suffisso, durata in (("d", 86400), ("h", 3600), ("m", 60)):
+        if secondi % durata == 0:
+            return f"{secondi // durata}{suffisso}"
+    return f"{secondi}s"
+
+# Costruisce in una sola passata la serie cumulativa di entrate/uscite.
+# Le righe arrivano ordinate per periodo, una per periodo.
+def serie_cumulativa(righe):
+    totale_entrate = 0
+    totale_uscite = 0
+    for r in righe:
+        totale_entrate += r["entrate"]
+        totale_uscite += r["uscite"]
+        yield {
+            "timestamp": r["periodo"].isoformat(),
+            "entrate": totale_entrate,
+            "uscite": totale_uscite
+        }
+
 # Funzione per calcolare le metriche
-async def calcola_metriche(pool):
+async def calcola_metriche(pool, finestra=FINESTRA_DEFAULT, risoluzione=RISOLUZIONE_DEFAULT):
+    # Tutte le query leggono solo le tabelle di rollup (vedi rollup.py):
+    # il costo dipende dalla finestra richiesta e non dalla dimensione di transazioni.
+
     # Numero di transazioni di oggi (entrate e uscite)
-    transazioni_oggi = await pool.fetch("""
-        SELECT 
-            CASE WHEN importo < 0 THEN 'uscite' ELSE 'entrate' END AS tipo,
-            COUNT(*) AS conteggio
-        FROM transazioni
-        WHERE DATE(data) = CURRENT_DATE
-        GROUP BY tipo
-    """)
+    transazioni_oggi = await query.fetch(pool, "metrics.oggi")
     #Utenti attivi oggi
-    utenti_attivi_oggi = await pool.fetchval("""
-        SELECT COUNT(DISTINCT user_id) 
-        FROM transazioni 
-        WHERE DATE(data) = CURRENT_DATE
-    """)
-    # Percentuale di crescita degli utenti 
-    crescita_utenti = await pool.fetchval("""
-        WITH utenti_corrente AS (
-    SELECT COUNT(DISTINCT user_id) AS totale
-    FROM transazioni
-    WHERE DATE_PART('month', data) = DATE_PART('month', CURRENT_DATE)
-    ),
-    utenti_precedente AS (
-        SELECT COUNT(DISTINCT user_id) AS totale
-        FROM transazioni
-        WHERE DATE_PART('month', data) = DATE_PART('month', CURRENT_DATE) - 1
-    )
-    SELECT 
-        (utenti_corrente.totale - utenti_precedente.totale) * 100.0 / NULLIF(utenti_precedente.totale, 0) AS crescita_percentuale
-    FROM utenti_corrente, utenti_precedente
-                                          """)
-
-    # Transazioni per minuto negli ultimi 2 giorni
-    transazioni_per_minuto = await pool.fetch("""
-        SELECT 
-            DATE_TRUNC('minute', data) AS minuto,
-            CASE WHEN importo < 0 THEN 'uscite' ELSE 'entrate' END AS tipo,
-            COUNT(*) AS conteggio
-        FROM transazioni
-        WHERE data >= CURRENT_DATE - INTERVAL '2 days'
-        GROUP BY minuto, tipo
-        ORDER BY minuto
-    """)
-
-   # Prepara i dati per il JSON con totali cumulativi
-    transazioni_minuto = []
-    totale_entrate = 0
-    totale_uscite = 0
+    utenti_attivi_oggi = await query.fetchval(pool, "metrics.utenti_attivi_oggi")
+    # Percentuale di crescita degli utenti (mese corrente rispetto al precedente)
+    crescita_utenti = await query.fetchval(pool, "metrics.crescita")
 
-    for t in transazioni_per_minuto:
-        minuto = t["minuto"].isoformat()
-        tipo = t["tipo"]
-        conteggio = t["conteggio"]
-
-        # Aggiorna i totali cumulativi
-        if tipo == "entrate":
-            totale_entrate += conteggio
-        elif tipo == "uscite":
-            totale_uscite += conteggio
-
-        # Cerca se il minuto esiste già nella lista
-        existing_entry = next((entry for entry in transazioni_minuto if entry["timestamp"] == minuto), None)
-        if existing_entry:
-            existing_entry["entrate"] = totale_entrate
-            existing_entry["uscite"] = totale_uscite
-        else:
-            transazioni_minuto.append({
-                "timestamp": minuto,
-                "entrate": totale_entrate,
-                "uscite": totale_uscite
-            })
+    # Transazioni per periodo nella finestra richiesta, raggruppate in SQL alla risoluzione scelta
+    transazioni_per_periodo = await query.fetch(pool, f"metrics.per_periodo.{risoluzione}", finestra)
 
     # Numero totale di utenti
-    utenti_totali = await pool.fetchval("SELECT COUNT(DISTINCT user_id) FROM transazioni")
+    utenti_totali = await query.fetchval(pool, "metrics.utenti_totali")
 
     # Data e ora attuale
     ora_attuale = datetime.datetime.now().isoformat()
@@ -90,15 +93,117 @@ async def calcola_metriche(pool):
         "uptime": str(datetime.datetime.now() - SERVER_UPTIME),
         "transazioni_oggi": {t["tipo"]: t["conteggio"] for t in transazioni_oggi},
         "utenti_attivi_oggi": utenti_attivi_oggi,
-        "transazioni_per_minuto": transazioni_minuto,
+        "finestra": formatta_finestra(finestra),
+        "risoluzione": risoluzione,
+        "transazioni_per_minuto": list(serie_cumulativa(transazioni_per_periodo)),
         "utenti_totali": utenti_totali,
-        "crescita_utenti(%)": crescita_utenti,
+        "crescita_utenti(%)": float(crescita_utenti) if crescita_utenti is not None else None,
     }
 
     return metriche
 
+# Statistiche operative dei componenti del bot: restano fuori da /metrics (che espone solo
+# le metriche di business) e sono servite da /metrics/query e /metrics/prometheus
+def statistiche_operative():
+    return {
+        "cache_grafici": cache_grafici.statistiche(),
+        "cache_categorie": cache_categorie.statistiche(),
+        "cache_carte": cache_carte.statistiche(),
+        "inserimenti_batch": inseritore.statistiche(),
+        "aggiornamenti": processore.statistiche() if processore is not None else None,
+        "invii": limitatore.statistiche() if limitatore is not None else None,
+        "pool": letture.primario.statistiche() if letture.primario is not None else None,
+        "letture": letture.statistiche(),
+        "persistenza": persistenza.statistiche(),
+    }
+
+monitoraggio.STATO_COMPONENTI.imposta(statistiche_operative)
+
+# Cache delle risposte di /metrics: serve il JSON già serializzato per METRICS_CACHE_TTL secondi.
+# Le richieste che arrivano durante un ricalcolo attendono quello in corso (single-flight),
+# quindi un picco di richieste non diventa mai un picco di query sul database.
+class CacheMetriche:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.voci = {}      # chiave -> (istante di calcolo, corpo JSON in bytes)
+        self.in_corso = {}  # chiave -> task del ricalcolo in corso
+        self.hit = 0
+        self.miss = 0
+        self.attese = 0     # richieste accodate a un ricalcolo già in corso
+
+    # Restituisce (corpo, età in secondi, esito) con esito in HIT / MISS / COALESCED
+    async def ottieni(self, chiave, calcola):
+        voce = self.voci.get(chiave)
+        if voce is not None and time.monotonic() - voce[0] < self.ttl:
+            self.hit += 1
+            return voce[1], time.monotonic() - voce[0], "HIT"
+
+        task = self.in_corso.get(chiave)
+        if task is None:
+            self.miss += 1
+            esito = "MISS"
+            task = asyncio.ensure_future(self._ricalcola(chiave, calcola))
+            self.in_corso[chiave] = task
+        else:
+            self.attese += 1
+            esito = "COALESCED"
+
+        # shield: se il client si disconnette il ricalcolo continua per gli altri in attesa
+        istante, corpo = await asyncio.shield(task)
+        return corpo, time.monotonic() - istante, esito
+
+    async def _ricalcola(self, chiave, calcola):
+        try:
+            corpo = json.dumps(await calcola()).encode()
+            istante = time.monotonic()
+            # Scarta le voci scadute per non accumulare combinazioni di parametri
+            self.voci = {k: v for k, v in self.voci.items() if istante - v[0] < self.ttl}
+            self.voci[chiave] = (istante, corpo)
+            return istante, corpo
+        finally:
+            del self.in_corso[chiave]
+
+cache_metriche = CacheMetriche(float(os.getenv("METRICS_CACHE_TTL", "5")))
+
+# Endpoint con le statistiche per query (chiamate, errori, percentili di latenza)
+# e quelle dei componenti (cache, pool, coda degli aggiornamenti, invii, persistenza)
+async def handle_query_stats(request):
+    return web.json_response({"query": query.dump_statistiche(), **statistiche_operative()})
+
+# Metriche operative in formato Prometheus (vedi monitoraggio.py); la versione del formato
+# di esposizione sta nel Content-Type
+async def handle_prometheus(request):
+    return web.Response(text=monitoraggio.esporta(), content_type="text/plain; version=0.0.4", charset="utf-8")
+
 # Endpoint per le metriche
 async def handle_metrics(request):
-    pool = request.app["db_pool"]
-    metriche = await calcola_metriche(pool)
-    return web.json_response(metriche)
\ No newline at end of file
+    # Le metriche leggono solo il rollup: vanno sulla replica, se disponibile
+    pool = letture.pool()
+    try:
+        finestra = parse_finestra(request.query.get("window", "2d"))
+        risoluzione = request.query.get("resolution", RISOLUZIONE_DEFAULT)
+        if risoluzione not in RISOLUZIONI:
+            raise ValueError(f"risoluzione non valida: {risoluzione!r} (usa {', '.join(RISOLUZIONI)})")
+        if finestra / PASSI[risoluzione] > MAX_PUNTI:
+            raise ValueError(f"troppi punti: riduci la finestra o usa una risoluzione più ampia (max {MAX_PUNTI})")
+    except ValueError as e:
+        return web.json_response({"errore": str(e)}, status=400)
+
+    try:
+        corpo, eta, esito = await cache_metriche.ottieni(
+            (finestra, risoluzione),
+            lambda: calcola_metriche(pool, finestra, risoluzione)
+        )
+    except DatabaseOccupato:
+        return web.json_response({"errore": "database occupato, riprova tra poco"}, status=503, headers={"Retry-After": "1"})
+    return web.Response(
+        body=corpo,
+        content_type="application/json",
+        headers={
+            "X-Cache": esito,
+            "X-Cache-Age": f"{eta:.3f}",
+            "X-Cache-Hits": str(cache_metriche.hit),
+            "X-Cache-Misses": str(cache_metriche.miss),
+            "X-Cache-Coalesced": str(cache_metriche.attese),
+        }
+    )
\ No newline at end of file
@@ -0,0 +1,206 @@
+import asyncpg
+
+# Migrazioni dello schema, in ordine. Ogni migrazione è (versione, descrizione, passi):
+# un passo è una stringa SQL oppure una funzione async che riceve la connessione e il timeout
+# (da passare a ogni sua query: il command_timeout del pool non basta per i backfill).
+# Le migrazioni sono idempotenti e già applicate non vanno mai modificate: per cambiare
+# lo schema si aggiunge una nuova versione in fondo alla lista.
+MIGRAZIONI = [
+    (1, "tabelle di base", [
+        """
+        CREATE TABLE IF NOT EXISTS carte (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            nome TEXT NOT NULL,
+            UNIQUE(user_id, nome)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS categorie (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            nome TEXT NOT NULL,
+            UNIQUE(user_id, nome)  -- Ogni utente può avere categorie uniche
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transazioni (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            descrizione TEXT,
+            importo NUMERIC,
+            data TIMESTAMP DEFAULT NOW(),
+            categoria_id INTEGER,
+            metodoPagamento INTEGER,
+            FOREIGN KEY (metodoPagamento) REFERENCES carte(id) ON DELETE SET NULL,
+            FOREIGN KEY (categoria_id) REFERENCES categorie(id) ON DELETE SET NULL
+        )
+        """,
+    ]),
+    (2, "rollup per /metrics", [
+        """
+        CREATE TABLE IF NOT EXISTS transazioni_rollup_minuto (
+            minuto TIMESTAMP NOT NULL,
+            tipo TEXT NOT NULL,
+            conteggio INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (minuto, tipo)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transazioni_rollup_utente_giorno (
+            giorno DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            conteggio INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (giorno, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transazioni_rollup_utente (
+            user_id BIGINT PRIMARY KEY,
+            conteggio INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # Backfill dalle transazioni esistenti. SQL copiato qui e non chiamato da rollup.py:
+        # una migrazione già applicata non deve cambiare se cambia il codice del bot
+        "LOCK TABLE transazioni IN SHARE MODE",
+        "TRUNCATE transazioni_rollup_minuto, transazioni_rollup_utente_giorno, transazioni_rollup_utente",
+        """
+        INSERT INTO transazioni_rollup_minuto (minuto, tipo, conteggio)
+        SELECT
+            DATE_TRUNC('minute', data),
+            CASE WHEN importo < 0 THEN 'uscite' ELSE 'entrate' END,
+            COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL
+        GROUP BY 1, 2
+        """,
+        """
+        INSERT INTO transazioni_rollup_utente_giorno (giorno, user_id, conteggio)
+        SELECT data::date, user_id, COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY 1, 2
+        """,
+        """
+        INSERT INTO transazioni_rollup_utente (user_id, conteggio)
+        SELECT user_id, COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY 1
+        """,
+    ]),
+    (3, "indici per le query per utente", [
+        # Elenchi per utente ordinati per data (riepilogo, gestisci, esporta, grafici)
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_data ON transazioni (user_id, data DESC)",
+        # Riepilogo per categoria
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_categoria_data ON transazioni (user_id, categoria_id, data)",
+        # Riepiloghi e grafici di sole spese / sole entrate
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_uscite ON transazioni (user_id, data DESC) WHERE importo < 0",
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_entrate ON transazioni (user_id, data DESC) WHERE importo > 0",
+        "ANALYZE transazioni",
+    ]),
+    (4, "indici per la paginazione keyset (data, id)", [
+        # id come ultima colonna: il confronto (data, id) < ($2, $3) resta tutto sull'indice
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_data_id ON transazioni (user_id, data DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_categoria_data_id ON transazioni (user_id, categoria_id, data DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_uscite_id ON transazioni (user_id, data DESC, id DESC) WHERE importo < 0",
+        "CREATE INDEX IF NOT EXISTS idx_transazioni_user_entrate_id ON transazioni (user_id, data DESC, id DESC) WHERE importo > 0",
+        # Sostituiti dai precedenti, che ne coprono gli stessi prefissi
+        "DROP INDEX IF EXISTS idx_transazioni_user_data",
+        "DROP INDEX IF EXISTS idx_transazioni_user_categoria_data",
+        "DROP INDEX IF EXISTS idx_transazioni_user_uscite",
+        "DROP INDEX IF EXISTS idx_transazioni_user_entrate",
+    ]),
+    (5, "stato delle conversazioni e user_data", [
+        # Una riga per utente (vedi persistenza.py); gli utenti senza stato non hanno righe
+        """
+        CREATE TABLE IF NOT EXISTS stato_utenti (
+            user_id BIGINT PRIMARY KEY,
+            user_data JSONB NOT NULL DEFAULT '{}',
+            conversazioni JSONB NOT NULL DEFAULT '{}',
+            aggiornato TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (6, "saldi mensili per utente e categoria", [
+        # Vedi saldi.py; categoria_id = 0 per le transazioni senza categoria
+        """
+        CREATE TABLE IF NOT EXISTS saldi_mensili (
+            user_id BIGINT NOT NULL,
+            categoria_id INTEGER NOT NULL,
+            mese DATE NOT NULL,
+            entrate NUMERIC NOT NULL DEFAULT 0,
+            uscite NUMERIC NOT NULL DEFAULT 0,
+            conteggio_entrate INTEGER NOT NULL DEFAULT 0,
+            conteggio_uscite INTEGER NOT NULL DEFAULT 0,
+            conteggio INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, categoria_id, mese)
+        )
+        """,
+        # Backfill dalle transazioni esistenti, congelato qui come quello della migrazione 2
+        "LOCK TABLE transazioni IN SHARE MODE",
+        "TRUNCATE saldi_mensili",
+        """
+        INSERT INTO saldi_mensili (
+            user_id, categoria_id, mese, entrate, uscite, conteggio_entrate, conteggio_uscite, conteggio
+        )
+        SELECT
+            user_id,
+            COALESCE(categoria_id, 0),
+            DATE_TRUNC('month', data)::date,
+            COALESCE(SUM(importo) FILTER (WHERE importo > 0), 0),
+            COALESCE(SUM(importo) FILTER (WHERE importo < 0), 0),
+            COUNT(*) FILTER (WHERE importo > 0),
+            COUNT(*) FILTER (WHERE importo < 0),
+            COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL AND user_id IS NOT NULL AND importo IS NOT NULL
+        GROUP BY 1, 2, 3
+        """,
+    ]),
+]
+
+# Chiave dell'advisory lock che serializza le migrazioni tra più istanze
+LOCK_MIGRAZIONI = 7310251
+# Secondi concessi a ogni passo: indici e backfill su tabelle grandi superano il timeout del pool
+TIMEOUT_PASSO = 3600
+
+async def versione_corrente(conn):
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(versione), 0) FROM schema_versione")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+# Porta lo schema all'ultima versione. Con lo schema già aggiornato costa un solo round trip.
+async def applica_migrazioni(pool):
+    ultima = MIGRAZIONI[-1][0]
+    async with pool.acquire() as conn:
+        if await versione_corrente(conn) >= ultima:
+            return
+
+        async with conn.transaction():
+            await conn.execute("SET LOCAL statement_timeout = 0")
+            # Un'altra istanza può tenere il lock per tutta la durata delle sue migrazioni
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", LOCK_MIGRAZIONI, timeout=TIMEOUT_PASSO)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_versione (
+                    versione INTEGER PRIMARY KEY,
+                    descrizione TEXT,
+                    applicata_il TIMESTAMP DEFAULT NOW()
+                )
+            """)
+            # Riletta sotto lock: un'altra istanza potrebbe averle appena applicate
+            versione = await versione_corrente(conn)
+            for numero, descrizione, passi in MIGRAZIONI:
+                if numero <= versione:
+                    continue
+                print(f"🛠️ Migrazione {numero}: {descrizione}")
+                for passo in passi:
+                    if callable(passo):
+                        await passo(conn, timeout=TIMEOUT_PASSO)
+                    else:
+                        await conn.execute(passo, timeout=TIMEOUT_PASSO)
+                await conn.execute(
+                    "INSERT INTO schema_versione (versione, descrizione) VALUES ($1, $2)",
+                    numero, descrizione
+                )
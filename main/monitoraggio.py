@@ -0,0 +1,211 @@
+import asyncio
+import functools
+import time
+
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+# Metriche operative del bot in formato testo Prometheus (/metrics/prometheus):
+# latenza ed errori degli handler, delle query al database e delle chiamate al Bot API,
+# profondità della coda degli aggiornamenti e ritardo dell'event loop.
+# Contatori in memoria senza lock (tutto gira sull'event loop): osservare un valore costa
+# un perf_counter e qualche accesso a dizionario.
+
+BUCKET_DEFAULT = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+metriche = []
+
+def _etichette(nomi, valori):
+    if not nomi:
+        return ""
+    coppie = []
+    for nome, valore in zip(nomi, valori):
+        valore = str(valore).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        coppie.append(f'{nome}="{valore}"')
+    return "{" + ",".join(coppie) + "}"
+
+class Istogramma:
+    def __init__(self, nome, aiuto, etichette=(), bucket=BUCKET_DEFAULT):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        self.bucket = bucket
+        self.serie = {}  # valori delle etichette -> [conteggi per bucket, somma, totale]
+        metriche.append(self)
+
+    def osserva(self, valore, *etichette):
+        serie = self.serie.get(etichette)
+        if serie is None:
+            serie = self.serie[etichette] = [[0] * len(self.bucket), 0.0, 0]
+        for i, limite in enumerate(self.bucket):
+            if valore <= limite:
+                serie[0][i] += 1
+                break
+        serie[1] += valore
+        serie[2] += 1
+
+    def esporta(self):
+        righe = [f"# HELP {self.nome} {self.aiuto}", f"# TYPE {self.nome} histogram"]
+        for valori, (conteggi, somma, totale) in sorted(self.serie.items()):
+            cumulato = 0
+            for limite, conteggio in zip(self.bucket, conteggi):
+                cumulato += conteggio
+                etichette = _etichette(self.etichette + ("le",), valori + (limite,))
+                righe.append(f"{self.nome}_bucket{etichette} {cumulato}")
+            etichette = _etichette(self.etichette + ("le",), valori + ("+Inf",))
+            righe.append(f"{self.nome}_bucket{etichette} {totale}")
+            righe.append(f"{self.nome}_sum{_etichette(self.etichette, valori)} {somma}")
+            righe.append(f"{self.nome}_count{_etichette(self.etichette, valori)} {totale}")
+        return righe
+
+class Contatore:
+    def __init__(self, nome, aiuto, etichette=()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        self.serie = {}
+        metriche.append(self)
+
+    def incrementa(self, *etichette, valore=1):
+        self.serie[etichette] = self.serie.get(etichette, 0) + valore
+
+    def esporta(self):
+        righe = [f"# HELP {self.nome} {self.aiuto}", f"# TYPE {self.nome} counter"]
+        for valori, totale in sorted(self.serie.items()):
+            righe.append(f"{self.nome}{_etichette(self.etichette, valori)} {totale}")
+        return righe
+
+# Valore letto al momento dell'esposizione da una funzione (None = non disponibile)
+class Misura:
+    def __init__(self, nome, aiuto):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.lettura = None
+        metriche.append(self)
+
+    def imposta(self, lettura):
+        self.lettura = lettura
+
+    def esporta(self):
+        valore = self.lettura() if self.lettura is not None else None
+        if valore is None:
+            return []
+        return [f"# HELP {self.nome} {self.aiuto}", f"# TYPE {self.nome} gauge", f"{self.nome} {valore}"]
+
+# Statistiche dei componenti (cache, pool, coda, invii...) lette da una funzione che restituisce
+# {sezione: {voce: valore}}: una serie per ogni valore numerico, anche annidato (voce "a_b")
+class Stato:
+    def __init__(self, nome, aiuto):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.lettura = None
+        metriche.append(self)
+
+    def imposta(self, lettura):
+        self.lettura = lettura
+
+    def _valori(self, prefisso, dati):
+        for chiave, valore in dati.items():
+            voce = f"{prefisso}_{chiave}" if prefisso else str(chiave)
+            if isinstance(valore, dict):
+                yield from self._valori(voce, valore)
+            elif isinstance(valore, (int, float)):
+                yield voce, int(valore) if isinstance(valore, bool) else valore
+
+    def esporta(self):
+        if self.lettura is None:
+            return []
+        righe = [f"# HELP {self.nome} {self.aiuto}", f"# TYPE {self.nome} gauge"]
+        for sezione, dati in self.lettura().items():
+            if isinstance(dati, dict):
+                for voce, valore in self._valori("", dati):
+                    righe.append(f"{self.nome}{_etichette(('sezione', 'voce'), (sezione, voce))} {valore}")
+        return righe
+
+HANDLER_DURATA = Istogramma("bot_handler_duration_seconds", "Durata degli handler", ("handler",))
+HANDLER_ERRORI = Contatore("bot_handler_errors_total", "Eccezioni sollevate dagli handler", ("handler",))
+DB_DURATA = Istogramma("bot_db_query_duration_seconds", "Durata delle query per nome (query.py)", ("query",))
+DB_ERRORI = Contatore("bot_db_query_errors_total", "Query fallite per nome", ("query",))
+API_DURATA = Istogramma("bot_telegram_api_duration_seconds", "Durata delle chiamate al Bot API", ("method",))
+API_ERRORI = Contatore("bot_telegram_api_errors_total", "Chiamate al Bot API fallite", ("method", "code"))
+CODA_AGGIORNAMENTI = Misura("bot_update_queue_depth", "Aggiornamenti ricevuti e non ancora presi in carico")
+AGGIORNAMENTI_IN_ATTESA = Misura("bot_updates_waiting", "Aggiornamenti in attesa del turno del proprio utente")
+INVII_ATTESA = Istogramma("bot_outbound_wait_seconds", "Attesa delle chiamate al Bot API prima dell'invio (invii.py)", ("priorita",))
+INVII_FRENATI = Contatore("bot_outbound_throttled_total", "Chiamate al Bot API frenate dai limiti", ("motivo",))
+INVII_IN_CODA = Misura("bot_outbound_queue_depth", "Chiamate al Bot API in attesa del turno")
+STATO_COMPONENTI = Stato("bot_component_stat", "Statistiche dei componenti, come in /metrics/query")
+LOOP_RITARDO = Istogramma(
+    "bot_event_loop_lag_seconds", "Ritardo dell'event loop rispetto a un timer periodico",
+    bucket=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+def osserva_query(nome, durata, errore):
+    DB_DURATA.osserva(durata, nome)
+    if errore:
+        DB_ERRORI.incrementa(nome)
+
+def esporta():
+    righe = []
+    for metrica in metriche:
+        righe.extend(metrica.esporta())
+    return "\n".join(righe) + "\n"
+
+# Handler
+
+def misura_handler(callback, nome=None):
+    nome = nome or callback.__name__
+
+    @functools.wraps(callback)
+    async def misurato(update, context):
+        inizio = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORI.incrementa(nome)
+            raise
+        finally:
+            HANDLER_DURATA.osserva(time.perf_counter() - inizio, nome)
+
+    return misurato
+
+# Avvolge le callback di tutti gli handler registrati (anche dentro i ConversationHandler).
+# Va chiamata una volta, dopo aver aggiunto tutti gli handler.
+def misura_handlers(app):
+    def avvolgi(handler):
+        if isinstance(handler, ConversationHandler):
+            for interno in handler.entry_points + handler.fallbacks:
+                avvolgi(interno)
+            for gestori in handler.states.values():
+                for interno in gestori:
+                    avvolgi(interno)
+        elif getattr(handler, "callback", None) is not None and not hasattr(handler.callback, "__wrapped__"):
+            handler.callback = misura_handler(handler.callback)
+
+    for gruppo in app.handlers.values():
+        for handler in gruppo:
+            avvolgi(handler)
+
+# Bot API: HTTPXRequest che misura ogni chiamata, con il nome del metodo come etichetta
+
+class RichiestaMisurata(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        metodo = url.rsplit("/", 1)[-1]
+        inizio = time.perf_counter()
+        try:
+            codice, corpo = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            API_ERRORI.incrementa(metodo, type(e).__name__)
+            raise
+        finally:
+            API_DURATA.osserva(time.perf_counter() - inizio, metodo)
+        if codice >= 400:
+            API_ERRORI.incrementa(metodo, str(codice))
+        return codice, corpo
+
+# Event loop: un timer ogni `intervallo` secondi, il ritardo è quanto arriva in ritardo
+
+async def controlla_loop(intervallo=0.5):
+    while True:
+        atteso = time.perf_counter() + intervallo
+        await asyncio.sleep(intervallo)
+        LOOP_RITARDO.osserva(max(0.0, time.perf_counter() - atteso))
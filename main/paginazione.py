@@ -0,0 +1,111 @@
+from datetime import date, datetime, time, timedelta
+
+import query
+
+# Paginazione keyset sulle transazioni di un utente, ordinate per (data, id) decrescenti.
+# Il cursore è la coppia (data, id) di una riga al bordo della pagina e viaggia
+# nella callback_data dei bottoni ◀/▶ (max 64 byte), codificato in esadecimale.
+
+EPOCA = datetime(1970, 1, 1)
+AVANTI = "a"    # ▶ verso le transazioni più vecchie
+INDIETRO = "i"  # ◀ verso le transazioni più recenti
+
+# Finestra del riepilogo: [dal, al) a giorni interi, così resta la stessa tra un click e
+# l'altro e nella callback_data bastano i due giorni (dall'EPOCA, in esadecimale)
+GIORNI_DEFAULT = 30
+MAX_GIORNI = 36500
+USO_RIEPILOGO = (
+    "❌ Formato non valido. Esempi:\n"
+    f"• /riepilogo (ultimi {GIORNI_DEFAULT} giorni)\n"
+    "• /riepilogo 90\n"
+    "• /riepilogo 2025-01-01 2025-06-30"
+)
+
+def ultimi_giorni(giorni, oggi=None):
+    al = datetime.combine((oggi or date.today()) + timedelta(days=1), time())
+    return al - timedelta(days=giorni), al
+
+# Interpreta gli argomenti di /riepilogo: [giorni] oppure dal [al] (date incluse).
+# Restituisce (dal, al escluso); solleva ValueError se non validi.
+def parse_finestra(argomenti, oggi=None):
+    if not argomenti:
+        return ultimi_giorni(GIORNI_DEFAULT, oggi)
+    if len(argomenti) == 1 and argomenti[0].isdigit():
+        giorni = int(argomenti[0])
+        if not 1 <= giorni <= MAX_GIORNI:
+            raise ValueError(f"giorni fuori intervallo: {giorni}")
+        return ultimi_giorni(giorni, oggi)
+    if len(argomenti) > 2:
+        raise ValueError("troppi argomenti")
+    dal = datetime.strptime(argomenti[0], "%Y-%m-%d")
+    if len(argomenti) == 2:
+        try:
+            al = datetime.strptime(argomenti[1], "%Y-%m-%d") + timedelta(days=1)
+        except OverflowError:
+            raise ValueError(f"data finale fuori intervallo: {argomenti[1]}") from None
+    else:
+        al = ultimi_giorni(1, oggi)[1]
+    if al <= dal:
+        raise ValueError("la data finale precede quella iniziale")
+    return dal, al
+
+def codifica_finestra(finestra):
+    dal, al = finestra
+    return f"{(dal - EPOCA).days:x}.{(al - EPOCA).days:x}"
+
+def decodifica_finestra(testo):
+    dal, al = testo.split(".")
+    return EPOCA + timedelta(days=int(dal, 16)), EPOCA + timedelta(days=int(al, 16))
+
+def descrivi_finestra(finestra):
+    dal, al = finestra
+    return f"dal {dal:%d/%m/%Y} al {al - timedelta(days=1):%d/%m/%Y}"
+
+def codifica_cursore(riga):
+    micro = (riga["data"] - EPOCA) // timedelta(microseconds=1)
+    return f"{micro:x}.{riga['id']:x}"
+
+def decodifica_cursore(testo):
+    micro, id_transazione = testo.split(".")
+    return EPOCA + timedelta(microseconds=int(micro, 16)), int(id_transazione, 16)
+
+# Legge una pagina di transazioni. `variante` sceglie il filtro dichiarato in query.py
+# (g tutte, s spese, e entrate, c per categoria con l'id in `parametri`).
+# Restituisce (righe in ordine decrescente, ci sono righe più recenti, ci sono righe più vecchie).
+async def pagina_transazioni(pool, user_id, dimensione, variante="g", parametri=(), cursore=None, direzione=AVANTI):
+    argomenti = [user_id, *parametri]
+    nome = f"transazioni.pagina.{variante}"
+    if cursore is not None:
+        nome = f"{nome}.{direzione}"
+        argomenti.extend(decodifica_cursore(cursore))
+
+    # Una riga in più per sapere se esiste una pagina successiva nella direzione richiesta
+    righe = await query.fetch(pool, nome, *argomenti, dimensione + 1)
+    return _dividi(righe, dimensione, cursore, direzione)
+
+# Come pagina_transazioni, limitata a `finestra` (dal, al) e con il numero e la somma degli
+# importi di tutta la finestra calcolati dalla stessa query.
+# Restituisce (righe, più recenti, più vecchie, conteggio, totale).
+async def pagina_riepilogo(pool, user_id, dimensione, variante, parametri, finestra, cursore=None, direzione=AVANTI):
+    argomenti = [user_id, *parametri, *finestra]
+    nome = f"riepilogo.pagina.{variante}"
+    if cursore is not None:
+        nome = f"{nome}.{direzione}"
+        argomenti.extend(decodifica_cursore(cursore))
+
+    righe = await query.fetch(pool, nome, *argomenti, dimensione + 1)
+    # C'è sempre almeno una riga, con i totali; senza transazioni le sue colonne sono NULL
+    conteggio, totale = righe[0]["conteggio"], righe[0]["totale"]
+    righe = [r for r in righe if r["id"] is not None]
+    return (*_dividi(righe, dimensione, cursore, direzione), conteggio, totale)
+
+def _dividi(righe, dimensione, cursore, direzione):
+    altre = len(righe) > dimensione
+    righe = righe[:dimensione]
+
+    if cursore is None:
+        return righe, False, altre
+    if direzione == AVANTI:
+        return righe, True, altre
+    righe.reverse()
+    return righe, altre, True
@@ -0,0 +1,229 @@
+import asyncio
+import copy
+import json
+import os
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import query
+
+# Persistenza su Postgres dello stato delle conversazioni e di context.user_data, così un
+# riavvio non interrompe chi è a metà di /spesa. Una riga JSONB per utente in stato_utenti:
+# - user_data: il dizionario context.user_data
+# - conversazioni: {nome del ConversationHandler: {"chat_id:user_id": stato}}
+# Le conversazioni in corso sono lette all'avvio, una query per ConversationHandler
+# (get_conversations, l'interfaccia pubblica di python-telegram-bot); lo user_data di un utente
+# al suo primo aggiornamento (refresh_user_data, che l'Application chiama prima di qualsiasi
+# handler grazie al TypeHandler del gruppo -1). Le modifiche arrivano ogni
+# PERSISTENZA_INTERVALLO secondi e vengono scritte insieme, con una sola query, solo per gli
+# utenti il cui stato è cambiato davvero. Gli utenti inattivi da PERSISTENZA_INATTIVI secondi
+# e non a metà di una conversazione escono dalla memoria, sia da qui sia da Application.user_data:
+# al prossimo aggiornamento si rileggono dal database.
+
+def _chiave_testo(chiave):
+    return ":".join(str(k) for k in chiave)
+
+def _chiave_tupla(testo):
+    return tuple(int(k) for k in testo.split(":"))
+
+def _json(valore):
+    return json.dumps(valore, separators=(",", ":"), sort_keys=True)
+
+class PersistenzaPostgres(BasePersistence):
+    def __init__(self, intervallo=None, inattivi=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=intervallo or float(os.getenv("PERSISTENZA_INTERVALLO", "2")),
+        )
+        self.inattivi = inattivi or float(os.getenv("PERSISTENZA_INATTIVI", "3600"))
+        self.pool = None
+        self.app = None
+        self.caricati = set()       # utenti già letti dal database
+        self.ultimo_uso = {}        # user_id -> istante (monotonic) dell'ultimo aggiornamento
+        self.ultima_pulizia = time.monotonic()
+        self.user_data = {}         # user_id -> ultimo user_data ricevuto
+        self.conversazioni = {}     # user_id -> {nome: {chiave testo: stato}}
+        self.scritti = {}           # user_id -> JSON dell'ultimo stato scritto
+        self.sporchi = set()
+        self.espulsi = set()        # utenti tolti da Application.user_data, vedi drop_user_data
+        self.scrittura = None
+        self.righe_scritte = 0
+        self.scritture = 0
+
+    # Da chiamare prima di app.initialize(), che legge le conversazioni
+    def collega(self, pool, app):
+        self.pool = pool
+        self.app = app
+
+    # user_data con caricamento pigro: all'avvio non si legge niente
+    async def get_user_data(self):
+        return {}
+
+    async def get_conversations(self, name):
+        righe = await query.fetch(self.pool, "stato.conversazioni", name)
+        return {
+            _chiave_tupla(chiave): stato
+            for riga in righe
+            for chiave, stato in json.loads(riga["stati"]).items()
+        }
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def refresh_user_data(self, user_id, user_data):
+        adesso = time.monotonic()
+        self.ultimo_uso[user_id] = adesso
+        self._pulisci(adesso)
+        if user_id in self.caricati:
+            return
+        riga = await query.fetchrow(self.pool, "stato.by_user", user_id)
+        self.caricati.add(user_id)
+        if riga is None:
+            return
+        salvati = json.loads(riga["user_data"])
+        user_data.update(salvati)
+        self.user_data.setdefault(user_id, user_data)
+        # I ConversationHandler hanno già gli stati letti all'avvio: qui servono solo per
+        # riscrivere la riga completa al prossimo cambiamento
+        conversazioni = self.conversazioni.setdefault(user_id, json.loads(riga["conversazioni"]))
+        self.scritti[user_id] = _json([salvati, conversazioni])
+
+    # Toglie dalla memoria gli utenti inattivi già scritti, al massimo una volta al minuto.
+    # Non durante una scrittura: i suoi utenti non sono più tra gli sporchi ma non ancora in scritti.
+    # Chi è a metà di una conversazione resta: i ConversationHandler tengono comunque il suo stato.
+    def _pulisci(self, adesso):
+        if adesso - self.ultima_pulizia < 60 or (self.scrittura is not None and not self.scrittura.done()):
+            return
+        self.ultima_pulizia = adesso
+        limite = adesso - self.inattivi
+        for user_id in [
+            u for u, t in self.ultimo_uso.items()
+            if t < limite and u not in self.sporchi and not self.conversazioni.get(u)
+        ]:
+            del self.ultimo_uso[user_id]
+            if self.app is not None:
+                self.espulsi.add(user_id)
+                self.app.drop_user_data(user_id)
+            self.caricati.discard(user_id)
+            self.user_data.pop(user_id, None)
+            self.conversazioni.pop(user_id, None)
+            self.scritti.pop(user_id, None)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        self.user_data[user_id] = data
+        self._segna(user_id)
+
+    async def drop_user_data(self, user_id):
+        if user_id in self.espulsi:
+            # Eco di _pulisci: la riga nel database resta. Se l'utente è tornato nel frattempo
+            # l'Application ha saltato il suo update_user_data, quindi lo si riprende da lì.
+            self.espulsi.discard(user_id)
+            if user_id in self.caricati:
+                self.user_data[user_id] = copy.deepcopy(self.app.user_data.get(user_id, {}))
+                self._segna(user_id)
+            return
+        self.user_data[user_id] = {}
+        self._segna(user_id)
+
+    # Le chiavi sono (chat_id, user_id): tutti i ConversationHandler del bot sono per chat e per utente
+    async def update_conversation(self, name, key, new_state):
+        user_id = key[-1]
+        stati = self.conversazioni.setdefault(user_id, {}).setdefault(name, {})
+        if new_state is None:
+            stati.pop(_chiave_testo(key), None)
+            if not stati:
+                del self.conversazioni[user_id][name]
+        else:
+            stati[_chiave_testo(key)] = new_state
+        self._segna(user_id)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    # L'Application chiama gli update_* tutti insieme: la scrittura parte dopo, una per il gruppo
+    def _segna(self, user_id):
+        self.sporchi.add(user_id)
+        if self.scrittura is None or self.scrittura.done():
+            self.scrittura = asyncio.get_running_loop().create_task(self._scrivi())
+
+    async def _scrivi(self):
+        await asyncio.sleep(0)
+        # Gli utenti segnati durante una scrittura vengono scritti nel giro successivo
+        while self.sporchi:
+            if not await self._scrivi_sporchi():
+                return
+
+    # Restituisce False se la scrittura è fallita (gli utenti restano da scrivere)
+    async def _scrivi_sporchi(self):
+        sporchi, self.sporchi = self.sporchi, set()
+        salva = []
+        elimina = []
+        for user_id in sporchi:
+            user_data = self.user_data.get(user_id, {})
+            conversazioni = self.conversazioni.get(user_id, {})
+            stato = _json([user_data, conversazioni])
+            if stato == self.scritti.get(user_id, _json([{}, {}])):
+                continue  # nessun cambiamento reale
+            if not user_data and not conversazioni:
+                elimina.append((user_id, stato))
+            else:
+                salva.append((user_id, stato, user_data, conversazioni))
+        if not salva and not elimina:
+            return True
+        try:
+            if salva:
+                await query.execute(
+                    self.pool, "stato.salva",
+                    [s[0] for s in salva], [_json(s[2]) for s in salva], [_json(s[3]) for s in salva]
+                )
+            if elimina:
+                await query.execute(self.pool, "stato.elimina", [e[0] for e in elimina])
+        except Exception as e:
+            print(f"⚠️ Errore nel salvataggio dello stato di {len(salva) + len(elimina)} utenti: {e}")
+            self.sporchi |= sporchi
+            return False
+        for user_id, stato, *_ in salva + elimina:
+            self.scritti[user_id] = stato
+        self.scritture += 1
+        self.righe_scritte += len(salva) + len(elimina)
+        return True
+
+    # Chiamata dall'Application allo spegnimento, dopo l'ultimo giro di update_*
+    async def flush(self):
+        if self.scrittura is not None:
+            await self.scrittura
+        if self.sporchi:
+            await self._scrivi_sporchi()
+
+    def statistiche(self):
+        return {
+            "utenti_caricati": len(self.caricati),
+            "utenti_in_memoria": len(self.ultimo_uso),
+            "in_attesa": len(self.sporchi),
+            "scritture": self.scritture,
+            "righe_scritte": self.righe_scritte,
+        }
+
+persistenza = PersistenzaPostgres()
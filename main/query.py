@@ -0,0 +1,393 @@
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import monitoraggio
+
+# Repository delle query: ogni query usata dagli handler è dichiarata una sola volta qui,
+# con un nome. Le funzioni fetch/fetchrow/fetchval/execute la eseguono su un pool o su una
+# connessione e ne misurano chiamate, errori e latenza.
+# asyncpg prepara ogni testo SQL sulla connessione al primo uso e lo tiene nella sua
+# statement cache: la dimensione della cache del pool si regola su len(QUERY).
+
+# Filtri delle varianti di elenco/totale delle transazioni di un utente ($1 = user_id)
+FILTRI_TRANSAZIONI = {
+    "g": "",                          # tutte
+    "s": "AND importo < 0",           # spese
+    "e": "AND importo > 0",           # entrate
+    "c": "AND categoria_id = $2",     # per categoria
+}
+# Numero di parametri usati dal filtro (user_id compreso)
+PARAMETRI_FILTRO = {"g": 1, "s": 1, "e": 1, "c": 2}
+
+# Risoluzioni di /metrics -> espressione SQL sul bucket del rollup
+RISOLUZIONI = {
+    "minute": "minuto",
+    "5m": "DATE_TRUNC('hour', minuto) + FLOOR(DATE_PART('minute', minuto) / 5) * INTERVAL '5 minutes'",
+    "hour": "DATE_TRUNC('hour', minuto)",
+    "day": "DATE_TRUNC('day', minuto)",
+}
+
+QUERY = {
+    # Transazioni
+    "transazioni.insert": """
+        INSERT INTO transazioni (user_id, descrizione, importo, categoria_id, metodoPagamento) VALUES ($1, $2, $3, $4, $5)
+        RETURNING id, user_id, importo, data, categoria_id
+    """,
+    # Inserimento a lotti (vedi inserimenti.py): gli id seguono l'ordine delle righe in ingresso
+    # Gli id sono presi dalla sequenza prima dell'INSERT: RETURNING non vede la posizione n
+    # della riga in ingresso, il join sull'id la riporta accanto alla riga inserita
+    "transazioni.insert_batch": """
+        WITH r AS (
+            SELECT nextval(pg_get_serial_sequence('transazioni', 'id')) AS id, v.*
+            FROM unnest($1::bigint[], $2::text[], $3::numeric[], $4::int[], $5::int[])
+                WITH ORDINALITY AS v(user_id, descrizione, importo, categoria_id, carta_id, n)
+        ), inserite AS (
+            INSERT INTO transazioni (id, user_id, descrizione, importo, categoria_id, metodoPagamento)
+            SELECT id, user_id, descrizione, importo, categoria_id, carta_id FROM r
+            RETURNING id, user_id, importo, data, categoria_id
+        )
+        SELECT r.n, i.* FROM inserite i JOIN r USING (id) ORDER BY r.n
+    """,
+    "transazioni.lock_by_id": "SELECT user_id, importo, data, categoria_id FROM transazioni WHERE id = $1 AND user_id = $2 FOR UPDATE",
+    "transazioni.update": """
+        UPDATE transazioni SET descrizione = COALESCE($1, descrizione), importo = $2 WHERE id = $3
+        RETURNING user_id, descrizione, importo, data, categoria_id
+    """,
+    "transazioni.delete": "DELETE FROM transazioni WHERE id = $1 AND user_id = $2 RETURNING user_id, importo, data, categoria_id",
+    "transazioni.by_id": "SELECT id, descrizione, importo FROM transazioni WHERE id = $1 AND user_id = $2",
+
+    # Grafici, dai saldi mensili (vedi saldi.py): righe per mese, non per transazione
+    "grafici.generale": """
+        SELECT COALESCE(SUM(entrate), 0) AS entrate, COALESCE(SUM(uscite), 0) AS uscite
+        FROM saldi_mensili WHERE user_id = $1
+    """,
+    "grafici.spese_per_categoria": """
+        SELECT c.nome AS categoria, SUM(s.uscite) AS totale
+        FROM saldi_mensili s
+        LEFT JOIN categorie c ON s.categoria_id = c.id
+        WHERE s.user_id = $1 AND s.conteggio_uscite > 0
+        GROUP BY c.nome
+        ORDER BY totale
+    """,
+    "grafici.entrate_per_categoria": """
+        SELECT c.nome AS categoria, SUM(s.entrate) AS totale
+        FROM saldi_mensili s
+        LEFT JOIN categorie c ON s.categoria_id = c.id
+        WHERE s.user_id = $1 AND s.conteggio_entrate > 0
+        GROUP BY c.nome
+        ORDER BY totale
+    """,
+
+    # Categorie e carte
+    "categorie.by_user": "SELECT id, nome FROM categorie WHERE user_id = $1 ORDER BY nome",
+    "categorie.insert": "INSERT INTO categorie (user_id, nome) VALUES ($1, $2)",
+    "categorie.update_nome": "UPDATE categorie SET nome = $1 WHERE id = $2 AND user_id = $3",
+    "categorie.delete_by_id": "DELETE FROM categorie WHERE id = $1 AND user_id = $2 RETURNING id",
+    "categorie.delete_by_nome": "DELETE FROM categorie WHERE user_id = $1 AND nome = $2 RETURNING id",
+    "carte.by_user": "SELECT id, nome FROM carte WHERE user_id = $1 ORDER BY nome",
+    "carte.insert": "INSERT INTO carte (user_id, nome) VALUES ($1, $2)",
+
+    # Importazione da CSV (vedi importazione.py)
+    "importazione.categorie_crea": """
+        INSERT INTO categorie (user_id, nome) SELECT $1, unnest($2::text[])
+        ON CONFLICT (user_id, nome) DO NOTHING
+    """,
+    "importazione.categorie_ids": "SELECT id, nome FROM categorie WHERE user_id = $1 AND nome = ANY($2::text[])",
+    "importazione.carte_crea": """
+        INSERT INTO carte (user_id, nome) SELECT $1, unnest($2::text[])
+        ON CONFLICT (user_id, nome) DO NOTHING
+    """,
+    "importazione.carte_ids": "SELECT id, nome FROM carte WHERE user_id = $1 AND nome = ANY($2::text[])",
+    "importazione.tabella": """
+        CREATE TEMP TABLE importazione (
+            descrizione TEXT, importo NUMERIC, data TIMESTAMP, categoria_id INTEGER, carta_id INTEGER
+        ) ON COMMIT DROP
+    """,
+    "importazione.inserisci": """
+        INSERT INTO transazioni (user_id, descrizione, importo, data, categoria_id, metodoPagamento)
+        SELECT $1, i.descrizione, i.importo, i.data, i.categoria_id, i.carta_id
+        FROM (
+            -- Righe ripetute nel file: una sola per descrizione, importo e minuto
+            SELECT DISTINCT ON (descrizione, importo, DATE_TRUNC('minute', data)) *
+            FROM importazione
+        ) i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM transazioni t
+            WHERE t.user_id = $1 AND t.data >= i.data AND t.data < i.data + INTERVAL '1 minute'
+              AND t.importo = i.importo AND t.descrizione IS NOT DISTINCT FROM i.descrizione
+        )
+        RETURNING user_id, importo, data, categoria_id
+    """,
+
+    # Saldi mensili per utente e categoria (vedi saldi.py)
+    "saldi.aggiorna": """
+        INSERT INTO saldi_mensili AS s
+            (user_id, categoria_id, mese, entrate, uscite, conteggio_entrate, conteggio_uscite, conteggio)
+        SELECT * FROM unnest(
+            $1::bigint[], $2::int[], $3::date[], $4::numeric[], $5::numeric[], $6::int[], $7::int[], $8::int[]
+        )
+        ON CONFLICT (user_id, categoria_id, mese) DO UPDATE SET
+            entrate = s.entrate + EXCLUDED.entrate,
+            uscite = s.uscite + EXCLUDED.uscite,
+            conteggio_entrate = s.conteggio_entrate + EXCLUDED.conteggio_entrate,
+            conteggio_uscite = s.conteggio_uscite + EXCLUDED.conteggio_uscite,
+            conteggio = s.conteggio + EXCLUDED.conteggio
+    """,
+    "saldi.pulizia": """
+        DELETE FROM saldi_mensili
+        WHERE conteggio <= 0
+          AND (user_id, categoria_id, mese) IN (SELECT * FROM unnest($1::bigint[], $2::int[], $3::date[]))
+    """,
+    "saldi.sposta_categoria": """
+        WITH spostati AS (
+            DELETE FROM saldi_mensili WHERE user_id = $1 AND categoria_id = $2
+            RETURNING user_id, mese, entrate, uscite, conteggio_entrate, conteggio_uscite, conteggio
+        )
+        INSERT INTO saldi_mensili AS s
+            (user_id, categoria_id, mese, entrate, uscite, conteggio_entrate, conteggio_uscite, conteggio)
+        SELECT user_id, 0, mese, entrate, uscite, conteggio_entrate, conteggio_uscite, conteggio
+        FROM spostati
+        ON CONFLICT (user_id, categoria_id, mese) DO UPDATE SET
+            entrate = s.entrate + EXCLUDED.entrate,
+            uscite = s.uscite + EXCLUDED.uscite,
+            conteggio_entrate = s.conteggio_entrate + EXCLUDED.conteggio_entrate,
+            conteggio_uscite = s.conteggio_uscite + EXCLUDED.conteggio_uscite,
+            conteggio = s.conteggio + EXCLUDED.conteggio
+    """,
+
+    # Rollup di /metrics (vedi rollup.py)
+    "rollup.minuto": """
+        INSERT INTO transazioni_rollup_minuto AS r (minuto, tipo, conteggio)
+        SELECT * FROM unnest($1::timestamp[], $2::text[], $3::int[])
+        ON CONFLICT (minuto, tipo) DO UPDATE SET conteggio = r.conteggio + EXCLUDED.conteggio
+    """,
+    "rollup.minuto_pulizia": """
+        DELETE FROM transazioni_rollup_minuto
+        WHERE conteggio <= 0 AND (minuto, tipo) IN (SELECT * FROM unnest($1::timestamp[], $2::text[]))
+    """,
+    "rollup.utente_giorno": """
+        INSERT INTO transazioni_rollup_utente_giorno AS r (giorno, user_id, conteggio)
+        SELECT * FROM unnest($1::date[], $2::bigint[], $3::int[])
+        ON CONFLICT (giorno, user_id) DO UPDATE SET conteggio = r.conteggio + EXCLUDED.conteggio
+    """,
+    "rollup.utente_giorno_pulizia": """
+        DELETE FROM transazioni_rollup_utente_giorno
+        WHERE conteggio <= 0 AND (giorno, user_id) IN (SELECT * FROM unnest($1::date[], $2::bigint[]))
+    """,
+    "rollup.utente": """
+        INSERT INTO transazioni_rollup_utente AS r (user_id, conteggio)
+        SELECT * FROM unnest($1::bigint[], $2::int[])
+        ON CONFLICT (user_id) DO UPDATE SET conteggio = r.conteggio + EXCLUDED.conteggio
+    """,
+    "rollup.utente_pulizia": "DELETE FROM transazioni_rollup_utente WHERE conteggio <= 0 AND user_id = ANY($1::bigint[])",
+
+    # Stato delle conversazioni (vedi persistenza.py)
+    "stato.by_user": "SELECT user_data, conversazioni FROM stato_utenti WHERE user_id = $1",
+    "stato.conversazioni": "SELECT conversazioni -> $1::text AS stati FROM stato_utenti WHERE conversazioni ? $1::text",
+    "stato.salva": """
+        INSERT INTO stato_utenti AS s (user_id, user_data, conversazioni)
+        SELECT * FROM unnest($1::bigint[], $2::jsonb[], $3::jsonb[])
+        ON CONFLICT (user_id) DO UPDATE
+        SET user_data = EXCLUDED.user_data, conversazioni = EXCLUDED.conversazioni, aggiornato = NOW()
+    """,
+    "stato.elimina": "DELETE FROM stato_utenti WHERE user_id = ANY($1::bigint[])",
+
+    # Ritardo della replica in secondi (0 se allineata o se è un primario)
+    "replica.ritardo": """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """,
+
+    # Metriche (lette solo dal rollup)
+    "metrics.oggi": """
+        SELECT tipo, SUM(conteggio) AS conteggio
+        FROM transazioni_rollup_minuto
+        WHERE minuto >= CURRENT_DATE AND minuto < CURRENT_DATE + 1
+        GROUP BY tipo
+    """,
+    "metrics.utenti_attivi_oggi": """
+        SELECT COUNT(*)
+        FROM transazioni_rollup_utente_giorno
+        WHERE giorno = CURRENT_DATE
+    """,
+    "metrics.crescita": """
+        WITH utenti_corrente AS (
+            SELECT COUNT(DISTINCT user_id) AS totale
+            FROM transazioni_rollup_utente_giorno
+            WHERE giorno >= DATE_TRUNC('month', CURRENT_DATE)
+        ),
+        utenti_precedente AS (
+            SELECT COUNT(DISTINCT user_id) AS totale
+            FROM transazioni_rollup_utente_giorno
+            WHERE giorno >= DATE_TRUNC('month', CURRENT_DATE) - INTERVAL '1 month'
+              AND giorno < DATE_TRUNC('month', CURRENT_DATE)
+        )
+        SELECT
+            (utenti_corrente.totale - utenti_precedente.totale) * 100.0 / NULLIF(utenti_precedente.totale, 0) AS crescita_percentuale
+        FROM utenti_corrente, utenti_precedente
+    """,
+    "metrics.utenti_totali": "SELECT COUNT(*) FROM transazioni_rollup_utente",
+}
+
+# Varianti generate: una query dichiarata per ogni combinazione ammessa
+
+for _risoluzione, _espressione in RISOLUZIONI.items():
+    QUERY[f"metrics.per_periodo.{_risoluzione}"] = f"""
+        SELECT
+            {_espressione} AS periodo,
+            COALESCE(SUM(conteggio) FILTER (WHERE tipo = 'entrate'), 0) AS entrate,
+            COALESCE(SUM(conteggio) FILTER (WHERE tipo = 'uscite'), 0) AS uscite
+        FROM transazioni_rollup_minuto
+        WHERE minuto >= LOCALTIMESTAMP - $1::interval
+        GROUP BY periodo
+        ORDER BY periodo
+    """
+
+for _variante, _filtro in FILTRI_TRANSAZIONI.items():
+    _n = PARAMETRI_FILTRO[_variante]
+    # Paginazione keyset: prima pagina, ▶ verso le più vecchie, ◀ verso le più recenti
+    # (vedi paginazione.py); l'ultimo parametro è il LIMIT
+    QUERY[f"transazioni.pagina.{_variante}"] = f"""
+        SELECT id, descrizione, importo, data FROM transazioni
+        WHERE user_id = $1 AND data IS NOT NULL {_filtro}
+        ORDER BY data DESC, id DESC
+        LIMIT ${_n + 1}
+    """
+    QUERY[f"transazioni.pagina.{_variante}.a"] = f"""
+        SELECT id, descrizione, importo, data FROM transazioni
+        WHERE user_id = $1 AND data IS NOT NULL {_filtro} AND (data, id) < (${_n + 1}, ${_n + 2})
+        ORDER BY data DESC, id DESC
+        LIMIT ${_n + 3}
+    """
+    QUERY[f"transazioni.pagina.{_variante}.i"] = f"""
+        SELECT id, descrizione, importo, data FROM transazioni
+        WHERE user_id = $1 AND data IS NOT NULL {_filtro} AND (data, id) > (${_n + 1}, ${_n + 2})
+        ORDER BY data ASC, id ASC
+        LIMIT ${_n + 3}
+    """
+
+    # Riepilogo in una finestra [dal, al): una pagina come sopra più numero e somma degli
+    # importi di tutta la finestra, in un solo round trip. Il LEFT JOIN restituisce i totali
+    # anche quando la pagina è vuota (una riga con le colonne della transazione a NULL).
+    _finestra = f"user_id = $1 {_filtro} AND data >= ${_n + 1} AND data < ${_n + 2}"
+    for _suffisso, _cursore, _ordine, _limite in (
+        ("", "", "DESC", _n + 3),
+        (".a", f"AND (data, id) < (${_n + 3}, ${_n + 4})", "DESC", _n + 5),
+        (".i", f"AND (data, id) > (${_n + 3}, ${_n + 4})", "ASC", _n + 5),
+    ):
+        QUERY[f"riepilogo.pagina.{_variante}{_suffisso}"] = f"""
+            SELECT p.id, p.descrizione, p.importo, p.data, t.conteggio, t.totale
+            FROM (
+                SELECT COUNT(*) AS conteggio, COALESCE(SUM(importo), 0) AS totale
+                FROM transazioni WHERE {_finestra}
+            ) t
+            LEFT JOIN LATERAL (
+                SELECT id, descrizione, importo, data FROM transazioni
+                WHERE {_finestra} {_cursore}
+                ORDER BY data {_ordine}, id {_ordine}
+                LIMIT ${_limite}
+            ) p ON TRUE
+            ORDER BY p.data {_ordine}, p.id {_ordine}
+        """
+
+for _dal in (False, True):
+    for _al in (False, True):
+        _condizioni = "t.user_id = $1"
+        _i = 2
+        if _dal:
+            _condizioni += f" AND t.data >= ${_i}"
+            _i += 1
+        if _al:
+            _condizioni += f" AND t.data < ${_i}"
+        QUERY[f"esportazione.conta{'.dal' if _dal else ''}{'.al' if _al else ''}"] = f"""
+            SELECT COUNT(*) FROM transazioni t WHERE {_condizioni}
+        """
+
+# Statistiche per query: chiamate, errori, latenze recenti per i percentili
+CAMPIONI_LATENZA = 1000
+
+class StatisticheQuery:
+    def __init__(self):
+        self.chiamate = 0
+        self.errori = 0
+        self.tempo_totale = 0.0
+        self.latenze = deque(maxlen=CAMPIONI_LATENZA)
+
+    def registra(self, durata, errore):
+        self.chiamate += 1
+        self.tempo_totale += durata
+        self.latenze.append(durata)
+        if errore:
+            self.errori += 1
+
+    def riepilogo(self):
+        ordinate = sorted(self.latenze)
+        def percentile(p):
+            return round(ordinate[min(len(ordinate) - 1, int(len(ordinate) * p))] * 1000, 3) if ordinate else None
+        return {
+            "chiamate": self.chiamate,
+            "errori": self.errori,
+            "media_ms": round(self.tempo_totale / self.chiamate * 1000, 3) if self.chiamate else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+        }
+
+statistiche = {}
+
+def _registra(nome, durata, errore):
+    voce = statistiche.get(nome)
+    if voce is None:
+        voce = statistiche[nome] = StatisticheQuery()
+    voce.registra(durata, errore)
+    monitoraggio.osserva_query(nome, durata, errore)
+
+# Misura un'operazione sul database che non passa da QUERY (COPY, ricostruzioni, ...)
+@asynccontextmanager
+async def misura(nome):
+    inizio = time.perf_counter()
+    errore = True
+    try:
+        yield
+        errore = False
+    finally:
+        _registra(nome, time.perf_counter() - inizio, errore)
+
+async def _esegui(metodo, db, nome, args):
+    sql = QUERY[nome]
+    inizio = time.perf_counter()
+    errore = True
+    try:
+        risultato = await getattr(db, metodo)(sql, *args)
+        errore = False
+        return risultato
+    finally:
+        _registra(nome, time.perf_counter() - inizio, errore)
+
+# `db` può essere il pool o una connessione (anche dentro una transazione)
+async def fetch(db, nome, *args):
+    return await _esegui("fetch", db, nome, args)
+
+async def fetchrow(db, nome, *args):
+    return await _esegui("fetchrow", db, nome, args)
+
+async def fetchval(db, nome, *args):
+    return await _esegui("fetchval", db, nome, args)
+
+async def execute(db, nome, *args):
+    return await _esegui("execute", db, nome, args)
+
+# Statistiche di tutte le query eseguite, dalla più costosa in tempo totale
+def dump_statistiche():
+    return {
+        nome: voce.riepilogo()
+        for nome, voce in sorted(statistiche.items(), key=lambda v: v[1].tempo_totale, reverse=True)
+    }
+
+# Statement cache di asyncpg per connessione: tutte le query dichiarate più un margine
+# per quelle non dichiarate (migrazioni, ricostruzioni)
+DIMENSIONE_STATEMENT_CACHE = len(QUERY) + 20
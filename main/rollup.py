@@ -0,0 +1,125 @@
+import asyncio
+import os
+import sys
+from collections import Counter
+
+import asyncpg
+
+import query
+import saldi
+
+# Tabelle di rollup lette da /metrics al posto di transazioni (create dalla migrazione 2):
+# - transazioni_rollup_minuto: conteggio per minuto e tipo (entrate/uscite)
+# - transazioni_rollup_utente_giorno: conteggio per giorno e utente (utenti attivi)
+# - transazioni_rollup_utente: conteggio per utente (utenti totali)
+# registra/registra_modifica aggiornano anche i saldi mensili per utente (saldi.py), così
+# ogni scrittura su transazioni ha un solo punto da chiamare.
+
+def tipo_transazione(importo):
+    return "uscite" if importo < 0 else "entrate"
+
+# Applica al rollup e ai saldi l'effetto di un insieme di righe di transazioni
+# (segno=1 per inserimenti, segno=-1 per eliminazioni).
+# Va chiamata sulla stessa connessione e nella stessa transazione della scrittura.
+async def registra(conn, righe, segno=1):
+    await saldi.registra(conn, righe, segno)
+    await _conta(conn, righe, segno)
+
+async def _conta(conn, righe, segno):
+    minuti = Counter()
+    giorni = Counter()
+    utenti = Counter()
+    for r in righe:
+        if r["data"] is None:
+            continue
+        minuti[(r["data"].replace(second=0, microsecond=0), tipo_transazione(r["importo"]))] += segno
+        if r["user_id"] is not None:
+            giorni[(r["data"].date(), r["user_id"])] += segno
+            utenti[r["user_id"]] += segno
+
+    if not minuti:
+        return
+
+    # Chiavi ordinate: transazioni concorrenti bloccano le righe nello stesso ordine (niente deadlock)
+    chiavi = sorted(minuti)
+    await query.execute(conn, "rollup.minuto", [k[0] for k in chiavi], [k[1] for k in chiavi], [minuti[k] for k in chiavi])
+    if segno < 0:
+        await query.execute(conn, "rollup.minuto_pulizia", [k[0] for k in chiavi], [k[1] for k in chiavi])
+
+    chiavi = sorted(giorni)
+    if chiavi:
+        await query.execute(conn, "rollup.utente_giorno", [k[0] for k in chiavi], [k[1] for k in chiavi], [giorni[k] for k in chiavi])
+        # Le righe a zero falserebbero i conteggi di utenti distinti
+        if segno < 0:
+            await query.execute(conn, "rollup.utente_giorno_pulizia", [k[0] for k in chiavi], [k[1] for k in chiavi])
+
+    chiavi = sorted(utenti)
+    if chiavi:
+        await query.execute(conn, "rollup.utente", chiavi, [utenti[k] for k in chiavi])
+        if segno < 0:
+            await query.execute(conn, "rollup.utente_pulizia", chiavi)
+
+# Applica una modifica di una singola transazione (riga prima e dopo l'UPDATE)
+async def registra_modifica(conn, vecchia, nuova):
+    # I saldi cambiano anche quando cambia solo l'importo
+    await saldi.registra_modifica(conn, vecchia, nuova)
+    if (tipo_transazione(vecchia["importo"]) == tipo_transazione(nuova["importo"])
+            and vecchia["data"] == nuova["data"]
+            and vecchia["user_id"] == nuova["user_id"]):
+        return
+    await _conta(conn, [vecchia], -1)
+    await _conta(conn, [nuova], 1)
+
+# Ricostruisce da zero il rollup a partire da transazioni, su una connessione
+# già dentro una transazione. Blocca le scritture su transazioni fino al commit.
+async def ricostruisci_conn(conn, timeout=None):
+    await conn.execute("LOCK TABLE transazioni IN SHARE MODE", timeout=timeout)
+    await conn.execute("""
+        TRUNCATE transazioni_rollup_minuto, transazioni_rollup_utente_giorno, transazioni_rollup_utente
+    """, timeout=timeout)
+    await conn.execute("""
+        INSERT INTO transazioni_rollup_minuto (minuto, tipo, conteggio)
+        SELECT
+            DATE_TRUNC('minute', data),
+            CASE WHEN importo < 0 THEN 'uscite' ELSE 'entrate' END,
+            COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL
+        GROUP BY 1, 2
+    """, timeout=timeout)
+    await conn.execute("""
+        INSERT INTO transazioni_rollup_utente_giorno (giorno, user_id, conteggio)
+        SELECT data::date, user_id, COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY 1, 2
+    """, timeout=timeout)
+    await conn.execute("""
+        INSERT INTO transazioni_rollup_utente (user_id, conteggio)
+        SELECT user_id, COUNT(*)
+        FROM transazioni
+        WHERE data IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY 1
+    """, timeout=timeout)
+
+async def ricostruisci(pool):
+    async with query.misura("rollup.ricostruzione"):
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await ricostruisci_conn(conn)
+
+# Uso: python rollup.py ricostruisci (lo schema deve essere già migrato dall'avvio del bot)
+async def _comando(argomenti):
+    if argomenti != ["ricostruisci"]:
+        print("Uso: python rollup.py ricostruisci")
+        return 1
+    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"))
+    try:
+        await ricostruisci(pool)
+    finally:
+        await pool.close()
+    print("✅ Rollup ricostruito")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_comando(sys.argv[1:])))
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import sys
+from decimal import Decimal
+
+import asyncpg
+
+import query
+
+# Saldi mensili materializzati per utente e categoria (tabella saldi_mensili, migrazione 6):
+# per ogni (utente, categoria, mese) somma e numero di entrate e di uscite. I totali dei
+# riepiloghi e i grafici li leggono da qui invece di scorrere tutta la storia delle transazioni.
+# Sono aggiornati nella stessa transazione di ogni scrittura su transazioni (rollup.registra
+# li chiama) e di ogni eliminazione di categoria (sposta_in_senza_categoria).
+# Le transazioni senza categoria stanno sotto categoria_id = 0: la chiave primaria non ammette NULL.
+
+SENZA_CATEGORIA = 0
+
+# Colonne dei valori, nell'ordine delle variazioni e dei parametri di saldi.aggiorna
+COLONNE = ("entrate", "uscite", "conteggio_entrate", "conteggio_uscite", "conteggio")
+
+def _accumula(variazioni, riga, segno):
+    if riga["data"] is None or riga["user_id"] is None or riga["importo"] is None:
+        return
+    chiave = (riga["user_id"], riga["categoria_id"] or SENZA_CATEGORIA, riga["data"].date().replace(day=1))
+    valori = variazioni.setdefault(chiave, [Decimal(0), Decimal(0), 0, 0, 0])
+    if riga["importo"] > 0:
+        valori[0] += riga["importo"] * segno
+        valori[2] += segno
+    elif riga["importo"] < 0:
+        valori[1] += riga["importo"] * segno
+        valori[3] += segno
+    valori[4] += segno
+
+async def _applica(conn, variazioni):
+    # Chiavi ordinate: transazioni concorrenti bloccano le righe nello stesso ordine (niente deadlock)
+    chiavi = sorted(k for k, v in variazioni.items() if any(v))
+    if not chiavi:
+        return
+    await query.execute(
+        conn, "saldi.aggiorna",
+        [k[0] for k in chiavi], [k[1] for k in chiavi], [k[2] for k in chiavi],
+        *([variazioni[k][i] for k in chiavi] for i in range(len(COLONNE)))
+    )
+    # Un mese rimasto senza transazioni non deve restare come riga a zero
+    if any(variazioni[k][4] < 0 for k in chiavi):
+        await query.execute(
+            conn, "saldi.pulizia", [k[0] for k in chiavi], [k[1] for k in chiavi], [k[2] for k in chiavi]
+        )
+
+# Applica ai saldi l'effetto di un insieme di righe di transazioni (segno=1 inserimenti,
+# segno=-1 eliminazioni). Le righe devono avere user_id, importo, data e categoria_id.
+# Va chiamata sulla stessa connessione e nella stessa transazione della scrittura.
+async def registra(conn, righe, segno=1):
+    variazioni = {}
+    for riga in righe:
+        _accumula(variazioni, riga, segno)
+    await _applica(conn, variazioni)
+
+# Una singola transazione modificata (riga prima e dopo l'UPDATE), con un solo upsert
+async def registra_modifica(conn, vecchia, nuova):
+    variazioni = {}
+    _accumula(variazioni, vecchia, -1)
+    _accumula(variazioni, nuova, 1)
+    await _applica(conn, variazioni)
+
+# Eliminando una categoria le sue transazioni passano a categoria_id NULL (ON DELETE SET NULL):
+# i suoi saldi confluiscono in quelli senza categoria. Nella stessa transazione del DELETE.
+async def sposta_in_senza_categoria(conn, user_id, categoria_id):
+    await query.execute(conn, "saldi.sposta_categoria", user_id, categoria_id)
+
+# Saldi attesi, calcolati da transazioni ($1 = user_id oppure NULL per tutti)
+SQL_ATTESI = """
+    SELECT
+        user_id,
+        COALESCE(categoria_id, 0) AS categoria_id,
+        DATE_TRUNC('month', data)::date AS mese,
+        COALESCE(SUM(importo) FILTER (WHERE importo > 0), 0) AS entrate,
+        COALESCE(SUM(importo) FILTER (WHERE importo < 0), 0) AS uscite,
+        COUNT(*) FILTER (WHERE importo > 0) AS conteggio_entrate,
+        COUNT(*) FILTER (WHERE importo < 0) AS conteggio_uscite,
+        COUNT(*) AS conteggio
+    FROM transazioni
+    WHERE data IS NOT NULL AND user_id IS NOT NULL AND importo IS NOT NULL
+      AND ($1::bigint IS NULL OR user_id = $1)
+    GROUP BY 1, 2, 3
+"""
+
+# Ricostruisce i saldi (di un utente o di tutti) a partire da transazioni, su una connessione
+# già dentro una transazione. Blocca le scritture su transazioni fino al commit.
+async def ricostruisci_conn(conn, user_id=None, timeout=None):
+    await conn.execute("LOCK TABLE transazioni IN SHARE MODE", timeout=timeout)
+    if user_id is None:
+        await conn.execute("TRUNCATE saldi_mensili", timeout=timeout)
+    else:
+        await conn.execute("DELETE FROM saldi_mensili WHERE user_id = $1", user_id, timeout=timeout)
+    await conn.execute(f"""
+        INSERT INTO saldi_mensili (user_id, categoria_id, mese, {", ".join(COLONNE)})
+        {SQL_ATTESI}
+    """, user_id, timeout=timeout)
+
+async def ricostruisci(pool, user_id=None):
+    async with query.misura("saldi.ricostruzione"):
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await ricostruisci_conn(conn, user_id)
+
+# Controllo di consistenza: confronta i saldi salvati con quelli ricalcolati da transazioni.
+# Restituisce al massimo `limite` differenze come (chiave, attesi, salvati); una lista vuota
+# vuol dire che i saldi sono corretti. La lettura è in REPEATABLE READ per vedere le due
+# tabelle allo stesso istante anche mentre il bot scrive.
+async def verifica(pool, user_id=None, limite=100):
+    colonne = ", ".join(COLONNE)
+    async with query.misura("saldi.verifica"):
+        async with pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                righe = await conn.fetch(f"""
+                    WITH attesi AS ({SQL_ATTESI}),
+                    salvati AS (
+                        SELECT user_id, categoria_id, mese, {colonne} FROM saldi_mensili
+                        WHERE $1::bigint IS NULL OR user_id = $1
+                    )
+                    SELECT
+                        COALESCE(a.user_id, s.user_id) AS user_id,
+                        COALESCE(a.categoria_id, s.categoria_id) AS categoria_id,
+                        COALESCE(a.mese, s.mese) AS mese,
+                        ROW({", ".join("a." + c for c in COLONNE)}) AS attesi,
+                        ROW({", ".join("s." + c for c in COLONNE)}) AS salvati
+                    FROM attesi a
+                    FULL JOIN salvati s
+                        ON a.user_id = s.user_id AND a.categoria_id = s.categoria_id AND a.mese = s.mese
+                    WHERE ({", ".join("a." + c for c in COLONNE)})
+                        IS DISTINCT FROM ({", ".join("s." + c for c in COLONNE)})
+                    ORDER BY 1, 2, 3
+                    LIMIT $2
+                """, user_id, limite)
+    return [
+        ((r["user_id"], r["categoria_id"], r["mese"]), tuple(r["attesi"]), tuple(r["salvati"]))
+        for r in righe
+    ]
+
+# Uso: python saldi.py verifica [user_id] | ricostruisci [user_id]
+# (lo schema deve essere già migrato dall'avvio del bot)
+async def _comando(argomenti):
+    if not argomenti or argomenti[0] not in ("verifica", "ricostruisci") or len(argomenti) > 2:
+        print("Uso: python saldi.py verifica [user_id] | ricostruisci [user_id]")
+        return 1
+    user_id = int(argomenti[1]) if len(argomenti) == 2 else None
+    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"))
+    try:
+        if argomenti[0] == "ricostruisci":
+            await ricostruisci(pool, user_id)
+            print("✅ Saldi ricostruiti")
+            return 0
+        differenze = await verifica(pool, user_id)
+    finally:
+        await pool.close()
+    if not differenze:
+        print("✅ Saldi coerenti con le transazioni")
+        return 0
+    nomi = ", ".join(COLONNE)
+    for (utente, categoria, mese), attesi, salvati in differenze:
+        print(f"❌ utente {utente}, categoria {categoria}, {mese:%Y-%m}: attesi ({nomi}) = {attesi}, salvati = {salvati}")
+    print("Per correggere: python saldi.py ricostruisci" + (f" {user_id}" if user_id is not None else ""))
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_comando(sys.argv[1:])))
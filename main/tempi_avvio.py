@@ -0,0 +1,72 @@
+import time
+
+# Tempi di avvio del bot. transaction.py importa questo modulo per primo, così
+# INIZIO cade prima di tutti gli altri import e le fasi misurano l'avvio a freddo reale.
+INIZIO = time.perf_counter()
+fasi = {}
+
+def segna(fase):
+    if fase not in fasi:
+        fasi[fase] = time.perf_counter() - INIZIO
+        print(f"⏱️ Avvio, {fase}: {fasi[fase] * 1000:.0f} ms")
+
+# Moduli pesanti che non devono essere importati all'avvio (solo nei worker dei grafici)
+MODULI_VIETATI = ("matplotlib", "numpy", "PIL")
+
+# Report in stile -X importtime dell'import di un modulo, eseguito in un processo pulito.
+# Restituisce (tempo totale in µs, righe (self µs, cumulativo µs, nome) del primo livello, moduli importati)
+def analizza_import(modulo="transaction"):
+    import os
+    import subprocess
+    import sys
+
+    risultato = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    )
+    righe = []
+    importati = set()
+    totale = 0
+    for linea in risultato.stderr.splitlines():
+        if not linea.startswith("import time:") or "self [us]" in linea:
+            continue
+        proprio, cumulativo, nome = linea[len("import time:"):].split("|")
+        importati.add(nome.strip())
+        # Indentazione: 1 spazio per il modulo richiesto, 3 per i suoi import diretti
+        livello = (len(nome) - len(nome.lstrip())) // 2
+        if livello == 0 and nome.strip() == modulo:
+            totale = int(cumulativo)
+        elif livello == 1:
+            righe.append((int(proprio), int(cumulativo), nome.strip()))
+    return totale, righe, importati
+
+# Uso: python tempi_avvio.py [budget in ms] — esce con codice 1 se il budget è superato
+# o se all'avvio viene importato un modulo pesante. Il tempo al primo aggiornamento
+# viene stampato dal bot stesso ("⏱️ Avvio, primo_aggiornamento").
+def _controlla(argomenti):
+    import os
+
+    budget = float(argomenti[0]) if argomenti else float(os.getenv("AVVIO_BUDGET_MS", "1500"))
+    totale, righe, importati = analizza_import()
+
+    print(f"{'cumulativo ms':>14} {'proprio ms':>11}  modulo")
+    for proprio, cumulativo, nome in sorted(righe, reverse=True, key=lambda r: r[1])[:15]:
+        print(f"{cumulativo / 1000:14.1f} {proprio / 1000:11.1f}  {nome}")
+    print(f"\nImport di transaction: {totale / 1000:.0f} ms (budget {budget:.0f} ms)")
+
+    esito = 0
+    vietati = sorted(m for m in importati if m.split(".")[0] in MODULI_VIETATI)
+    if vietati:
+        print(f"❌ Moduli pesanti importati all'avvio: {', '.join(vietati[:10])}")
+        esito = 1
+    if totale / 1000 > budget:
+        print("❌ Budget di avvio superato")
+        esito = 1
+    if esito == 0:
+        print("✅ Avvio entro il budget")
+    return esito
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(_controlla(sys.argv[1:]))
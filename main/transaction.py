@@ -1,98 +1,174 @@
-from ast import Call
-from importlib.metadata import EntryPoint
-from matplotlib.backend_bases import key_press_handler
-from matplotlib.pylab import rand
-from telegram import Bot, Update, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, ConversationHandler, CallbackQueryHandler, filters
+import tempi_avvio  # per primo: misura anche il tempo degli altri import
+from telegram import Update, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, ConversationHandler, CallbackQueryHandler, TypeHandler, filters
 import os
-from pathlib import Path
-from dotenv import load_dotenv
 import asyncpg
-import csv
-import io
+import database
+from database import DatabaseOccupato, letture
 from aiohttp import web
 import asyncio  # Importa asyncio per gestire l'event loop
-import nest_asyncio
-import matplotlib.pyplot as plt
-from metrics import handle_metrics
-from datetime import datetime, timedelta
-
-
-# Applica nest_asyncio per evitare conflitti con l'event loop
-nest_asyncio.apply()
-
+import hmac
+import secrets
+import signal
+from grafici import ServizioGrafici, GraficiOccupati
+from cache_grafici import cache_grafici
+from cache_utente import cache_categorie, cache_carte
+from metrics import handle_metrics, handle_query_stats, handle_prometheus
+import monitoraggio
+import query as db
+import rollup
+import saldi
+import paginazione
+import esportazione
+import importazione
+from inserimenti import inseritore
+from elaborazione import processore
+from invii import limitatore
+from persistenza import persistenza
+from migrazioni import applica_migrazioni
+from html import escape
+
+
+tempi_avvio.segna("import")
+
+# Pool condiviso, configurato da variabili d'ambiente (vedi database.py)
 async def connect_db():
-    return await asyncpg.create_pool(os.getenv("DATABASE_URL"))
-
-async def crea_tabella(pool):
-    # Crea la tabella delle transazioni
-    await pool.execute("""
-        CREATE TABLE IF NOT EXISTS transazioni (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            descrizione TEXT,
-            importo NUMERIC,
-            data TIMESTAMP DEFAULT NOW(),
-            categoria_id INTEGER,
-            metodoPagamento INTEGER,
-            FOREIGN KEY (metodoPagamento) REFERENCES carte(id) ON DELETE SET NULL,
-            FOREIGN KEY (categoria_id) REFERENCES categorie(id) ON DELETE SET NULL
-        )
-    """)
-    # Crea la tabella delle categorie
-    await pool.execute("""
-        CREATE TABLE IF NOT EXISTS categorie (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            nome TEXT NOT NULL,
-            UNIQUE(user_id, nome)  -- Ogni utente può avere categorie uniche
-        )
-    """)
-    # Crea la tabella dei metodi di pagamento
-    await pool.execute("""
-        CREATE TABLE IF NOT EXISTS carte (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            nome TEXT NOT NULL,
-            UNIQUE(user_id, nome)
-        )
-    """)
+    return await database.connetti()
+
+# Da chiamare dopo ogni scrittura che cambia i dati di report di un utente: invalida i suoi
+# grafici in cache e tiene le sue letture sul primario finché la replica non è allineata
+def dati_modificati(user_id):
+    cache_grafici.invalida(user_id)
+    letture.scrittura(user_id)
+
+# Scritture su transazioni: ogni modifica aggiorna il rollup nella stessa transazione SQL
+# Con INSERIMENTI_BATCH=1 l'insert passa dal writer a lotti (inserimenti.py)
+async def inserisci_transazione(pool, user_id, descrizione, importo, categoria_id, carta_id):
+    if inseritore.attivo:
+        riga = await inseritore.inserisci(user_id, descrizione, importo, categoria_id, carta_id)
+        dati_modificati(user_id)
+        return riga
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            riga = await db.fetchrow(
+                conn, "transazioni.insert", user_id, descrizione, importo, categoria_id, carta_id
+            )
+            await rollup.registra(conn, [riga])
+    dati_modificati(user_id)
+    return riga
+
+# L'importo mantiene il segno della transazione originale (una spesa resta una spesa)
+async def modifica_transazione(pool, transazione_id, user_id, importo, descrizione=None):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            vecchia = await db.fetchrow(conn, "transazioni.lock_by_id", transazione_id, user_id)
+            if vecchia is None:
+                return None
+            importo = -abs(importo) if vecchia['importo'] < 0 else abs(importo)
+            nuova = await db.fetchrow(conn, "transazioni.update", descrizione, importo, transazione_id)
+            await rollup.registra_modifica(conn, vecchia, nuova)
+    dati_modificati(user_id)
+    return nuova
+
+async def elimina_transazione(pool, transazione_id, user_id):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            righe = await db.fetch(conn, "transazioni.delete", transazione_id, user_id)
+            await rollup.registra(conn, righe, -1)
+    dati_modificati(user_id)
+    return len(righe) > 0
+
+# Elimina una categoria (query `nome` con RETURNING id) e sposta i suoi saldi mensili in
+# "Senza Categoria", dove finiscono le sue transazioni. Restituisce False se non esisteva.
+async def elimina_categoria_db(pool, user_id, nome, *parametri):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            categoria_id = await db.fetchval(conn, nome, *parametri)
+            if categoria_id is None:
+                return False
+            await saldi.sposta_in_senza_categoria(conn, user_id, categoria_id)
+    return True
 
 # Stati della conversazione
 DESCRIZIONE, IMPORTO, CATEGORIA, CARTA = range(4)
 
-# Lista globale per memorizzare le spese
-spese = []
-
-
 # Funzione per esportare le spese in CSV
 async def esporta(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    pool = context.application.bot_data["db_pool"]
+    # Lettura di report: va sulla replica, se disponibile
+    pool = letture.pool(user_id)
 
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo, data FROM transazioni WHERE user_id = $1 ORDER BY data DESC",
-        user_id
-    )
+    try:
+        dal, al, colonne = esportazione.parse_argomenti(context.args)
+    except ValueError:
+        await update.message.reply_text(esportazione.USO)
+        return
 
-    if not transazioni:
+    righe = await esportazione.conta_righe(pool, user_id, dal, al)
+    if not righe:
         await update.message.reply_text("📂 Nessuna transazione da esportare.")
         return
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Descrizione", "Importo", "Data"])
+    if righe > esportazione.SOGLIA_BACKGROUND:
+        # Esportazione grande: non teniamo occupato l'handler, il documento arriva quando è pronto
+        await update.message.reply_text(f"⏳ Sto preparando l'esportazione di {righe} transazioni, te la invio appena è pronta.")
+        context.application.create_task(esportazione.esportazione_background(
+            context.bot, update.effective_chat.id, pool, user_id, dal, al, colonne
+        ))
+        return
 
-    for t in transazioni:
-        writer.writerow([t["descrizione"], float(t["importo"]), t["data"].strftime("%Y-%m-%d %H:%M")])
+    await esportazione.invia_esportazione(context.bot, update.effective_chat.id, pool, user_id, dal, al, colonne)
 
-    output.seek(0)
+# /importa [mappatura colonne]: il CSV arriva nel messaggio successivo
+ATTESA_FILE = range(1)
 
-    await update.message.reply_document(
-        document=io.BytesIO(output.getvalue().encode()),
-        filename="transazioni.csv",
-        caption="📤 Ecco il tuo file CSV con le transazioni"
-    )
+async def importa_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        context.user_data['mappatura'] = importazione.parse_mappatura(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{importazione.USO}")
+        return ConversationHandler.END
+    await update.message.reply_text(importazione.USO)
+    return ATTESA_FILE
+
+async def importa_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    pool = context.application.bot_data["db_pool"]
+    documento = update.message.document
+    mappatura = context.user_data.pop('mappatura', importazione.MAPPATURA_DEFAULT)
+
+    if documento.file_size and documento.file_size > importazione.MAX_BYTE:
+        await update.message.reply_text("⚠️ Il file è troppo grande (massimo 20 MB).")
+        return ConversationHandler.END
+
+    await update.message.reply_text("⏳ Importazione in corso...")
+    try:
+        percorso = await importazione.scarica_documento(context.bot, documento)
+        try:
+            # Il parsing gira in un thread: un file grande non blocca gli altri utenti
+            righe, errori, scartate = await asyncio.to_thread(importazione.analizza_file, percorso, mappatura)
+        finally:
+            os.unlink(percorso)
+
+        importate, duplicate = 0, 0
+        if righe:
+            importate, duplicate = await importazione.importa_righe(pool, user_id, righe)
+            cache_categorie.invalida(user_id)
+            cache_carte.invalida(user_id)
+            dati_modificati(user_id)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ File non valido: {e}")
+        return ConversationHandler.END
+    except DatabaseOccupato:
+        raise  # risposta di gestisci_errore
+    except Exception as e:
+        # Download o transazione falliti: l'utente aspetta comunque una risposta
+        print(f"Errore nell'importazione per l'utente {user_id}: {e!r}")
+        await update.message.reply_text("⚠️ Errore durante l'importazione, nessuna transazione importata. Riprova più tardi.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(importazione.riepilogo(importate, duplicate, scartate, errori))
+    return ConversationHandler.END
 
 # Comando /start
 from telegram.helpers import escape_markdown
@@ -104,8 +180,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /spesa - Aggiungi una spesa\n"
         "• /entrata - Aggiungi un'entrata\n"
         "• /riepilogo [giorni] - Mostra il riepilogo delle tue transazioni negli ultimi [giorni] (se non specificato 30gg)\n"
+        "  oppure /riepilogo [dal] [al] per un periodo (es. /riepilogo 2025-01-01 2025-06-30)\n"
         "• /gestisci - Modifica o elimina una transazione\n"
-        "• /esporta - Esporta le tue transazioni\n\n"
+        "• /esporta [dal] [al] - Esporta le tue transazioni (es. /esporta 2025-01-01 2025-06-30)\n\n"
         "• /grafico - Visualizza il grafico delle tue finanze\n\n"
         "• /categorie - Per visualizzare tutte le categorie presenti\n\n"
         "Inizia subito a gestire le tue finanze! 🚀"
@@ -130,7 +207,8 @@ async def set_bot_commands(app):
         BotCommand("grafico", "Visualizza il grafico delle finanze"),
         BotCommand("gestisci", "Gestisci una transazione"),
         BotCommand("gestisci_categoria", "Gestisci una categoria"),
-        BotCommand("esporta", "Esporta le transazioni in CSV")
+        BotCommand("esporta", "Esporta le transazioni in CSV"),
+        BotCommand("importa", "Importa transazioni da un file CSV")
     ]
     await app.bot.set_my_commands(commands)
 # Conversazione /spesa
@@ -155,13 +233,10 @@ async def importo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         importo = float(update.message.text)  # Converte il testo in un numero decimale
         context.user_data['importo'] = importo  # Salva l'importo nel contesto
 
-        # Recupera le categorie dal database
+        # Recupera le categorie (dalla cache per utente)
         user_id = update.effective_user.id
         pool = context.application.bot_data["db_pool"]
-        categorie = await pool.fetch(
-            "SELECT id, nome FROM categorie WHERE user_id = $1 ORDER BY nome",
-            user_id
-        )
+        categorie = await cache_categorie.elenco(pool, user_id)
 
         if not categorie:
             await update.message.reply_text(
@@ -187,26 +262,43 @@ async def importo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return IMPORTO
 
 # /gestisci
+PAGINA_GESTISCI = 10
+
+# Tastiera con una pagina di transazioni recenti: la callback_data porta l'id della transazione,
+# quindi in user_data non resta nessuna lista e la selezione è corretta anche se l'elenco cambia.
+async def tastiera_gestisci(pool, user_id, cursore=None, direzione=paginazione.AVANTI):
+    transazioni, precedenti, successive = await paginazione.pagina_transazioni(
+        pool, user_id, PAGINA_GESTISCI, cursore=cursore, direzione=direzione
+    )
+    if not transazioni:
+        return None
+
+    keyboard = [
+        [InlineKeyboardButton(f"{(t['descrizione'] or '')[:40]}: {'-' if t['importo'] < 0 else ''}{abs(t['importo']):.2f} €", callback_data=f"gestisci_{t['id']}")]
+        for t in transazioni
+    ]
+    navigazione = []
+    if precedenti:
+        navigazione.append(InlineKeyboardButton(
+            "◀", callback_data=f"gestisci_pag_{paginazione.INDIETRO}_{paginazione.codifica_cursore(transazioni[0])}"
+        ))
+    if successive:
+        navigazione.append(InlineKeyboardButton(
+            "▶", callback_data=f"gestisci_pag_{paginazione.AVANTI}_{paginazione.codifica_cursore(transazioni[-1])}"
+        ))
+    if navigazione:
+        keyboard.append(navigazione)
+    return InlineKeyboardMarkup(keyboard)
+
 async def gestisci(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     pool = context.application.bot_data["db_pool"]
 
-    transazioni = await pool.fetch(
-        "SELECT id, descrizione, importo FROM transazioni WHERE user_id = $1 ORDER BY data DESC",
-        user_id
-    )
-
-    if not transazioni:
+    reply_markup = await tastiera_gestisci(pool, user_id)
+    if reply_markup is None:
         await update.message.reply_text("📂 *Non ci sono transazioni da gestire.*", parse_mode="Markdown")
         return
 
-    context.user_data['transazioni'] = transazioni  # salviamo in memoria per callback successive
-
-    keyboard = [
-        [InlineKeyboardButton(f"{t['descrizione']}: {'-' if t['importo'] < 0 else ''}{abs(t['importo']):.2f} €", callback_data=f"gestisci_{i}")]
-        for i, t in enumerate(transazioni)
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "🛠️ *Seleziona una transazione da gestire:*",
         reply_markup=reply_markup,
@@ -224,17 +316,32 @@ async def gestisci_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Log per debug
     print(f"Callback data ricevuto: {data}")
 
+    # Navigazione tra le pagine di /gestisci: gestisci_pag_<direzione>_<cursore>
+    if data.startswith("gestisci_pag_"):
+        try:
+            direzione, cursore = data.split("_")[2:]
+            pool = context.application.bot_data["db_pool"]
+            reply_markup = await tastiera_gestisci(pool, query.from_user.id, cursore, direzione)
+            if reply_markup is None:
+                reply_markup = await tastiera_gestisci(pool, query.from_user.id)
+            if reply_markup is None:
+                await query.edit_message_text("📂 *Non ci sono transazioni da gestire.*", parse_mode="Markdown")
+                return
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
+        except (KeyError, ValueError):
+            await query.edit_message_text("⚠️ Errore: Formato del callback non valido.")
+        return
+
     # Gestione delle transazioni
-    if data.startswith("gestisci_") and not data.startswith("gestisci_categoria_"):
+    elif data.startswith("gestisci_") and not data.startswith("gestisci_categoria_"):
         try:
-            indice = int(data.split("_")[1])  # Ottieni l'indice della transazione
-            transazioni = context.user_data.get('transazioni')
-            if not transazioni or indice >= len(transazioni):
+            transazione_id = int(data.split("_")[1])  # Ottieni l'ID della transazione
+            pool = context.application.bot_data["db_pool"]
+            transazione = await db.fetchrow(pool, "transazioni.by_id", transazione_id, query.from_user.id)
+            if not transazione:
                 await query.edit_message_text("⚠️ Errore: transazione non trovata.")
                 return
 
-            transazione = transazioni[indice]
-            context.user_data['indice'] = indice
             context.user_data['transazione_id'] = transazione['id']
 
             keyboard = [
@@ -259,12 +366,9 @@ async def gestisci_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             categoria_id = int(data.split("_")[2])  # Ottieni l'ID della categoria
             context.user_data['categoria_id'] = categoria_id
 
-            # Recupera il nome della categoria dal database
+            # Recupera il nome della categoria tra quelle dell'utente
             pool = context.application.bot_data["db_pool"]
-            categoria = await pool.fetchrow(
-                "SELECT nome FROM categorie WHERE id = $1",
-                categoria_id
-            )
+            categoria = await cache_categorie.trova(pool, query.from_user.id, categoria_id)
 
             if not categoria:
                 await query.edit_message_text("⚠️ Categoria non trovata.")
@@ -302,8 +406,11 @@ async def gestisci_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         transazione_id = context.user_data.get('transazione_id')
         if transazione_id:
             pool = context.application.bot_data["db_pool"]
-            await pool.execute("DELETE FROM transazioni WHERE id = $1", transazione_id)
-            await query.edit_message_text("🗑️ *Transazione eliminata con successo!*", parse_mode="Markdown")
+            if await elimina_transazione(pool, transazione_id, query.from_user.id):
+                await query.edit_message_text("🗑️ *Transazione eliminata con successo!*", parse_mode="Markdown")
+            else:
+                await query.edit_message_text("⚠️ Errore: transazione non trovata.")
+            context.user_data.pop('transazione_id', None)
         return ConversationHandler.END
 
     # Modifica categoria
@@ -321,7 +428,10 @@ async def gestisci_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if categoria_id:
             pool = context.application.bot_data["db_pool"]
             try:
-                await pool.execute("DELETE FROM categorie WHERE id = $1", categoria_id)
+                await elimina_categoria_db(pool, query.from_user.id, "categorie.delete_by_id", categoria_id, query.from_user.id)
+                cache_categorie.invalida(query.from_user.id)
+                # Le transazioni della categoria finiscono in "Senza Categoria": i grafici cambiano
+                dati_modificati(query.from_user.id)
                 await query.edit_message_text("🗑️ Categoria eliminata con successo!")
             except asyncpg.ForeignKeyViolationError:
                 await query.edit_message_text("⚠️ Errore: Non puoi eliminare una categoria associata a transazioni.")
@@ -336,38 +446,33 @@ async def aggiorna_transazione(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         dati = update.message.text.split()
         transazione_id = context.user_data.get('transazione_id')
-        transazioni = context.user_data.get('transazioni')
-        indice = context.user_data.get('indice')
 
-        if transazione_id is None or transazioni is None or indice is None:
+        if transazione_id is None:
             await update.message.reply_text("❌ Errore: Nessuna transazione selezionata per la modifica.")
             return ConversationHandler.END
 
         pool = context.application.bot_data["db_pool"]
+        user_id = update.effective_user.id
 
         if len(dati) == 1:
             importo = float(dati[0])
-            vecchio_importo = transazioni[indice]['importo']
-            importo = -abs(importo) if vecchio_importo < 0 else abs(importo)
-
-            await pool.execute("UPDATE transazioni SET importo = $1 WHERE id = $2", importo, transazione_id)
-            await update.message.reply_text(f"✅ Importo aggiornato: {importo:.2f} €")
+            transazione = await modifica_transazione(pool, transazione_id, user_id, importo)
+            if transazione:
+                await update.message.reply_text(f"✅ Importo aggiornato: {transazione['importo']:.2f} €")
 
         elif len(dati) >= 2:
             descrizione = " ".join(dati[:-1])
             importo = float(dati[-1])
-            vecchio_importo = transazioni[indice]['importo']
-            importo = -abs(importo) if vecchio_importo < 0 else abs(importo)
-
-            await pool.execute(
-                "UPDATE transazioni SET descrizione = $1, importo = $2 WHERE id = $3",
-                descrizione, importo, transazione_id
-            )
-            await update.message.reply_text(f"✅ Transazione aggiornata: {descrizione} {importo:.2f} €")
+            transazione = await modifica_transazione(pool, transazione_id, user_id, importo, descrizione)
+            if transazione:
+                await update.message.reply_text(f"✅ Transazione aggiornata: {descrizione} {transazione['importo']:.2f} €")
 
         else:
             raise ValueError("Formato non valido. Mi servono almeno una descrizione e un importo.")
 
+        if transazione is None:
+            await update.message.reply_text("⚠️ Errore: transazione non trovata.")
+        context.user_data.pop('transazione_id', None)
         return ConversationHandler.END
 
     except ValueError:
@@ -388,13 +493,10 @@ async def seleziona_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE
         categoria_id = int(query.data.split("_")[1])
         context.user_data['categoria_id'] = categoria_id
 
-        # Recupera le carte dal database
+        # Recupera le carte (dalla cache per utente)
         user_id = query.from_user.id
         pool = context.application.bot_data["db_pool"]
-        carte = await pool.fetch(
-            "SELECT id, nome FROM carte WHERE user_id = $1 ORDER BY nome",
-            user_id
-        )
+        carte = await cache_carte.elenco(pool, user_id)
 
         if not carte:
             await query.edit_message_text(
@@ -438,33 +540,48 @@ async def seleziona_carta(update: Update, context: ContextTypes.DEFAULT_TYPE):
             importo = abs(importo)
 
         pool = context.application.bot_data["db_pool"]
-        await pool.execute(
-            "INSERT INTO transazioni (user_id, descrizione, importo, categoria_id, metodoPagamento) VALUES ($1, $2, $3, $4, $5)",
-            user_id, descrizione, importo, categoria_id, carta_id
-        )
+        await inserisci_transazione(pool, user_id, descrizione, importo, categoria_id, carta_id)
 
         await query.edit_message_text(
             f"✅ {'Spesa' if tipo == 'spesa' else 'Entrata'} aggiunta: {descrizione} {importo:+.2f} €"
         )
         return ConversationHandler.END
 
+# Errori non gestiti dagli handler. Con il database saturo si risponde subito
+# invece di lasciare l'aggiornamento in attesa di una connessione.
+# L'avviso va sempre in un nuovo messaggio: le callback query sono già state
+# risposte dagli handler e Telegram ne accetta una sola risposta.
+async def gestisci_errore(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, DatabaseOccupato):
+        if isinstance(update, Update) and update.effective_message is not None:
+            await update.effective_message.reply_text("⏳ Il servizio è molto carico, riprova tra poco.")
+        return
+    print(f"Errore nella gestione di un aggiornamento: {context.error!r}")
+
 # /annulla
 async def annulla(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Operazione annullata.", reply_markup=ReplyKeyboardRemove())
     context.user_data.clear()
     return ConversationHandler.END
 
-# /riepilogo
+# /riepilogo [giorni] oppure /riepilogo dal [al]
 async def riepilogo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        finestra = paginazione.parse_finestra(context.args)
+    except ValueError:
+        await update.message.reply_text(paginazione.USO_RIEPILOGO)
+        return
+    # La finestra viaggia in ogni callback_data: riepilogo_<tipo>_<finestra>
+    f = paginazione.codifica_finestra(finestra)
     keyboard = [
-        [InlineKeyboardButton("📊 Tutte", callback_data="riepilogo_generale")],
-        [InlineKeyboardButton("📊 Categoria", callback_data="riepilogo_categorie")],
-        [InlineKeyboardButton("📉 Spese", callback_data="riepilogo_spese")],
-        [InlineKeyboardButton("📈 Entrate", callback_data="riepilogo_entrate")]
+        [InlineKeyboardButton("📊 Tutte", callback_data=f"riepilogo_generale_{f}")],
+        [InlineKeyboardButton("📊 Categoria", callback_data=f"riepilogo_categorie_{f}")],
+        [InlineKeyboardButton("📉 Spese", callback_data=f"riepilogo_spese_{f}")],
+        [InlineKeyboardButton("📈 Entrate", callback_data=f"riepilogo_entrate_{f}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
-        "Scegli il tipo di riepilogo che vuoi visualizzare:",
+        f"Scegli il tipo di riepilogo che vuoi visualizzare ({paginazione.descrivi_finestra(finestra)}):",
         reply_markup=reply_markup
     )
 # Callback per il riepilogo
@@ -473,28 +590,45 @@ async def riepilogo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     user_id = query.from_user.id
     pool = context.application.bot_data["db_pool"]
+    # Le pagine del riepilogo sono letture di report: vanno sulla replica, se disponibile
+    report = letture.pool(user_id)
 
-    if query.data == "riepilogo_generale":
-        # Mostra tutte le transazioni (puoi riutilizzare la logica già presente)
+    parti = query.data.split("_")
+    tipo = parti[1]
+    try:
+        # L'ultimo campo è la finestra; i bottoni dei messaggi precedenti non l'hanno e
+        # usano quella predefinita
+        numero_campi = {"categoria": 4, "pag": 6}.get(tipo, 3)
+        if len(parti) == numero_campi:
+            finestra = paginazione.decodifica_finestra(parti.pop())
+        elif len(parti) == numero_campi - 1:
+            finestra = paginazione.parse_finestra([])
+        else:
+            raise ValueError(query.data)
+        if tipo == "categoria":
+            categoria_id = int(parti[2])
+    except (ValueError, OverflowError):
+        await query.edit_message_text("⚠️ Errore: Formato del callback non valido.")
+        return
+
+    if tipo == "generale":
         await query.edit_message_text("📊 Riepilogo di tutte le transazioni in arrivo...")
-        await mostra_riepilogo_generale(query, pool, user_id)
-    elif query.data == "riepilogo_spese":
+        await mostra_riepilogo_generale(query, report, user_id, finestra)
+    elif tipo == "spese":
         await query.edit_message_text("📉 Riepilogo delle sole spese in arrivo...")
-        await mostra_riepilogo_spese(query, pool, user_id)
-    elif query.data == "riepilogo_entrate":
+        await mostra_riepilogo_spese(query, report, user_id, finestra)
+    elif tipo == "entrate":
         await query.edit_message_text("📈 Riepilogo delle sole entrate in arrivo...")
-        await mostra_riepilogo_entrate(query, pool, user_id)
-    elif query.data == "riepilogo_categorie":
+        await mostra_riepilogo_entrate(query, report, user_id, finestra)
+    elif tipo == "categorie":
         # Mostra la tastiera con le categorie
-        categorie = await pool.fetch(
-            "SELECT id, nome FROM categorie WHERE user_id = $1 ORDER BY nome",
-            user_id
-        )
+        categorie = await cache_categorie.elenco(pool, user_id)
         if not categorie:
             await query.edit_message_text("📂 Non hai ancora creato categorie.")
             return
+        f = paginazione.codifica_finestra(finestra)
         keyboard = [
-            [InlineKeyboardButton(c['nome'], callback_data=f"riepilogo_categoria_{c['id']}")]
+            [InlineKeyboardButton(c['nome'], callback_data=f"riepilogo_categoria_{c['id']}_{f}")]
             for c in categorie
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -502,57 +636,79 @@ async def riepilogo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "📋 Scegli una categoria:",
             reply_markup=reply_markup
         )
-    elif query.data.startswith("riepilogo_categoria_"):
-        categoria_id = int(query.data.split("_")[-1])
-        await mostra_riepilogo_per_categoria(query, pool, user_id, categoria_id)
-
-async def mostra_riepilogo_generale(query, pool, user_id):
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo, data FROM transazioni WHERE user_id = $1 ORDER BY data DESC",
-        user_id
-    )
-    if not transazioni:
-        await query.edit_message_text("📂 Nessuna transazione trovata.")
-        return
-    totale = sum(float(t['importo']) for t in transazioni)
-    testo = "\n".join([f"• {t['descrizione']}: {t['importo']:.2f} € ({t['data'].strftime('%d/%m/%Y')})" for t in transazioni])
-    await query.edit_message_text(f"📊 Tutte le transazioni:\n\n{testo}\n\n<b>Totale:</b> {totale:.2f} €", parse_mode="HTML")
-
-async def mostra_riepilogo_spese(query, pool, user_id):
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo, data FROM transazioni WHERE user_id = $1 AND importo < 0 ORDER BY data DESC",
-        user_id
-    )
-    if not transazioni:
-        await query.edit_message_text("📉 Nessuna spesa trovata.")
-        return
-    totale = sum(float(t['importo']) for t in transazioni)
-    testo = "\n".join([f"• {t['descrizione']}: {t['importo']:.2f} € ({t['data'].strftime('%d/%m/%Y')})" for t in transazioni])
-    await query.edit_message_text(f"📉 Solo spese:\n\n{testo}\n\n<b>Totale spese:</b> {totale:.2f} €", parse_mode="HTML")
-
-async def mostra_riepilogo_entrate(query, pool, user_id):
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo, data FROM transazioni WHERE user_id = $1 AND importo > 0 ORDER BY data DESC",
-        user_id
+    elif tipo == "categoria":
+        await mostra_riepilogo_per_categoria(query, report, user_id, categoria_id, finestra)
+    elif tipo == "pag":
+        # Navigazione tra le pagine: riepilogo_pag_<variante>_<direzione>_<cursore>_<finestra>
+        try:
+            variante, direzione, cursore = parti[2:]
+            await mostra_pagina_riepilogo(query, report, user_id, variante, finestra, cursore, direzione)
+        except (KeyError, ValueError):
+            await query.edit_message_text("⚠️ Errore: Formato del callback non valido.")
+
+# Varianti del riepilogo: titolo, etichetta del totale, messaggio se vuoto
+# (i filtri SQL sono in query.FILTRI_TRANSAZIONI)
+RIEPILOGHI = {
+    "g": ("📊 Tutte le transazioni", "Totale", "📂 Nessuna transazione trovata."),
+    "s": ("📉 Solo spese", "Totale spese", "📉 Nessuna spesa trovata."),
+    "e": ("📈 Solo entrate", "Totale entrate", "📈 Nessuna entrata trovata."),
+    "c": ("📋 Transazioni per questa categoria", "Totale categoria",
+          "📋 Nessuna transazione trovata per questa categoria."),
+}
+PAGINA_RIEPILOGO = 20
+
+# Mostra una pagina del riepilogo nella finestra (dal, al) con i bottoni ◀/▶.
+# `variante` è "g", "s", "e" oppure "c<id categoria>".
+async def mostra_pagina_riepilogo(query, pool, user_id, variante, finestra, cursore=None, direzione=paginazione.AVANTI):
+    parametri = (int(variante[1:]),) if variante.startswith("c") else ()
+    titolo, etichetta, vuoto = RIEPILOGHI[variante[0]]
+
+    # Pagina e totale della finestra arrivano dalla stessa query
+    transazioni, precedenti, successive, conteggio, totale = await paginazione.pagina_riepilogo(
+        pool, user_id, PAGINA_RIEPILOGO, variante[0], parametri, finestra, cursore, direzione
     )
+    if not transazioni and cursore is not None:
+        # Le transazioni sono cambiate tra un click e l'altro: riparti dalla prima pagina
+        transazioni, precedenti, successive, conteggio, totale = await paginazione.pagina_riepilogo(
+            pool, user_id, PAGINA_RIEPILOGO, variante[0], parametri, finestra
+        )
+    periodo = paginazione.descrivi_finestra(finestra)
     if not transazioni:
-        await query.edit_message_text("📈 Nessuna entrata trovata.")
+        await query.edit_message_text(f"{vuoto} ({periodo})")
         return
-    totale = sum(float(t['importo']) for t in transazioni)
-    testo = "\n".join([f"• {t['descrizione']}: {t['importo']:.2f} € ({t['data'].strftime('%d/%m/%Y')})" for t in transazioni])
-    await query.edit_message_text(f"📈 Solo entrate:\n\n{testo}\n\n<b>Totale entrate:</b> {totale:.2f} €", parse_mode="HTML")
-
-async def mostra_riepilogo_per_categoria(query, pool, user_id, categoria_id):
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo, data FROM transazioni WHERE user_id = $1 AND categoria_id = $2 ORDER BY data DESC",
-        user_id, categoria_id
+
+    testo = "\n".join([
+        f"• {escape((t['descrizione'] or '')[:80])}: {t['importo']:.2f} € ({t['data'].strftime('%d/%m/%Y')})"
+        for t in transazioni
+    ])
+    f = paginazione.codifica_finestra(finestra)
+    bottoni = []
+    if precedenti:
+        bottoni.append(InlineKeyboardButton(
+            "◀", callback_data=f"riepilogo_pag_{variante}_{paginazione.INDIETRO}_{paginazione.codifica_cursore(transazioni[0])}_{f}"
+        ))
+    if successive:
+        bottoni.append(InlineKeyboardButton(
+            "▶", callback_data=f"riepilogo_pag_{variante}_{paginazione.AVANTI}_{paginazione.codifica_cursore(transazioni[-1])}_{f}"
+        ))
+
+    await query.edit_message_text(
+        f"{titolo} ({periodo}):\n\n{testo}\n\n<b>{etichetta}:</b> {totale:.2f} € ({conteggio} transazioni)",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([bottoni]) if bottoni else None
     )
-    if not transazioni:
-        await query.edit_message_text("📋 Nessuna transazione trovata per questa categoria.")
-        return
-    totale = sum(float(t['importo']) for t in transazioni)
-    testo = "\n".join([f"• {t['descrizione']}: {t['importo']:.2f} € ({t['data'].strftime('%d/%m/%Y')})" for t in transazioni])
-    await query.edit_message_text(f"📋 Transazioni per questa categoria:\n\n{testo}\n\n<b>Totale categoria:</b> {totale:.2f} €", parse_mode="HTML")
+
+async def mostra_riepilogo_generale(query, pool, user_id, finestra):
+    await mostra_pagina_riepilogo(query, pool, user_id, "g", finestra)
+
+async def mostra_riepilogo_spese(query, pool, user_id, finestra):
+    await mostra_pagina_riepilogo(query, pool, user_id, "s", finestra)
+
+async def mostra_riepilogo_entrate(query, pool, user_id, finestra):
+    await mostra_pagina_riepilogo(query, pool, user_id, "e", finestra)
+
+async def mostra_riepilogo_per_categoria(query, pool, user_id, categoria_id, finestra):
+    await mostra_pagina_riepilogo(query, pool, user_id, f"c{categoria_id}", finestra)
 
 # Catch comandi non validi
 async def comando_non_riconosciuto(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -565,11 +721,6 @@ async def comando_non_riconosciuto(update: Update, context: ContextTypes.DEFAULT
 async def messaggio_generico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⚠️ --- Non ho capito. Usa un comando come /spesa, /entrata o /riepilogo --- ⚠️")
 
-# Definisci etichette per grafici
-def format_labels(pct, all_vals):
-    absolute = int(round(pct / 100. * sum(all_vals)))
-    return f"{absolute} €\n({pct:.1f}%)"
-
 # Funzione per generare il grafico a torta
 async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Crea la tastiera inline con le opzioni
@@ -590,76 +741,74 @@ async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def grafico_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()  # Rispondi al callback per evitare timeout
-    if query.data == "grafico_spese":
-        await query.edit_message_text("📉 Generando il grafico delle sole spese per categoria...")
-        await grafico_spese(update, context)
-    elif query.data == "grafico_entrate":
-        await query.edit_message_text("📈 Generando il grafico delle sole entrate per categoria...")
-        await grafico_entrate(update, context)
-    elif query.data == "grafico_generale":
-        await query.edit_message_text("📊 Generando il grafico generale...")
-        await grafico_generale(update, context)
- 
+    try:
+        if query.data == "grafico_spese":
+            await query.edit_message_text("📉 Generando il grafico delle sole spese per categoria...")
+            await grafico_spese(update, context)
+        elif query.data == "grafico_entrate":
+            await query.edit_message_text("📈 Generando il grafico delle sole entrate per categoria...")
+            await grafico_entrate(update, context)
+        elif query.data == "grafico_generale":
+            await query.edit_message_text("📊 Generando il grafico generale...")
+            await grafico_generale(update, context)
+    except GraficiOccupati:
+        await query.message.reply_text("⏳ Troppi grafici in preparazione, riprova tra qualche secondo.")
+    except asyncio.TimeoutError:
+        await query.message.reply_text("⚠️ Il grafico ha impiegato troppo tempo, riprova più tardi.")
+
+# Invia un grafico e registra nella cache il file_id restituito da Telegram:
+# con file_id (grafico già inviato) non c'è né render né upload
+async def invia_grafico(update, chiave, png, didascalia, file_id=None):
+    messaggio = await update.callback_query.message.reply_photo(photo=file_id or png, caption=didascalia)
+    if file_id is None and messaggio.photo:
+        cache_grafici.salva(chiave, png, messaggio.photo[-1].file_id)
+
+# Se il grafico è in cache per la versione corrente dei dati lo invia e restituisce True
+async def invia_grafico_da_cache(update, chiave, didascalia):
+    voce = cache_grafici.ottieni(chiave)
+    if voce is None:
+        return False
+    png, file_id = voce
+    await invia_grafico(update, chiave, png, didascalia, file_id)
+    return True
+
 async def grafico_generale(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    pool = context.application.bot_data["db_pool"]
+    pool = letture.pool(user_id)
 
-    # Recupera le transazioni dal database
-    transazioni = await pool.fetch(
-        "SELECT descrizione, importo FROM transazioni WHERE user_id = $1",
-        user_id
-    )
+    chiave = cache_grafici.chiave(user_id, "generale")
+    if await invia_grafico_da_cache(update, chiave, "📊 Ecco il grafico delle tue finanze!"):
+        return
 
-    if not transazioni:
+    # Totali di spese ed entrate dai saldi mensili (vedi saldi.py)
+    totali = await db.fetchrow(pool, "grafici.generale", user_id)
+    spese = float(totali['uscite'])
+    entrate = float(totali['entrate'])
+
+    if not spese and not entrate:
         await update.callback_query.message.reply_text("📊 Nessuna transazione trovata per generare il grafico.")
         return
 
-    # Calcola il totale delle spese e delle entrate (convertendo in float)
-    spese = sum(float(t['importo']) for t in transazioni if t['importo'] < 0)
-    entrate = sum(float(t['importo']) for t in transazioni if t['importo'] > 0)
-
     # Dati per il grafico
     labels = ['Spese', 'Entrate']
     valori = [abs(spese), entrate]
 
-    # Genera il grafico a torta
-    plt.figure(figsize=(6, 6))
-    wedges, texts, autotexts = plt.pie(
-        valori,
-        labels=labels,
-        autopct=lambda pct: format_labels(pct, valori),
-        startangle=90,
-        colors=['red', 'green']
-    )
-    plt.title("Andamento delle Finanze")
-
-    # Personalizza lo stile delle etichette
-    for text in autotexts:
-        text.set_color("white")
-        text.set_fontsize(10)
-
-    # Salva il grafico in un buffer
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
-    plt.close()
+    # Genera il grafico a torta nel pool di rendering
+    png = await context.application.bot_data["grafici"].torta(valori, labels, "Andamento delle Finanze", ['red', 'green'])
 
     # Invia il grafico all'utente
-    await update.callback_query.message.reply_photo(photo=buffer, caption="📊 Ecco il grafico delle tue finanze!")
+    await invia_grafico(update, chiave, png, "📊 Ecco il grafico delle tue finanze!")
 
 async def grafico_spese(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    pool = context.application.bot_data["db_pool"]
+    pool = letture.pool(user_id)
+
+    chiave = cache_grafici.chiave(user_id, "spese")
+    if await invia_grafico_da_cache(update, chiave, "📉 Ecco il grafico delle tue spese per categoria!"):
+        return
 
     # Recupera le spese dal database, raggruppate per categoria
-    spese_per_categoria = await pool.fetch("""
-        SELECT c.nome AS categoria, SUM(t.importo) AS totale
-        FROM transazioni t
-        LEFT JOIN categorie c ON t.categoria_id = c.id
-        WHERE t.user_id = $1 AND t.importo < 0
-        GROUP BY c.nome
-        ORDER BY totale
-    """, user_id)
+    spese_per_categoria = await db.fetch(pool, "grafici.spese_per_categoria", user_id)
 
     if not spese_per_categoria:
         await update.callback_query.message.reply_text("📉 Nessuna spesa trovata per generare il grafico.")
@@ -669,45 +818,23 @@ async def grafico_spese(update: Update, context: ContextTypes.DEFAULT_TYPE):
     categorie = [s["categoria"] or "Senza Categoria" for s in spese_per_categoria]
     valori = [abs(float(s["totale"])) for s in spese_per_categoria]
 
-    # Genera il grafico a torta
-    plt.figure(figsize=(6, 6))
-    wedges, texts, autotexts = plt.pie(
-        valori,
-        labels=categorie,
-        autopct=lambda pct: format_labels(pct, valori),
-        startangle=90,
-        colors=plt.cm.Paired.colors
-    )
-    plt.title("Spese per Categoria")
-
-    # Personalizza lo stile delle etichette
-    for text in autotexts:
-        text.set_color("white")
-        text.set_fontsize(10)
-
-    # Salva il grafico in un buffer
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.close()
+    # Genera il grafico a torta nel pool di rendering
+    png = await context.application.bot_data["grafici"].torta(valori, categorie, "Spese per Categoria")
 
     # Invia il grafico all'utente
-    await update.callback_query.message.reply_photo(photo=buffer, caption="📉 Ecco il grafico delle tue spese per categoria!")
+    await invia_grafico(update, chiave, png, "📉 Ecco il grafico delle tue spese per categoria!")
 
 
 async def grafico_entrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    pool = context.application.bot_data["db_pool"]
+    pool = letture.pool(user_id)
+
+    chiave = cache_grafici.chiave(user_id, "entrate")
+    if await invia_grafico_da_cache(update, chiave, "📈 Ecco il grafico delle tue entrate per categoria!"):
+        return
 
     # Recupera le entrate dal database, raggruppate per categoria
-    entrate_per_categoria = await pool.fetch("""
-        SELECT c.nome AS categoria, SUM(t.importo) AS totale
-        FROM transazioni t
-        LEFT JOIN categorie c ON t.categoria_id = c.id
-        WHERE t.user_id = $1 AND t.importo > 0
-        GROUP BY c.nome
-        ORDER BY totale
-    """, user_id)
+    entrate_per_categoria = await db.fetch(pool, "grafici.entrate_per_categoria", user_id)
 
     if not entrate_per_categoria:
         await update.callback_query.message.reply_text("📈 Nessuna entrata trovata per generare il grafico.")
@@ -717,30 +844,11 @@ async def grafico_entrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     categorie = [e["categoria"] or "Senza Categoria" for e in entrate_per_categoria]
     valori = [float(e["totale"]) for e in entrate_per_categoria]
 
-    # Genera il grafico a torta
-    plt.figure(figsize=(6, 6))
-    wedges, texts, autotexts = plt.pie(
-        valori,
-        labels=categorie,
-        autopct=lambda pct: format_labels(pct, valori),
-        startangle=90,
-        colors=plt.cm.Paired.colors
-    )
-    plt.title("Entrate per Categoria")
-
-    # Personalizza lo stile delle etichette
-    for text in autotexts:
-        text.set_color("white")
-        text.set_fontsize(10)
-
-    # Salva il grafico in un buffer
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.close()
+    # Genera il grafico a torta nel pool di rendering
+    png = await context.application.bot_data["grafici"].torta(valori, categorie, "Entrate per Categoria")
 
     # Invia il grafico all'utente
-    await update.callback_query.message.reply_photo(photo=buffer, caption="📈 Ecco il grafico delle tue entrate per categoria!")
+    await invia_grafico(update, chiave, png, "📈 Ecco il grafico delle tue entrate per categoria!")
 
 async def aggiungi_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -755,10 +863,8 @@ async def aggiungi_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # Inserisci la categoria nel database
     try:
-        await pool.execute(
-            "INSERT INTO categorie (user_id, nome) VALUES ($1, $2)",
-            user_id, nome_categoria
-        )
+        await db.execute(pool, "categorie.insert", user_id, nome_categoria)
+        cache_categorie.invalida(user_id)
         await update.message.reply_text(f"✅ Categoria '{nome_categoria}' aggiunta con successo!")
     except asyncpg.UniqueViolationError:
         await update.message.reply_text(f"⚠️ La categoria '{nome_categoria}' esiste già.")
@@ -767,11 +873,8 @@ async def lista_categorie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     pool = context.application.bot_data["db_pool"]
 
-    # Recupera le categorie dal database
-    categorie = await pool.fetch(
-        "SELECT nome FROM categorie WHERE user_id = $1 ORDER BY nome",
-        user_id
-    )
+    # Recupera le categorie (dalla cache per utente)
+    categorie = await cache_categorie.elenco(pool, user_id)
 
     if not categorie:
         await update.message.reply_text("📂 Non hai ancora creato categorie.")
@@ -792,25 +895,21 @@ async def elimina_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nome_categoria = " ".join(context.args)
 
     # Elimina la categoria dal database
-    result = await pool.execute(
-        "DELETE FROM categorie WHERE user_id = $1 AND nome = $2",
-        user_id, nome_categoria
-    )
+    eliminata = await elimina_categoria_db(pool, user_id, "categorie.delete_by_nome", user_id, nome_categoria)
 
-    if result == "DELETE 0":
+    if not eliminata:
         await update.message.reply_text(f"⚠️ La categoria '{nome_categoria}' non esiste.")
     else:
+        cache_categorie.invalida(user_id)
+        dati_modificati(user_id)
         await update.message.reply_text(f"✅ Categoria '{nome_categoria}' eliminata con successo!")
 
 async def gestisci_categoria_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     pool = context.application.bot_data["db_pool"]
     print(f"sto gestendo le categorie per l'utente {user_id}")
-    # Recupera le categorie dal database
-    categorie = await pool.fetch(
-        "SELECT id, nome FROM categorie WHERE user_id = $1 ORDER BY nome",
-        user_id
-    )
+    # Recupera le categorie (dalla cache per utente)
+    categorie = await cache_categorie.elenco(pool, user_id)
     if not categorie:
         await update.message.reply_text("📂 Non hai ancora creato categorie. Utilizza il comando aggiungi categoria per crearne!!")
         return ConversationHandler.END
@@ -841,10 +940,8 @@ async def aggiungi_categoria_nome(update: Update, context: ContextTypes.DEFAULT_
 
     # Inserisci la categoria nel database
     try:
-        await pool.execute(
-            "INSERT INTO categorie (user_id, nome) VALUES ($1, $2)",
-            user_id, nome_categoria
-        )
+        await db.execute(pool, "categorie.insert", user_id, nome_categoria)
+        cache_categorie.invalida(user_id)
         await update.message.reply_text(f"✅ Categoria '{nome_categoria}' aggiunta con successo!")
     except asyncpg.UniqueViolationError:
         await update.message.reply_text(f"⚠️ La categoria '{nome_categoria}' esiste già.")
@@ -863,10 +960,10 @@ async def modifica_categoria_nome(update: Update, context: ContextTypes.DEFAULT_
     pool = context.application.bot_data["db_pool"]
     try:
         # Aggiorna il nome della categoria nel database
-        await pool.execute(
-            "UPDATE categorie SET nome = $1 WHERE id = $2 AND user_id = $3",
-            nuovo_nome, categoria_id, user_id
-        )
+        await db.execute(pool, "categorie.update_nome", nuovo_nome, categoria_id, user_id)
+        cache_categorie.invalida(user_id)
+        # Il nome della categoria compare nelle etichette dei grafici
+        dati_modificati(user_id)
         await update.message.reply_text(f"✅ Categoria aggiornata con successo, nuovo nome: {nuovo_nome}")
     except asyncpg.UniqueViolationError:
         await update.message.reply_text(f"⚠️ La categoria ccon nome : '{nuovo_nome}' esiste già, sceglie un altro nome.")
@@ -893,10 +990,8 @@ async def aggiungi_carta_nome(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
     # Inserisci la carta nel database
     try:
-        await pool.execute(
-            "INSERT INTO carte (user_id, nome) VALUES ($1, $2)",
-            user_id, nome_carta
-        )
+        await db.execute(pool, "carte.insert", user_id, nome_carta)
+        cache_carte.invalida(user_id)
         await update.message.reply_text(f"✅ Carta '{nome_carta}' aggiunta con successo!")
     except asyncpg.UniqueViolationError:
         await update.message.reply_text(f"⚠️ La carta '{nome_carta}' esiste già.")
@@ -908,11 +1003,8 @@ async def lista_carte(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     pool = context.application.bot_data["db_pool"]
 
-    # Recupera le carte dal database
-    carte = await pool.fetch(
-        "SELECT nome FROM carte WHERE user_id = $1 ORDER BY nome",
-        user_id
-    )
+    # Recupera le carte (dalla cache per utente)
+    carte = await cache_carte.elenco(pool, user_id)
 
     if not carte:
         await update.message.reply_text("📂 Non hai ancora aggiunto metodi di pagamento.")
@@ -921,20 +1013,61 @@ async def lista_carte(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elenco = "\n".join([f"• {c['nome']}" for c in carte])
     await update.message.reply_text(f"💳 *I tuoi metodi di pagamento:*\n\n{elenco}", parse_mode="Markdown")
 
+# Modalità di ricezione degli aggiornamenti: "polling" (default) oppure "webhook".
+# In webhook Telegram invia gli aggiornamenti al server HTTP (stesso processo, stesso event loop,
+# stesso pool di /metrics) su WEBHOOK_URL + /telegram/<WEBHOOK_SECRET>.
+MODALITA = os.getenv("BOT_MODE", "polling")
+PERCORSO_WEBHOOK = "/telegram/"
+
 # Main
 async def main():
     db_pool = await connect_db()
-    await crea_tabella(db_pool)
+    await applica_migrazioni(db_pool)
+    # Replica opzionale per le letture di report (DATABASE_REPLICA_URL)
+    await letture.avvia(db_pool)
 
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
     if not TOKEN:
         raise ValueError("Assicurati di aver impostato TELEGRAM_BOT_TOKEN nelle variabili d'ambiente")
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Pool di processi per i grafici, avviato prima di ricevere aggiornamenti
+    servizio_grafici = ServizioGrafici()
+    servizio_grafici.avvia()
+
+    # Writer a lotti delle nuove transazioni (opzionale)
+    if inseritore.attivo:
+        inseritore.avvia(db_pool)
+
+    webhook = MODALITA == "webhook"
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+    if webhook and not WEBHOOK_URL:
+        raise ValueError("In modalità webhook imposta WEBHOOK_URL (l'indirizzo pubblico del server HTTP)")
+    # Segreto sia nel percorso sia nell'header X-Telegram-Bot-Api-Secret-Token
+    segreto = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+    # Chiamate al Bot API misurate (latenza ed errori per metodo); getUpdates resta fuori.
+    # 256 connessioni come la richiesta predefinita di ApplicationBuilder
+    builder = ApplicationBuilder().token(TOKEN).request(monitoraggio.RichiestaMisurata(connection_pool_size=256))
+    # Bot API alternativa, ad esempio quella finta dei test di carico (api_finta.py, carico.py)
+    API_URL = os.getenv("TELEGRAM_API_URL")
+    if API_URL:
+        API_URL = API_URL.rstrip("/")
+        builder = builder.base_url(f"{API_URL}/bot").base_file_url(f"{API_URL}/file/bot")
+    # Conversazioni e user_data su Postgres (persistenza.py): un riavvio non interrompe /spesa
+    builder = builder.persistence(persistenza)
+    if webhook:
+        # Gli aggiornamenti arrivano dal server HTTP: nessun Updater
+        builder = builder.updater(None)
+    if processore is not None:
+        # Utenti diversi in parallelo, aggiornamenti dello stesso utente in ordine (elaborazione.py)
+        builder = builder.concurrent_updates(processore)
+    if limitatore is not None:
+        # Chiamate in uscita entro i limiti di Telegram, risposte interattive per prime (invii.py)
+        builder = builder.rate_limiter(limitatore)
+    app = builder.build()
     app.bot_data["db_pool"] = db_pool
-
-    await set_bot_commands(app)
+    app.bot_data["grafici"] = servizio_grafici
 
     # Aggiungi i gestori
     app.add_handler(CommandHandler("start", start))
@@ -948,6 +1081,8 @@ async def main():
     app.add_handler(CallbackQueryHandler(grafico_callback, pattern="grafico_"))
 
     app.add_handler(ConversationHandler(
+    name="spesa",
+    persistent=True,
     entry_points=[CommandHandler("spesa", spesa_start)],
     states={
         DESCRIZIONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, descrizione)],
@@ -961,6 +1096,18 @@ async def main():
     app.add_handler(CallbackQueryHandler(riepilogo_callback, pattern="^riepilogo_"))
 
     app.add_handler(ConversationHandler(
+        name="importa",
+        persistent=True,
+        entry_points=[CommandHandler("importa", importa_start)],
+        states={
+            ATTESA_FILE: [MessageHandler(filters.Document.ALL, importa_file)],
+        },
+        fallbacks=[CommandHandler("annulla", annulla)],
+    ))
+
+    app.add_handler(ConversationHandler(
+    name="entrata",
+    persistent=True,
     entry_points=[CommandHandler("entrata", entrata_start)],
     states={
         DESCRIZIONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, descrizione)],
@@ -972,6 +1119,8 @@ async def main():
     ))
 
     app.add_handler(ConversationHandler(
+        name="aggiungi_carta",
+        persistent=True,
         entry_points=[CommandHandler("aggiungi_carta", aggiungi_carta_start)],
         states={
             NOME_CARTA: [MessageHandler(filters.TEXT & ~filters.COMMAND, aggiungi_carta_nome)],
@@ -979,6 +1128,8 @@ async def main():
         fallbacks=[CommandHandler("annulla", annulla)],
     ))
     app.add_handler(ConversationHandler(
+        name="aggiungi_categoria",
+        persistent=True,
         entry_points=[CommandHandler("aggiungi_categoria", aggiungi_categoria_start)],
         states={
             NOME_CATEGORIA: [MessageHandler(filters.TEXT & ~filters.COMMAND, aggiungi_categoria_nome)],
@@ -987,6 +1138,8 @@ async def main():
     ))
 
     app.add_handler(ConversationHandler(
+    name="gestisci",
+    persistent=True,
     entry_points=[CallbackQueryHandler(gestisci_callback)],
     states={
         IMPORTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, aggiorna_transazione)],
@@ -996,26 +1149,98 @@ async def main():
     per_message=False,
     ))
 
-    # Avvia il bot con polling
-    print("🚀 Avvio del bot in modalità polling...")
-    await app.run_polling()
-
-# Server HTTP dummy per Render
+    # Tempo dall'avvio del processo al primo aggiornamento gestito.
+    # Essendo nel gruppo -1 crea il contesto di ogni aggiornamento prima dei ConversationHandler:
+    # così lo stato salvato dell'utente viene caricato prima che ne serva la conversazione.
+    async def primo_aggiornamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        tempi_avvio.segna("primo_aggiornamento")
+    app.add_handler(TypeHandler(Update, primo_aggiornamento), group=-1)
+    app.add_error_handler(gestisci_errore)
+    # Latenza ed errori per handler, aggiunti attorno alle callback già registrate
+    monitoraggio.misura_handlers(app)
+    monitoraggio.CODA_AGGIORNAMENTI.imposta(app.update_queue.qsize)
+    if processore is not None:
+        monitoraggio.AGGIORNAMENTI_IN_ATTESA.imposta(lambda: processore.in_attesa)
+    if limitatore is not None:
+        monitoraggio.INVII_IN_CODA.imposta(limitatore.in_coda)
+    controllo_loop = asyncio.create_task(monitoraggio.controlla_loop())
+
+    # Server HTTP e bot girano sullo stesso event loop e condividono il pool
+    server = await start_http_server(db_pool, app if webhook else None, segreto)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for segnale in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(segnale, stop.set)
+
+    persistenza.collega(db_pool, app)
+    try:
+        await app.initialize()
+        await set_bot_commands(app)
+        if webhook:
+            await app.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + PERCORSO_WEBHOOK + segreto,
+                secret_token=segreto,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            # start_polling rimuove un eventuale webhook rimasto da un avvio precedente
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await app.start()
+
+        tempi_avvio.segna("pronto")
+        print(f"🚀 Bot avviato in modalità {'webhook' if webhook else 'polling'}")
+        await stop.wait()
+    finally:
+        print("🛑 Arresto del bot...")
+        controllo_loop.cancel()
+        if app.updater is not None and app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        # Prima gli inserimenti in coda, poi il resto
+        await inseritore.chiudi()
+        await servizio_grafici.chiudi()
+        await server.cleanup()
+        await letture.chiudi()
+        await db_pool.close()
+
+# Server HTTP (porta fornita da Render): /ping, /metrics e, in modalità webhook, gli aggiornamenti di Telegram
 async def handle_ping(request):
     return web.Response(text="pong")
 
-async def start_dummy_server():
+async def handle_webhook(request):
+    segreto = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(segreto, request.app["segreto"]):
+        return web.Response(status=403)
+    bot_app = request.app["bot"]
+    try:
+        update = Update.de_json(await request.json(), bot_app.bot)
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    # L'aggiornamento viene elaborato dall'Application: la risposta a Telegram non aspetta gli handler
+    await bot_app.update_queue.put(update)
+    return web.Response()
+
+async def start_http_server(db_pool, bot_app=None, segreto=None):
     PORT = int(os.environ.get("PORT", 8080))  # Porta fornita da Render
     app = web.Application()
     app.router.add_get("/ping", handle_ping)  # Endpoint di test
     app.router.add_get("/metrics", handle_metrics)  # Endpoint per le metriche
-    app["db_pool"] = await connect_db()
+    app.router.add_get("/metrics/query", handle_query_stats)  # Latenze per query e statistiche dei componenti
+    app.router.add_get("/metrics/prometheus", handle_prometheus)  # Metriche operative
+    app["db_pool"] = db_pool
+    if bot_app is not None:
+        app["bot"] = bot_app
+        app["segreto"] = segreto
+        app.router.add_post(PERCORSO_WEBHOOK + segreto, handle_webhook)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
-    print(f"🌐 Server HTTP dummy avviato su porta {PORT}")
+    print(f"🌐 Server HTTP avviato su porta {PORT}")
+    return runner
 
 if __name__ == "__main__":
-    asyncio.run(start_dummy_server())  # Avvia il server HTTP dummy in parallelo
-    asyncio.run(main())  # Avvia il bot in modalità polling
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file